@@ -0,0 +1,210 @@
+import logging, math, os, sqlite3, threading, time
+from collections import OrderedDict
+from utils import ConfigProvider, Singleton, RateLimiter
+from metrics import Metrics
+
+class AdmissionController(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Admission control for the API routes, checked before a request does any storage or SMS work:
+
+        Per route token buckets per Client ID (admission_client_limits) and per IP address (admission_ip_limits), so one client
+        looping on a route can't starve the others or burn Firestore and Twilio quota, and a cap on the requests each route may
+        have in flight in this process (admission_max_concurrency), so a burst is shed instead of queueing behind slow backends.
+
+        Buckets live in this process unless admission_shared_path is set, in which case every gunicorn worker on the host
+        shares them through one SQLite file (see SharedTokenBuckets). Concurrency caps are always per process.
+
+        Functions:\n
+        -- -- -- -- -- --
+        admit(): Decide whether a request may run
+        release(): Give back the route slot taken by admit()
+        """
+        self.__conf = ConfigProvider()
+        self.__client_limits = self.__parse_limits(self.__conf.admission_client_limits, "admission_client_limits")
+        self.__ip_limits = self.__parse_limits(self.__conf.admission_ip_limits, "admission_ip_limits")
+        self.__concurrency_retry_after = max(1, int(math.ceil(self.__conf.admission_concurrency_retry_after)))
+        self.__max_keys = max(1, self.__conf.admission_max_tracked_keys)
+        self.__lock = threading.Lock()
+        self.__buckets = OrderedDict()
+        self.__in_flight = {}
+        self.__max_concurrency = {}
+        for route, cap in dict(self.__conf.admission_max_concurrency).items():
+            try:
+                cap = int(cap)
+            except (TypeError, ValueError):
+                logging.error(f"AdmissionController: __init__: Invalid admission_max_concurrency entry for {route}: {cap}. Expected a number")
+                continue
+            if cap > 0:
+                self.__max_concurrency[route] = cap
+                self.__in_flight[route] = 0
+        if self.__conf.admission_shared_path != "":
+            self.__shared = SharedTokenBuckets(self.__conf.admission_shared_path)
+        else:
+            self.__shared = None
+
+    def admit(self, route, client_id, ip):
+        """
+        Decide whether a request may run. An admitted request holds one of its route's slots until release() is called
+
+        :param str route: Route rule. Ex: "/api/ping"
+        :param client_id: "Client ID" from the request body, or None if it has none
+        :param str ip: Remote address
+
+        :returns tuple: None if admitted, otherwise (retry_after, reason): whole seconds for the Retry-After header and
+                        "concurrency", "client" or "ip"
+        """
+        cap = self.__max_concurrency.get(route)
+        if cap is not None:
+            with self.__lock:
+                if self.__in_flight[route] >= cap:
+                    return self.__reject(route, "concurrency", self.__concurrency_retry_after, client_id, ip)
+                self.__in_flight[route] += 1
+        for reason, key, limits in [("ip", ip, self.__ip_limits), ("client", client_id, self.__client_limits)]:
+            limit = limits.get(route)
+            if limit is None or key is None:
+                continue
+            wait = self.__take(f"{route}|{reason}|{key}", limit)
+            if wait > 0:
+                self.release(route)
+                return self.__reject(route, reason, max(1, int(math.ceil(wait))), client_id, ip)
+        return None
+
+    def release(self, route):
+        """
+        Give back the route slot taken by a successful admit(). Does nothing for routes without a concurrency cap
+
+        :param str route: Route passed to admit()
+        """
+        if route not in self.__max_concurrency:
+            return
+        with self.__lock:
+            self.__in_flight[route] = max(0, self.__in_flight[route] - 1)
+
+    def __take(self, key, limit):
+        """
+        Take a token from a bucket
+
+        :returns float: 0.0 if taken, otherwise seconds until a token is available
+        """
+        rate, burst = limit
+        if self.__shared is not None:
+            return self.__shared.try_acquire(key, rate, burst)
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                bucket = self.__buckets[key] = RateLimiter(rate, burst)
+                if len(self.__buckets) > self.__max_keys:
+                    # Least recently seen first. A dropped bucket comes back full, so only idle keys should age out
+                    self.__buckets.popitem(last=False)
+            else:
+                self.__buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+    def __reject(self, route, reason, retry_after, client_id, ip):
+        logging.debug("AdmissionController: admit: Rejected %s from %s @ %s (%s), retry after %ss", route, client_id, ip, reason, retry_after,
+                      extra={"event": "admission", "route": route, "client_id": client_id, "reason": reason})
+        if self.__conf.metrics_enabled is True:
+            Metrics().inc("app_admission_rejections_total", (("route", route), ("reason", reason)))
+        return retry_after, reason
+
+    def __parse_limits(self, limits, key):
+        """
+        :param dict limits: Route -> [rate, burst] from the config
+        :param str key: Config key, for the log line
+
+        :returns dict: Route -> (rate, burst) for every valid entry with a rate above 0
+        """
+        parsed = {}
+        for route, limit in dict(limits).items():
+            try:
+                rate, burst = float(limit[0]), float(limit[1])
+            except (TypeError, ValueError, IndexError):
+                logging.error(f"AdmissionController: __parse_limits: Invalid {key} entry for {route}: {limit}. Expected [rate, burst]")
+                continue
+            if rate > 0:
+                parsed[route] = (rate, max(1.0, burst))
+        return parsed
+
+class SharedTokenBuckets():
+
+    # Buckets untouched for this many seconds are deleted. They would have refilled long before
+    PRUNE_AGE = 3600
+    # Prune after this many takes by one process
+    PRUNE_EVERY = 10000
+
+    def __init__(self, path):
+        """
+        Token buckets shared by every process on the host through a SQLite file. Each take is one short write transaction, so
+        refills and takes from all gunicorn workers see each other. Uses wall clock time, which every process agrees on.
+        If the file can't be used, takes are let through and the error is logged: admission control fails open.
+
+        :param str path: SQLite file. Created if it doesn't exist. Keep it on a local disk
+        """
+        self.__path = path
+        self.__local = threading.local()
+        # Connections inherited over a fork. Kept referenced so the child never closes them, which could checkpoint or unlock under the parent
+        self.__inherited = []
+        self.__takes = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__after_fork)
+
+    def try_acquire(self, key, rate, burst, tokens=1):
+        """
+        Take tokens from a bucket, creating it full if it doesn't exist
+
+        :param str key: Bucket key
+        :param float rate: Tokens added per second
+        :param float burst: Bucket size
+
+        :returns float: 0.0 if the tokens were taken, otherwise the number of seconds until they will be available
+        """
+        try:
+            con = self.__connection()
+            now = time.time()
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                row = con.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                available = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                if available >= tokens:
+                    available -= tokens
+                    wait = 0.0
+                else:
+                    wait = (tokens - available) / rate
+                con.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, available, now))
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+            self.__takes += 1
+            if self.__takes % self.PRUNE_EVERY == 0:
+                self.__prune(con, now)
+            return wait
+        except Exception as e:
+            logging.error(f"SharedTokenBuckets: try_acquire: Unable to use {self.__path}. Letting the request through")
+            logging.error(e)
+            return 0.0
+
+    def __connection(self):
+        con = getattr(self.__local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.__path, timeout=1.0, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            # Losing bucket state in a crash only means a few requests get through that shouldn't have
+            con.execute("PRAGMA synchronous=OFF")
+            con.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self.__local.con = con
+        return con
+
+    def __prune(self, con, now):
+        try:
+            con.execute("DELETE FROM buckets WHERE updated < ?", (now - self.PRUNE_AGE,))
+        except Exception as e:
+            logging.error(f"SharedTokenBuckets: __prune: Unable to prune {self.__path}")
+            logging.error(e)
+
+    def __after_fork(self):
+        # The child opens its own connections
+        self.__inherited.append(self.__local)
+        self.__local = threading.local()
@@ -0,0 +1,308 @@
+import json, logging, time
+from bootstrap import init_process
+from auth import AuthHolder
+from utils import ConfigProvider, RequestUtils, get_timestamp
+from clientutils import AsyncClientUtils
+from async_sms import AsyncTwilioDispatcher, AsyncSMSBroadcaster
+from sms_queue import SMSDispatchQueue
+from metrics import Metrics
+from tracing import Tracer
+from admission import AdmissionController
+
+class RequestHeaders(dict):
+
+    def __init__(self, raw_headers):
+        """
+        Request headers from an ASGI scope, looked up case-insensitively like Flask's
+
+        :param list raw_headers: List of (name, value) byte string pairs
+        """
+        super().__init__((name.decode("latin-1").lower(), value.decode("latin-1")) for name, value in raw_headers)
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+class AsyncRequest():
+
+    def __init__(self, scope, body):
+        """
+        The parts of a request the handlers use, under the same names as Flask's request, so RequestUtils' checks work on it
+
+        :param dict scope: ASGI HTTP scope
+        :param bytes body: Request body
+        """
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = RequestHeaders(scope.get("headers", []))
+        client = scope.get("client")
+        self.remote_addr = client[0] if client else None
+        self.__body = body
+        self.__json = None
+        self.__parsed = False
+
+    def get_json(self, silent=True):
+        """
+        :returns: The body parsed as JSON, or None if it is empty or not valid JSON
+        """
+        if not self.__parsed:
+            self.__parsed = True
+            try:
+                self.__json = json.loads(self.__body) if len(self.__body) > 0 else None
+            except ValueError:
+                self.__json = None
+        return self.__json
+
+class AsyncRequestHandler():
+
+    def __init__(self):
+        """
+        ASGI app serving the same routes as server.RequestHandler, for `uvicorn asgi:app`. Storage and SMS calls are awaited
+        (see async_storage.py and async_sms.py), so a request waiting on Firestore or Twilio costs a coroutine instead of a
+        thread and one process can keep thousands of backend calls in flight. Blocking backends such as sqlite_local run on a
+        pool of async_storage_threads threads.
+
+        Metrics, tracing, admission control and request event logging work as in the WSGI app. Request profiling (profiling.py)
+        is WSGI only.
+
+        Functions:\n
+        -- -- -- -- -- --
+        ping(): POST /api/ping
+        send_text(): POST /api/send_test_message
+        broadcast_text(): POST /api/broadcast_message
+        sms_status(): POST /api/sms_status
+        metrics(): GET /metrics
+        """
+        self.__conf = ConfigProvider()
+        self.__r_utils = RequestUtils()
+        self.__c_utils = AsyncClientUtils()
+        self.__td = AsyncTwilioDispatcher()
+        if self.__conf.sms_dispatch_mode == "queued":
+            self.__sms_queue = SMSDispatchQueue()
+        else:
+            self.__sms_queue = None
+        self.__tracer = Tracer() if self.__conf.tracing_enabled is True else None
+        self.__admission = AdmissionController() if self.__conf.admission_enabled is True else None
+        self.__routes = {
+            "/api/ping": ("POST", self.ping),
+            "/api/send_test_message": ("POST", self.send_text),
+            "/api/broadcast_message": ("POST", self.broadcast_text),
+            "/api/sms_status": ("POST", self.sms_status),
+            "/metrics": ("GET", self.metrics)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.__lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        start = time.perf_counter()
+        request = AsyncRequest(scope, await self.__read_body(receive))
+        handler = self.__routes.get(request.path)
+        # The route rather than the path, so unknown paths can't grow the number of metric series
+        route = request.path if handler is not None else "unmatched"
+        span = self.__tracer.start_request(request.headers, f"{request.method} {route}") if self.__tracer is not None else None
+        error = None
+        try:
+            if handler is None:
+                res = self.__r_utils.failure_template("Not found"), 404
+            elif request.method != handler[0]:
+                res = self.__r_utils.failure_template("Method not allowed"), 405
+            else:
+                res = await self.__admit_and_handle(request, handler[1])
+        except Exception as e:
+            error = e
+            logging.error(f"AsyncRequestHandler: __call__: An unknown exception occured handling {request.method} {request.path}")
+            logging.error(e)
+            res = self.__r_utils.failure_template("Internal server error"), 500
+        status, headers, body = self.__render(res)
+        if span is not None:
+            span.tags["http.method"] = request.method
+            span.tags["http.path"] = request.path
+            span.tags["http.status_code"] = status
+            headers["X-Request-ID"] = span.tags.get("request_id", span.trace_id)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()]
+        })
+        await send({"type": "http.response.body", "body": body})
+        if span is not None:
+            self.__tracer.end_span(span, error=error)
+        self.__record_request(request, route, status, time.perf_counter() - start)
+
+    async def ping(self, request):
+        """
+        Ping request. Logs the client ID and a timestamp to the database. See server.RequestHandler.ping()
+        """
+        mandatory_keys = ["Client ID", "Software Version"]
+        v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
+        if v is not True:
+            return v
+        body_json = request.get_json()
+        ts = get_timestamp()
+        ip = request.remote_addr
+        cid = body_json["Client ID"]
+        v = body_json["Software Version"]
+        logging.info("%s: PING from %s @ %s v%s", ts, cid, ip, v, extra={"event": "ping", "client_id": cid, "route": "/api/ping"})
+        await self.__c_utils.log_client_ping(ts, cid, ip, v)
+        return self.__r_utils.blank_success_template()
+
+    async def send_text(self, request):
+        """
+        Send a text to a phone number. See server.RequestHandler.send_text()
+        """
+        mandatory_keys = ["Client ID", "SMS Body", "Phone"]
+        v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
+        if v is not True:
+            return v
+        body_json = request.get_json()
+        message_body = body_json["SMS Body"]
+        to_phone = body_json["Phone"]
+        if self.__sms_queue is not None:
+            message_id = self.__sms_queue.enqueue(body_json["Client ID"], message_body, to_phone)
+            if message_id is None:
+                return self.__r_utils.failure_template("SMS queue is full, try again later"), 503
+            return self.__r_utils.queued_template(message_id), 202
+        t_res = await self.__td.dispatch(message_body, to_phone)
+        await self.__c_utils.log_sms_sent(get_timestamp(), body_json["Client ID"], message_body, to_phone, t_res)
+        if t_res is False:
+            return self.__r_utils.failure_template("An unknown error occured trying to send SMS")
+        return self.__r_utils.blank_success_template()
+
+    async def broadcast_text(self, request):
+        """
+        Send one text to a list of phone numbers. See server.RequestHandler.broadcast_text()
+        """
+        mandatory_keys = ["Client ID", "SMS Body", "Phones"]
+        v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
+        if v is not True:
+            return v
+        body_json = request.get_json()
+        phones = body_json["Phones"]
+        if type(phones) is not list or len(phones) == 0 or not all(type(phone) is str for phone in phones):
+            return self.__r_utils.failure_template_null_values(["Phones"])
+        broadcaster = AsyncSMSBroadcaster()
+        max_recipients = broadcaster.max_recipients()
+        if len(phones) > max_recipients:
+            return self.__r_utils.failure_template(f"Too many recipients. The limit is {max_recipients}")
+        message_body = body_json["SMS Body"]
+        results = await broadcaster.broadcast(message_body, phones)
+        if results is None:
+            return self.__r_utils.failure_template("Too many broadcasts in progress, try again later"), 503
+        await self.__c_utils.log_sms_broadcast(get_timestamp(), body_json["Client ID"], message_body, results)
+        sent = sum(1 for res in results.values() if res is True)
+        if sent == 0:
+            res = self.__r_utils.failure_template("An unknown error occured trying to send SMS")
+        else:
+            res = self.__r_utils.blank_success_template()
+        res["Results"] = results
+        res["Sent"] = sent
+        res["Failed"] = len(results) - sent
+        return res
+
+    async def sms_status(self, request):
+        """
+        Look up a message queued by /api/send_test_message. See server.RequestHandler.sms_status()
+        """
+        mandatory_keys = ["Client ID", "Message ID"]
+        v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
+        if v is not True:
+            return v
+        if self.__sms_queue is None:
+            return self.__r_utils.failure_template("SMS dispatch is not queued on this server"), 400
+        body_json = request.get_json()
+        status = self.__sms_queue.get_status(body_json["Message ID"], body_json["Client ID"])
+        if status is None:
+            return self.__r_utils.failure_template("Unknown Message ID"), 404
+        res = self.__r_utils.blank_success_template()
+        res.update(status)
+        return res
+
+    async def metrics(self, request):
+        """
+        Metrics in the Prometheus text format. 404 unless metrics_enabled is set
+        """
+        if self.__conf.metrics_enabled is not True:
+            return self.__r_utils.failure_template("Metrics are not enabled on this server"), 404
+        return Metrics().render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    async def __admit_and_handle(self, request, handler):
+        """
+        Run a handler if admission control lets the request through, otherwise answer 429 with a Retry-After header
+        """
+        if self.__admission is None:
+            return await handler(request)
+        body_json = request.get_json()
+        cid = body_json.get("Client ID") if type(body_json) is dict else None
+        rejection = self.__admission.admit(request.path, cid, request.remote_addr)
+        if rejection is not None:
+            retry_after, reason = rejection
+            return self.__r_utils.failure_template(f"Too many requests ({reason} limit). Retry in {retry_after} seconds"), 429, {"Retry-After": str(retry_after)}
+        try:
+            return await handler(request)
+        finally:
+            self.__admission.release(request.path)
+
+    async def __read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                logging.info(f"AsyncRequestHandler: __lifespan: Serving ASGI on database_type {self.__conf.database_type}")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await AuthHolder().close_async_clients()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def __render(self, res):
+        """
+        Turn a handler's return value into a status, headers and body the way Flask does: a dict or str, optionally in a tuple with
+        a status code and headers
+
+        :returns tuple: (status, headers dict, body bytes)
+        """
+        status, headers = 200, {}
+        if type(res) is tuple:
+            if len(res) == 3:
+                res, status, headers = res
+                headers = dict(headers)
+            else:
+                res, status = res
+        if type(res) is dict:
+            headers.setdefault("Content-Type", "application/json")
+            body = json.dumps(res, sort_keys=True).encode("utf-8")
+        else:
+            headers.setdefault("Content-Type", "text/html; charset=utf-8")
+            body = str(res).encode("utf-8")
+        headers["Content-Length"] = str(len(body))
+        return status, headers, body
+
+    def __record_request(self, request, route, status, latency):
+        """
+        The WSGI app's record_request() hook: request metrics and the request event log line
+        """
+        if self.__conf.metrics_enabled is True:
+            metrics = Metrics()
+            metrics.inc("app_http_requests_total", (("route", route), ("method", request.method), ("status", str(status))))
+            metrics.observe("app_http_request_duration_seconds", (("route", route), ("method", request.method)), latency)
+        if self.__conf.log_request_events is True:
+            latency_ms = round(latency * 1000, 2)
+            body_json = request.get_json()
+            cid = body_json.get("Client ID") if type(body_json) is dict else None
+            logging.debug("%s %s %s %sms", request.method, request.path, status, latency_ms,
+                          extra={"event": "request", "route": request.path, "status": status, "latency_ms": latency_ms, "client_id": cid})
+
+init_process()
+app = AsyncRequestHandler()
@@ -0,0 +1,157 @@
+import logging
+from auth import AuthHolder
+from utils import ConfigProvider
+from doccache import DocumentCache, RefCache
+from instrumentation import instrument
+from storage import parse_path, InvalidPathError
+from async_storage import AsyncStorageBackend, register_async_backend
+
+class AsyncFirestoreIO(AsyncStorageBackend):
+
+    # Firestore's limit on writes per batch
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self):
+        """
+        Firestore backend for the async server, on google.cloud.firestore's AsyncClient. Same arguments and return values as
+        the matching FirestoreIO methods. A call waiting on Firestore costs a coroutine instead of a thread, so one process can
+        keep thousands of them in flight.
+
+        References come from the same RefCache as FirestoreIO's, and with firestore_cache_enabled writes invalidate and reads fill
+        the same DocumentCache.
+
+        Functions:\n
+        -- -- -- -- -- --
+        write_doc(): Write (merge) a document
+        write_docs(): Write (merge) many documents with batched commits
+        read_doc(): Read a document
+        """
+        self.__auth = AuthHolder()
+        self.__conf = ConfigProvider()
+        self.__refs = RefCache()
+        if self.__conf.firestore_cache_enabled is True:
+            self.__cache = DocumentCache()
+        else:
+            self.__cache = None
+
+    @property
+    def __firestore(self):
+        return self.__auth.firestore_async
+
+    async def write_doc(self, path, write_dict):
+        """
+        See FirestoreIO.write_doc()
+
+        :returns: True if we executed the write, False if an error occured on the Firestore write command, None if an error occured locally.
+        """
+        if type(write_dict) is not dict:
+            logging.error(f"AsyncFirestoreIO: write_doc: type(write_dict) is not dict.")
+            return None
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
+            logging.error(f"AsyncFirestoreIO: write_doc: Invalid document path: {path}")
+            return None
+        try:
+            await d_ref.set(write_dict, merge=True)
+            return True
+        except Exception as e:
+            logging.error(e)
+            return False
+        finally:
+            # After the write: any coroutine can read the path while set() is awaited. See FirestoreIO.write_doc()
+            self.__invalidate(path)
+
+    async def write_docs(self, items):
+        """
+        See FirestoreIO.write_docs()
+
+        :returns list: One result per item, in order. True if written, False if the batch holding the item failed, None if the item was invalid.
+        """
+        results = [None] * len(items)
+        pending = []
+        for i, item in enumerate(items):
+            path, write_dict = item
+            if type(write_dict) is not dict:
+                logging.error(f"AsyncFirestoreIO: write_docs: type(write_dict) is not dict for path {path}")
+                continue
+            d_ref = self.__make_doc_ref(path)
+            if d_ref is None:
+                logging.error(f"AsyncFirestoreIO: write_docs: Invalid document path: {path}")
+                continue
+            pending.append((i, path, d_ref, write_dict))
+        for start in range(0, len(pending), self.MAX_BATCH_SIZE):
+            chunk = pending[start:start + self.MAX_BATCH_SIZE]
+            try:
+                batch = self.__firestore.batch()
+                for i, path, d_ref, write_dict in chunk:
+                    batch.set(d_ref, write_dict, merge=True)
+                await batch.commit()
+                committed = True
+            except Exception as e:
+                logging.error(f"AsyncFirestoreIO: write_docs: An exception occured committing a batch of {len(chunk)} writes")
+                logging.error(e)
+                committed = False
+            for i, path, d_ref, write_dict in chunk:
+                results[i] = committed
+                self.__invalidate(path)
+        return results
+
+    async def read_doc(self, path):
+        """
+        See FirestoreIO.read_doc()
+
+        :returns dict: Your doc's data or None if an error occured or the doc didn't exist
+        """
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
+            logging.error(f"AsyncFirestoreIO: read_doc: Invalid document path: {path}")
+            return None
+        if self.__cache is not None:
+            cached = self.__cache.get(path)
+            if type(cached) is dict:
+                return cached
+            elif cached is DocumentCache.MISSING:
+                return None
+        try:
+            doc = await d_ref.get()
+            if doc.exists:
+                doc_dict = doc.to_dict()
+                if self.__cache is not None:
+                    self.__cache.put(path, doc_dict)
+                return doc_dict
+            if self.__cache is not None:
+                self.__cache.put(path, DocumentCache.MISSING)
+            logging.warning("AsyncFirestoreIO: read_doc: Your doc at path: %s appears to not exist! Check that it exists first and try again!", path)
+            return None
+        except Exception as e:
+            logging.error(f"AsyncFirestoreIO: read_doc: An unknown exception occured trying to read your doc at {path}")
+            logging.error(e)
+            return None
+
+    def __invalidate(self, path):
+        if self.__cache is not None:
+            self.__cache.invalidate(path)
+
+    def __make_doc_ref(self, path):
+        """
+        Get the document reference for a document path, from the reference cache
+
+        :returns: AsyncDocumentReference, or None if the path is not a valid document path or there is no client
+        """
+        try:
+            parsed = parse_path(path)
+        except InvalidPathError as e:
+            logging.error(f"AsyncFirestoreIO: __make_doc_ref: {e}")
+            return None
+        if not parsed.is_document:
+            logging.error(f"AsyncFirestoreIO: __make_doc_ref: {path} is not a document path")
+            return None
+        client = self.__firestore
+        if client is None:
+            return None
+        return self.__refs.get(client, parsed.path, lambda: client.document(parsed.relative_path))
+
+TIMED_METHODS = ["write_doc", "write_docs", "read_doc"]
+instrument(AsyncFirestoreIO, "firestore", TIMED_METHODS, kind="CLIENT")
+
+register_async_backend("firestore", AsyncFirestoreIO)
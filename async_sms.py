@@ -0,0 +1,189 @@
+import asyncio, logging
+from urllib.parse import urlsplit
+import aiohttp
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from twilio.http.response import Response
+from auth import AuthHolder
+from utils import ConfigProvider, Singleton, RateLimiter
+from twilio_transport import RetryPolicy, rewrite_base_url
+from instrumentation import instrument
+
+class AsyncPooledTwilioHttpClient(AsyncTwilioHttpClient):
+
+    def __init__(self, max_in_flight, connect_timeout, read_timeout, max_retries, backoff_base, backoff_max, retry_statuses, base_url=""):
+        """
+        aiohttp version of twilio_transport.PooledTwilioHttpClient for the async server: one keep-alive connection pool, connect/read
+        timeouts and the same RetryPolicy. The pool holds up to max_in_flight connections; sends past that wait for a free one.
+
+        The aiohttp session is made on the first request, inside the event loop that will use it.
+
+        :param int max_in_flight: Maximum number of requests to Twilio at once
+        See PooledTwilioHttpClient for the other parameters
+        """
+        super().__init__(pool_connections=False)
+        self.__session = None
+        self.__max_in_flight = max(1, max_in_flight)
+        self.__timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        self.__retry = RetryPolicy(max_retries, backoff_base, backoff_max, retry_statuses)
+        self.__base_url = urlsplit(base_url) if base_url else None
+
+    async def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+        """
+        Make an HTTP request, retrying failures that RetryPolicy allows. See AsyncTwilioHttpClient.request() for the parameters.
+
+        :returns: twilio.http.response.Response of the last attempt
+        """
+        url = rewrite_base_url(url, self.__base_url)
+        attempt = 0
+        while True:
+            try:
+                response = await self.__send(method, url, params, data, headers, auth, timeout, allow_redirects)
+            except aiohttp.ClientConnectionError as e:
+                delay = self.__retry.delay(method, attempt, never_sent=isinstance(e, aiohttp.ClientConnectorError))
+                if delay is None:
+                    raise
+                logging.warning(f"AsyncPooledTwilioHttpClient: request: {method} {url} failed to connect ({e}). Retry {attempt + 1}/{self.__retry.max_retries} in {delay:.2f}s")
+            else:
+                delay = self.__retry.delay(method, attempt, response=response)
+                if delay is None:
+                    return response
+                logging.warning(f"AsyncPooledTwilioHttpClient: request: {method} {url} returned {response.status_code}. Retry {attempt + 1}/{self.__retry.max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def __send(self, method, url, params, data, headers, auth, timeout, allow_redirects):
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.__max_in_flight), timeout=self.__timeout)
+        kwargs = {
+            "method": method.upper(),
+            "url": url,
+            "params": params,
+            "data": data,
+            "headers": headers,
+            "auth": aiohttp.BasicAuth(login=auth[0], password=auth[1]) if auth is not None else None,
+            "allow_redirects": allow_redirects
+        }
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        self.log_request(kwargs)
+        async with self.__session.request(**kwargs) as response:
+            self.log_response(response.status, response)
+            return Response(response.status, await response.text(), response.headers)
+
+    async def close(self):
+        """
+        Close the connection pool
+        """
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+def make_async_twilio_http_client():
+    """
+    Build the HTTP client of the async Twilio client. Always pooled, since twilio's stock async client has no timeouts or base URL
+
+    :returns AsyncPooledTwilioHttpClient:
+    """
+    conf = ConfigProvider()
+    return AsyncPooledTwilioHttpClient(
+        max_in_flight=conf.async_sms_max_in_flight,
+        connect_timeout=conf.twilio_connect_timeout,
+        read_timeout=conf.twilio_read_timeout,
+        max_retries=conf.twilio_max_retries,
+        backoff_base=conf.twilio_backoff_base,
+        backoff_max=conf.twilio_backoff_max,
+        retry_statuses=conf.twilio_retry_statuses,
+        base_url=conf.twilio_api_base_url
+    )
+
+class AsyncTwilioDispatcher():
+
+    def __init__(self):
+        """
+        Async version of sms_utils.TwilioDispatcher for the async server
+        """
+        self.__conf = ConfigProvider()
+        self.__auth = AuthHolder()
+
+    @property
+    def __tw(self):
+        return self.__auth.twilio_async
+
+    async def dispatch(self, message_body, to_phone):
+        """
+        Send an SMS
+
+        :param str message_body: String formatted message body
+        :param str to_phone: Phone to send the SMS to
+
+        :returns: True if successful send, False if an exception occurred.
+        """
+        try:
+            twilio_msg_obj = await self.__tw.messages.create_async(
+                body = message_body,
+                from_ = self.__conf.twilio_from_phone,
+                to = to_phone
+            )
+            twilio_msg_obj.sid
+            return True
+        except Exception as e:
+            logging.error("AsyncTwilioDispatcher: dispatch: An issue occured trying to construct or send an SMS via Twilio.")
+            logging.error(e)
+            return False
+
+instrument(AsyncTwilioDispatcher, "twilio", ["dispatch"], kind="CLIENT")
+
+class AsyncSMSBroadcaster(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Async version of sms_utils.SMSBroadcaster. Up to async_sms_max_in_flight sends per broadcast are in flight at once, under
+        the process-wide sms_broadcast_rate cap. Send slots are reserved up front the same way, so a broadcast that can't finish
+        within sms_broadcast_max_wait is refused and every send sleeps once until its slot
+        """
+        self.__conf = ConfigProvider()
+        self.__td = AsyncTwilioDispatcher()
+        self.__limiter = RateLimiter(self.__conf.sms_broadcast_rate)
+
+    def max_recipients(self):
+        """
+        See SMSBroadcaster.max_recipients()
+        """
+        return int(min(self.__conf.sms_broadcast_max_recipients, self.__limiter.capacity(self.__conf.sms_broadcast_max_wait)))
+
+    async def broadcast(self, message_body, to_phones):
+        """
+        Send a message to every phone in to_phones
+
+        :param str message_body: String formatted message body
+        :param list to_phones: Phones to send the SMS to. Duplicates are sent once
+
+        :returns dict: Phone -> True if sent, False if an exception occurred. None if the sends couldn't be scheduled within
+                       sms_broadcast_max_wait behind other broadcasts; nothing was sent
+        """
+        phones = list(dict.fromkeys(to_phones))
+        waits = self.__limiter.reserve(len(phones), self.__conf.sms_broadcast_max_wait)
+        if waits is None:
+            logging.warning(f"AsyncSMSBroadcaster: broadcast: {len(phones)} sends don't fit in sms_broadcast_max_wait behind other broadcasts. Refusing")
+            return None
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        # Slots are in order, so each sender takes the next phone once it is free
+        jobs = iter(zip(phones, waits))
+        results = {}
+        senders = min(len(phones), max(1, self.__conf.async_sms_max_in_flight))
+        await asyncio.gather(*[self.__send_loop(message_body, jobs, start, results) for n in range(senders)])
+        return {phone: results[phone] for phone in phones}
+
+    async def __send_loop(self, message_body, jobs, start, results):
+        loop = asyncio.get_running_loop()
+        for to_phone, wait in jobs:
+            delay = start + wait - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                results[to_phone] = await self.__td.dispatch(message_body, to_phone)
+            except Exception as e:
+                logging.error(f"AsyncSMSBroadcaster: __send_loop: An unknown exception occured sending to {to_phone}")
+                logging.error(e)
+                results[to_phone] = False
@@ -0,0 +1,127 @@
+import asyncio, contextvars, importlib, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import ConfigProvider
+from storage import get_backend
+
+class AsyncStorageBackend():
+
+    native_logs = False
+
+    def __init__(self):
+        """
+        Interface of the storage backends used by the async server (see asgi.py). Same paths, merge rules and return values as
+        storage.StorageBackend, but every method is a coroutine. Only the writes and reads the request handlers need are here.
+
+        Functions:\n
+        -- -- -- -- -- --
+        write_doc(): Write (merge) a document
+        write_docs(): Write (merge) many documents
+        read_doc(): Read a document
+        log_client_pings(): Upsert rows into the ping log (native_logs backends only)
+        log_sms_rows(): Insert rows into the SMS log (native_logs backends only)
+        """
+
+    async def write_doc(self, path, write_dict):
+        raise NotImplementedError
+
+    async def write_docs(self, items):
+        raise NotImplementedError
+
+    async def read_doc(self, path):
+        raise NotImplementedError
+
+    async def log_client_pings(self, rows):
+        raise NotImplementedError
+
+    async def log_sms_rows(self, rows):
+        raise NotImplementedError
+
+class ThreadedStorageBackend(AsyncStorageBackend):
+
+    def __init__(self, backend):
+        """
+        Async front for a synchronous storage backend. Calls to a blocking backend run on the process-wide pool of
+        async_storage_threads threads so they never stall the event loop; calls to a non-blocking one (ex: MemoryIO) run inline.
+
+        :param backend: storage.StorageBackend instance
+        """
+        self.__backend = backend
+        self.native_logs = backend.native_logs
+        self.__executor = _storage_executor() if backend.blocking else None
+
+    async def write_doc(self, path, write_dict):
+        return await self.__run(self.__backend.write_doc, path, write_dict)
+
+    async def write_docs(self, items):
+        return await self.__run(self.__backend.write_docs, items)
+
+    async def read_doc(self, path):
+        return await self.__run(self.__backend.read_doc, path)
+
+    async def log_client_pings(self, rows):
+        return await self.__run(self.__backend.log_client_pings, rows)
+
+    async def log_sms_rows(self, rows):
+        return await self.__run(self.__backend.log_sms_rows, rows)
+
+    async def __run(self, func, *args):
+        if self.__executor is None:
+            return func(*args)
+        # Run in a copy of the current context so the backend's spans land under the caller's span
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, context.run, func, *args)
+
+_ASYNC_BACKENDS = {}
+_REGISTRY_LOCK = threading.Lock()
+_EXECUTOR = None
+
+# Modules of the built-in async backends, imported when their backend is first asked for. Only the async server asks, so the
+# WSGI server never loads the async Firestore client
+BUILTIN_ASYNC_BACKEND_MODULES = {
+    "firestore": "async_fsio"
+}
+
+def register_async_backend(name, factory):
+    """
+    Register a native async storage backend for database_type name. Backends without one are served through ThreadedStorageBackend
+
+    :param str name: database_type value that selects the backend
+    :param factory: Callable returning an AsyncStorageBackend. Called on every get_async_backend()
+    """
+    with _REGISTRY_LOCK:
+        if name in _ASYNC_BACKENDS:
+            logging.warning(f"async_storage: register_async_backend: Replacing async storage backend '{name}'")
+        _ASYNC_BACKENDS[name] = factory
+
+def get_async_backend(name=None):
+    """
+    Get an async storage backend instance: the native async backend registered under name if there is one, otherwise the
+    synchronous backend wrapped in a ThreadedStorageBackend
+
+    :param str name: Backend name. Defaults to database_type from the config
+
+    :returns: AsyncStorageBackend instance, or None if no backend is registered under that name
+    """
+    if name is None:
+        name = ConfigProvider().database_type
+    if name not in _ASYNC_BACKENDS and name in BUILTIN_ASYNC_BACKEND_MODULES:
+        try:
+            importlib.import_module(BUILTIN_ASYNC_BACKEND_MODULES[name])
+        except Exception as e:
+            logging.error(f"async_storage: get_async_backend: Unable to import async storage backend module '{BUILTIN_ASYNC_BACKEND_MODULES[name]}'")
+            logging.error(e)
+    factory = _ASYNC_BACKENDS.get(name)
+    if factory is not None:
+        return factory()
+    backend = get_backend(name)
+    if backend is None:
+        return None
+    return ThreadedStorageBackend(backend)
+
+def _storage_executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _REGISTRY_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(max_workers=max(1, ConfigProvider().async_storage_threads), thread_name_prefix="AsyncStorage")
+    return _EXECUTOR
@@ -1,21 +1,91 @@
-from firebase_admin import firestore, credentials
-import firebase_admin
-from twilio.rest import Client
 from utils import ConfigProvider, Singleton
-import logging
-import sqlite3
+from sqlite_pool import SQLitePool
+import logging, os, threading, time
 
 class AuthHolder(metaclass=Singleton):
 
     def __init__(self):
         """
         Holds API objects as a singleton so that we don't try to create them over and over again (this would cause issues with firestore, for instance.)
+
+        Each client is made the first time it is used, so importing the server doesn't load firebase_admin or twilio, and a process only
+        opens the clients it needs. Clients belong to the process that made them: gRPC channels, pooled HTTP connections and sqlite3
+        connections don't survive a fork, so a forked child (ex: a gunicorn worker of a --preload master) makes its own on first use.
+
+        Properties:\n
+        -- -- -- -- -- --
+        firestore: Firestore Client(), or None
+        twilio: Twilio Client(), or None
+        sqlite_pool: SQLitePool, or None
+        firestore_async: Firestore AsyncClient() for the async server, or None. Bound to the event loop that first uses it
+        twilio_async: Twilio Client() with an async HTTP client for the async server, or None. Bound to the event loop that first uses it
         """
         self.__conf = ConfigProvider()
-        self.firestore = self.__firestore_authenticator()
-        self.twilio = self.__twilio_authenticator()
-        self.sqlite_connection = self.__sqlite_connector()
-        self.sqlite_cursor = self.__sqlite_cursor()
+        self.__lock = threading.Lock()
+        self.__clients = {}
+        # Clients inherited over a fork. Kept referenced so they are never closed from the child, which could break them in the parent
+        self.__inherited = []
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__after_fork)
+
+    @property
+    def firestore(self):
+        return self.__get_client("firestore", self.__firestore_authenticator)
+
+    @property
+    def twilio(self):
+        return self.__get_client("twilio", self.__twilio_authenticator)
+
+    @property
+    def sqlite_pool(self):
+        return self.__get_client("sqlite_pool", self.__sqlite_pool_creator)
+
+    @property
+    def firestore_async(self):
+        return self.__get_client("firestore_async", self.__firestore_async_authenticator)
+
+    @property
+    def twilio_async(self):
+        return self.__get_client("twilio_async", self.__twilio_async_authenticator)
+
+    def __get_client(self, name, create):
+        """
+        Get a client, creating it on first use. Failures are remembered too, so a bad config is only logged once per process
+
+        :param str name: Client name
+        :param create: Method that creates the client
+
+        :returns: The client, or None if it couldn't be created
+        """
+        clients = self.__clients
+        if name in clients:
+            return clients[name]
+        with self.__lock:
+            if name not in self.__clients:
+                start = time.perf_counter()
+                self.__clients[name] = create()
+                logging.debug(f"AuthHolder: __get_client: Created {name} client in {(time.perf_counter() - start) * 1000:.1f}ms (pid {os.getpid()})")
+            return self.__clients[name]
+
+    async def close_async_clients(self):
+        """
+        Close and forget the clients bound to the running event loop, so the next loop makes its own. Called by the async server on shutdown
+        """
+        with self.__lock:
+            twilio = self.__clients.pop("twilio_async", None)
+            self.__clients.pop("firestore_async", None)
+        if twilio is not None:
+            try:
+                await twilio.http_client.close()
+            except Exception as e:
+                logging.error("AuthHolder: close_async_clients: Unable to close the async Twilio client")
+                logging.error(e)
+
+    def __after_fork(self):
+        if len(self.__clients) > 0:
+            self.__inherited.append(self.__clients)
+        self.__clients = {}
+        self.__lock = threading.Lock()
 
     def __firestore_authenticator(self):
         """
@@ -25,12 +95,13 @@ class AuthHolder(metaclass=Singleton):
         """
         if self.__conf.database_type == "firestore":
             try:
+                from firebase_admin import credentials
+                from google.cloud import firestore
                 # Initialize key file
                 key = credentials.Certificate(self.__conf.firestore_key_filepath)
-                # Initialize the app
-                firebase_admin.initialize_app(key)
-                # Create and return the client object
-                return firestore.client()
+                # Create and return the client object. Made directly rather than through firebase_admin.initialize_app(), which
+                # can only run once per process and would hand a forked child the parent's client
+                return firestore.Client(project=key.project_id, credentials=key.get_credential())
             except Exception as e:
                 logging.error("An unknown exception occured trying to authneticate Google Firestore! Check your config.yml")
                 logging.error(e)
@@ -38,6 +109,25 @@ class AuthHolder(metaclass=Singleton):
         else:
             return None
 
+    def __firestore_async_authenticator(self):
+        """
+        Create a firestore AsyncClient object
+
+        :returns: Firestore AsyncClient() if successful, else returns None if an Exception occurred or if Firestore was not selected as the database type
+        """
+        if self.__conf.database_type == "firestore":
+            try:
+                from firebase_admin import credentials
+                from google.cloud import firestore
+                key = credentials.Certificate(self.__conf.firestore_key_filepath)
+                return firestore.AsyncClient(project=key.project_id, credentials=key.get_credential())
+            except Exception as e:
+                logging.error("An unknown exception occured trying to authneticate Google Firestore (async)! Check your config.yml")
+                logging.error(e)
+                return None
+        else:
+            return None
+
     def __twilio_authenticator(self):
         """
         Create a twilio auth object
@@ -45,50 +135,49 @@ class AuthHolder(metaclass=Singleton):
         :returns: Twilio auth object if successful, else returns None if an Exception occurred
         """
         try:
-            client = Client(self.__conf.twilio_acc_sid, self.__conf.twilio_auth_token)
+            from twilio.rest import Client
+            from twilio_transport import make_twilio_http_client
+            client = Client(self.__conf.twilio_acc_sid, self.__conf.twilio_auth_token, http_client=make_twilio_http_client())
             return client
         except Exception as e:
             logging.error("An unknown exception occured trying to authenticate twilio! Check your config.yml")
             logging.error(e)
             return None
 
-    def __sqlite_connector(self):
+    def __twilio_async_authenticator(self):
         """
-        Create connection object and cursor object for sqlite3 local database
+        Create a twilio auth object whose API calls have *_async() versions
 
-        :returns: Connector object if enabled in config, otherwise null
+        :returns: Twilio auth object if successful, else returns None if an Exception occurred
         """
-        if self.__conf.database_type == "sqlite_local":
-            try:
-                con = sqlite3.connect(self.__conf.sqlite_local_filepath)
-                return con
-            except Exception as e:
-                if self.__conf.database_type == "sqlite_local":
-                    logging.error("An unknown exception occured trying to create a connection to sqlite3 database. Check your config!")
-                    logging.error(e)
-                    return None
-                else:
-                    logging.debug("sqlite_local was not selected in config. __sqlite_connector will return None")
-                    return None
-        else:
+        try:
+            from twilio.rest import Client
+            from async_sms import make_async_twilio_http_client
+            return Client(self.__conf.twilio_acc_sid, self.__conf.twilio_auth_token, http_client=make_async_twilio_http_client())
+        except Exception as e:
+            logging.error("An unknown exception occured trying to authenticate twilio (async)! Check your config.yml")
+            logging.error(e)
             return None
 
-    def __sqlite_cursor(self):
+    def __sqlite_pool_creator(self):
         """
-        Create sqlite3 Cursor object and return it for sqlite3 local database
+        Create the sqlite3 connection pool for the local database. Connections are opened lazily by the pool
 
-        :returns: Cursor object if enabled in config, otherwise null
+        :returns: SQLitePool if enabled in config, otherwise None
         """
-        if self.__conf.database_type == "sqlite_local" and self.sqlite_connection is not None:
+        if self.__conf.database_type == "sqlite_local":
             try:
-                cur = self.sqlite_connection.cursor()
-                return cur
+                return SQLitePool(self.__conf.sqlite_local_filepath,
+                                  max_readers=self.__conf.sqlite_pool_size,
+                                  busy_timeout_ms=self.__conf.sqlite_busy_timeout_ms,
+                                  cache_size_kib=self.__conf.sqlite_cache_size_kib,
+                                  mmap_size=self.__conf.sqlite_mmap_size,
+                                  synchronous=self.__conf.sqlite_synchronous,
+                                  acquire_timeout=self.__conf.sqlite_pool_timeout)
             except Exception as e:
-                if self.__conf.database_type == "sqlite_local":
-                    logging.error("An unknown exception occured trying to create a Cursor object for sqlite3 database. Check your config!")
-                    logging.error(e)
-                    return None
-                else:
-                    logging.debug("sqlite_local was not selected in config. __sqlite_cursor will return None")
-                    return None
-
+                logging.error("An unknown exception occured trying to create the sqlite3 connection pool. Check your config!")
+                logging.error(e)
+                return None
+        else:
+            logging.debug("sqlite_local was not selected in config. __sqlite_pool_creator will return None")
+            return None
@@ -0,0 +1,459 @@
+"""
+Load and latency benchmark for the API endpoints.
+
+Drives server.app (WSGI, one thread per client) or with --mode asgi asgi.app (one task per client on one event loop) in-process
+with many concurrent synthetic clients. Firestore is replaced by an in-memory storage backend and Twilio by a local HTTP stand-in,
+both with configurable injected latency, so runs are reproducible and need no credentials or network.
+Prints (or writes) machine-readable JSON with throughput, p50/p95/p99 latency and per-stage time (validation, storage, sms) per route.
+
+Usage: python benchmarks/api_bench.py --clients 32 --duration 20 --mix ping=0.9,send=0.1 --output bench.json
+       python benchmarks/api_bench.py --baseline bench.json --max-regression 0.15
+       python benchmarks/api_bench.py --mode asgi --clients 1000
+"""
+import argparse, asyncio, contextlib, contextvars, json, logging, os, random, shutil, subprocess, sys, tempfile, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+ROUTES = {
+    "ping": "/api/ping",
+    "send": "/api/send_test_message",
+    "broadcast": "/api/broadcast_message"
+}
+STAGES = ["validation", "storage", "sms"]
+
+# Per-request stage timings. The Flask test client runs the request on the calling thread, so a thread local is enough
+_stage_times = threading.local()
+# Same for --mode asgi: (task running the request, totals)
+_async_stage_times = contextvars.ContextVar("stage_times", default=None)
+
+def record_stage(stage, seconds):
+    totals = getattr(_stage_times, "totals", None)
+    if totals is not None:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+def record_stage_async(stage, seconds):
+    current = _async_stage_times.get()
+    # Broadcast sends run in tasks of their own. Only the request's task counts, like the broadcast threads in WSGI mode
+    if current is not None and current[0] is asyncio.current_task():
+        current[1][stage] = current[1].get(stage, 0.0) + seconds
+
+def timed_async(stage, func):
+    """
+    timed() for coroutine functions
+    """
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            record_stage_async(stage, time.perf_counter() - start)
+    return wrapper
+
+def timed(stage, func):
+    """
+    Wrap func so its run time is added to the current request's stage total
+    """
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_stage(stage, time.perf_counter() - start)
+    return wrapper
+
+def sleep_latency(mean_ms, jitter):
+    if mean_ms > 0:
+        time.sleep(max(0.0, random.gauss(mean_ms, mean_ms * jitter)) / 1000)
+
+class TwilioStandIn(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency_ms, jitter, failure_rate):
+        """
+        Local HTTP stand-in for the Twilio Messages API. Answers every POST with a queued message after the injected latency
+        """
+        super().__init__(("127.0.0.1", 0), TwilioStandInHandler)
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+class TwilioStandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        sleep_latency(self.server.latency_ms, self.server.jitter)
+        if random.random() < self.server.failure_rate:
+            status, body = 500, {"code": 20500, "message": "Stand-in failure", "status": 500}
+        else:
+            status, body = 201, {"sid": "SM" + os.urandom(16).hex(), "status": "queued"}
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def write_bench_config(work_dir, args, twilio_url):
+    """
+    Write config.yml and info.yml for the run into work_dir, based on config.yml.TEMPLATE
+    """
+    import yaml
+    with open(os.path.join(REPO_DIR, "config.yml.TEMPLATE")) as f:
+        conf = yaml.load(f, Loader=yaml.FullLoader)
+    conf.update({
+        "test_mode": True,
+        "database_type": "bench_memory",
+        "sqlite_local_filepath": os.path.join(work_dir, "bench.db"),
+        "twilio_acc_sid": "ACbenchmark",
+        "twilio_auth_token": "benchmark",
+        "twilio_from_phone": "+15550000000",
+        "twilio_transport": "pooled",
+        "twilio_max_retries": 0,
+        "twilio_pool_size": max(args.clients, 8) * 2,
+        "async_sms_max_in_flight": max(args.clients, 8) * 2,
+        "twilio_api_base_url": twilio_url,
+        "sms_broadcast_rate": 0,
+        "console_log_level": "warning",
+        "logfile_log_level": "warning",
+        "logfile_name": os.path.join(work_dir, "bench")
+    })
+    for override in args.set:
+        key, value = override.split("=", 1)
+        conf[key] = yaml.load(value, Loader=yaml.FullLoader)
+    with open(os.path.join(work_dir, "config.yml"), "w") as f:
+        yaml.dump(conf, f)
+    shutil.copy(os.path.join(REPO_DIR, "info.yml"), os.path.join(work_dir, "info.yml"))
+
+def install_stand_ins(args):
+    """
+    Register the latency-injecting storage backend and wrap the stages we time. Must run before server is imported
+    """
+    from storage import register_backend
+    from memio import MemoryIO
+    import utils, sms_utils
+
+    class LatencyMemoryIO(MemoryIO):
+        """
+        MemoryIO with injected per-operation latency, standing in for Firestore
+        """
+        def write_doc(self, path, write_dict):
+            sleep_latency(args.storage_latency_ms, args.jitter)
+            return super().write_doc(path, write_dict)
+
+        def write_docs(self, items):
+            sleep_latency(args.storage_latency_ms, args.jitter)
+            return MemoryIO.write_docs(self, items)
+
+        def read_doc(self, path):
+            sleep_latency(args.storage_latency_ms, args.jitter)
+            return super().read_doc(path)
+
+    for name in ["write_doc", "write_docs", "read_doc"]:
+        setattr(LatencyMemoryIO, name, timed("storage", getattr(LatencyMemoryIO, name)))
+    register_backend("bench_memory", LatencyMemoryIO)
+    if args.mode == "asgi":
+        install_async_stand_ins(args)
+        return
+    utils.RequestUtils.combined_key_value_checks = timed("validation", utils.RequestUtils.combined_key_value_checks)
+    # Broadcast sends run on the broadcaster's threads, so time the whole fan-out on the request thread instead
+    sms_utils.TwilioDispatcher.dispatch = timed("sms", sms_utils.TwilioDispatcher.dispatch)
+    sms_utils.SMSBroadcaster.broadcast = timed("sms", sms_utils.SMSBroadcaster.broadcast)
+
+def install_async_stand_ins(args):
+    """
+    --mode asgi: register a latency-injecting async storage backend that waits with asyncio.sleep(), and wrap the stages we time
+    """
+    from async_storage import AsyncStorageBackend, register_async_backend
+    from memio import MemoryIO
+    import utils, async_sms
+
+    async def sleep_latency_async(mean_ms, jitter):
+        if mean_ms > 0:
+            await asyncio.sleep(max(0.0, random.gauss(mean_ms, mean_ms * jitter)) / 1000)
+
+    class AsyncLatencyMemoryIO(AsyncStorageBackend):
+        """
+        MemoryIO behind an async interface with injected per-operation latency, standing in for Firestore's AsyncClient
+        """
+        def __init__(self):
+            self.__db = MemoryIO()
+
+        async def write_doc(self, path, write_dict):
+            await sleep_latency_async(args.storage_latency_ms, args.jitter)
+            return self.__db.write_doc(path, write_dict)
+
+        async def write_docs(self, items):
+            await sleep_latency_async(args.storage_latency_ms, args.jitter)
+            return self.__db.write_docs(items)
+
+        async def read_doc(self, path):
+            await sleep_latency_async(args.storage_latency_ms, args.jitter)
+            return self.__db.read_doc(path)
+
+    for name in ["write_doc", "write_docs", "read_doc"]:
+        setattr(AsyncLatencyMemoryIO, name, timed_async("storage", getattr(AsyncLatencyMemoryIO, name)))
+    register_async_backend("bench_memory", AsyncLatencyMemoryIO)
+    combined_key_value_checks = utils.RequestUtils.combined_key_value_checks
+
+    def validation(self, mandatory_keys, request):
+        start = time.perf_counter()
+        try:
+            return combined_key_value_checks(self, mandatory_keys, request)
+        finally:
+            record_stage_async("validation", time.perf_counter() - start)
+    utils.RequestUtils.combined_key_value_checks = validation
+    async_sms.AsyncTwilioDispatcher.dispatch = timed_async("sms", async_sms.AsyncTwilioDispatcher.dispatch)
+    async_sms.AsyncSMSBroadcaster.broadcast = timed_async("sms", async_sms.AsyncSMSBroadcaster.broadcast)
+
+def make_payload(kind, client_n, args):
+    client_id = f"bench-client-{client_n}"
+    if kind == "ping":
+        return {"Client ID": client_id, "Software Version": "1.0.0"}
+    elif kind == "send":
+        return {"Client ID": client_id, "SMS Body": "Benchmark message", "Phone": f"+1555{client_n:07d}"}
+    return {"Client ID": client_id, "SMS Body": "Benchmark broadcast", "Phones": [f"+1556{client_n:03d}{n:04d}" for n in range(args.broadcast_size)]}
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        kind, weight = part.split("=")
+        if kind not in ROUTES:
+            raise ValueError(f"Unknown route '{kind}' in --mix. Valid routes: {list(ROUTES)}")
+        weights[kind] = float(weight)
+    return weights
+
+def client_loop(app, client_n, args, weights, deadline, samples):
+    """
+    One synthetic client. Sends requests back to back, or paced to its share of --rate
+    """
+    rng = random.Random(args.seed + client_n)
+    client = app.test_client()
+    kinds = list(weights.keys())
+    cum_weights = []
+    total = 0.0
+    for kind in kinds:
+        total += weights[kind]
+        cum_weights.append(total)
+    interval = args.clients / args.rate if args.rate > 0 else 0.0
+    next_send = time.perf_counter() + rng.uniform(0, interval)
+    while time.perf_counter() < deadline:
+        if interval > 0:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+        kind = rng.choices(kinds, cum_weights=cum_weights)[0]
+        _stage_times.totals = {}
+        start = time.perf_counter()
+        try:
+            res = client.post(ROUTES[kind], json=make_payload(kind, client_n, args))
+            status = res.status_code
+        except Exception:
+            status = 0
+        latency = time.perf_counter() - start
+        samples.append((kind, status, latency, _stage_times.totals))
+        _stage_times.totals = None
+
+async def call_asgi(app, method, path, body):
+    """
+    Run one request through an ASGI app
+
+    :returns int: Response status code
+    """
+    messages = [{"type": "http.request", "body": json.dumps(body).encode("utf-8"), "more_body": False}]
+    sent = []
+
+    async def receive():
+        if len(messages) > 0:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [(b"content-type", b"application/json")], "client": ("127.0.0.1", 0)}
+    await app(scope, receive, send)
+    return sent[0]["status"]
+
+async def async_client_loop(app, client_n, args, weights, deadline, samples):
+    """
+    One synthetic client for --mode asgi. Same request mix and pacing as client_loop()
+    """
+    rng = random.Random(args.seed + client_n)
+    kinds = list(weights.keys())
+    cum_weights = []
+    total = 0.0
+    for kind in kinds:
+        total += weights[kind]
+        cum_weights.append(total)
+    interval = args.clients / args.rate if args.rate > 0 else 0.0
+    next_send = time.perf_counter() + rng.uniform(0, interval)
+    while time.perf_counter() < deadline:
+        if interval > 0:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_send += interval
+        kind = rng.choices(kinds, cum_weights=cum_weights)[0]
+        totals = {}
+        _async_stage_times.set((asyncio.current_task(), totals))
+        start = time.perf_counter()
+        try:
+            status = await call_asgi(app, "POST", ROUTES[kind], make_payload(kind, client_n, args))
+        except Exception:
+            status = 0
+        latency = time.perf_counter() - start
+        samples.append((kind, status, latency, totals))
+
+async def run_async_clients(app, args, weights, deadline, samples):
+    from auth import AuthHolder
+    await asyncio.gather(*[async_client_loop(app, n, args, weights, deadline, samples) for n in range(args.clients)])
+    await AuthHolder().close_async_clients()
+
+def percentile(sorted_values, pct):
+    if len(sorted_values) == 0:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def summarize(samples, elapsed):
+    """
+    :returns dict: Per-route and overall throughput, latency percentiles and stage times, all in milliseconds
+    """
+    def stats(group):
+        latencies = sorted(s[2] * 1000 for s in group)
+        errors = sum(1 for s in group if s[1] == 0 or s[1] >= 400)
+        stages = {}
+        for stage in STAGES:
+            values = sorted(s[3].get(stage, 0.0) * 1000 for s in group)
+            stages[stage] = {
+                "mean": round(sum(values) / len(values), 3) if values else None,
+                "p95": round(percentile(values, 95), 3) if values else None
+            }
+        return {
+            "requests": len(group),
+            "errors": errors,
+            "throughput_rps": round(len(group) / elapsed, 2) if elapsed > 0 else None,
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p50": round(percentile(latencies, 50), 3) if latencies else None,
+                "p95": round(percentile(latencies, 95), 3) if latencies else None,
+                "p99": round(percentile(latencies, 99), 3) if latencies else None,
+                "max": round(latencies[-1], 3) if latencies else None
+            },
+            "stages_ms": stages
+        }
+    routes = {}
+    for kind in ROUTES:
+        group = [s for s in samples if s[0] == kind]
+        if len(group) > 0:
+            routes[kind] = stats(group)
+    return {"overall": stats(samples), "routes": routes}
+
+def compare(results, baseline, max_regression):
+    """
+    Compare p95 latency and throughput per route against a baseline run
+
+    :returns list: Human readable regressions. Empty if none
+    """
+    regressions = []
+    for route, current in results["results"]["routes"].items():
+        before = baseline.get("results", {}).get("routes", {}).get(route)
+        if before is None:
+            continue
+        if before["latency_ms"]["p95"] and current["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + max_regression):
+            regressions.append(f"{route}: p95 {before['latency_ms']['p95']}ms -> {current['latency_ms']['p95']}ms")
+        if before["throughput_rps"] and current["throughput_rps"] < before["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{route}: throughput {before['throughput_rps']}rps -> {current['throughput_rps']}rps")
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the API endpoints")
+    parser.add_argument("--mode", choices=["wsgi", "asgi"], default="wsgi", help="Serve with the Flask app (a thread per client) or the ASGI app (a task per client)")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent synthetic clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run")
+    parser.add_argument("--rate", type=float, default=0.0, help="Total requests/second across all clients. 0 sends as fast as possible")
+    parser.add_argument("--mix", default="ping=0.9,send=0.1", help="Route weights, ex: ping=0.8,send=0.15,broadcast=0.05")
+    parser.add_argument("--broadcast-size", type=int, default=10, help="Recipients per broadcast request")
+    parser.add_argument("--storage-latency-ms", type=float, default=20.0, help="Mean injected latency per storage operation")
+    parser.add_argument("--sms-latency-ms", type=float, default=150.0, help="Mean injected latency of the Twilio stand-in")
+    parser.add_argument("--sms-failure-rate", type=float, default=0.0, help="Fraction of Twilio stand-in sends that fail")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency standard deviation as a fraction of the mean")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the payload mix")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a config.yml value, ex: --set write_behind_enabled=true")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="Allowed fractional p95/throughput regression against --baseline")
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    twilio = TwilioStandIn(args.sms_latency_ms, args.jitter, args.sms_failure_rate)
+    threading.Thread(target=twilio.serve_forever, daemon=True).start()
+    work_dir = tempfile.mkdtemp(prefix="api_bench_")
+    write_bench_config(work_dir, args, f"http://127.0.0.1:{twilio.server_port}")
+    os.chdir(work_dir)
+    # Keeps the logging module-level helpers from installing a stderr basicConfig handler before the server sets up logging
+    logging.getLogger().addHandler(logging.NullHandler())
+    install_stand_ins(args)
+    # The startup banner and console log go to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import server
+        if args.mode == "asgi":
+            import asgi
+    for name in ["twilio", "urllib3"]:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    samples = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    if args.mode == "asgi":
+        asyncio.run(run_async_clients(asgi.app, args, weights, deadline, samples))
+    else:
+        threads = [threading.Thread(target=client_loop, args=(server.app, n, args, weights, deadline, samples), daemon=True) for n in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - start
+    twilio.shutdown()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k not in ["output", "baseline"]},
+        "elapsed_s": round(elapsed, 3),
+        "results": summarize(samples, elapsed)
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        results["regressions"] = regressions
+        exit_code = 1 if len(regressions) > 0 else 0
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Cold start benchmark.
+
+Starts a fresh interpreter per run, like a new gunicorn worker, and times importing the server, the first and second /api/ping
+and the first use of the Twilio client. Also reports which heavy client libraries had been loaded after the import and after the
+first request. Storage is the in-memory backend and Twilio is never contacted, so runs need no credentials or network.
+
+Usage: python benchmarks/cold_start.py --runs 5
+       python benchmarks/cold_start.py --repo /path/to/other/checkout --set database_type=sqlite_local
+"""
+import argparse, json, os, shutil, statistics, subprocess, sys, tempfile, time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["firebase_admin", "google.cloud.firestore", "google.cloud.firestore_v1", "grpc", "twilio.rest"]
+
+# Runs in the fresh interpreter, from the work dir holding config.yml
+CHILD_SCRIPT = """
+import contextlib, json, logging, sys, time
+sys.path.insert(0, sys.argv[1])
+heavy = sys.argv[2].split(",")
+logging.getLogger().addHandler(logging.NullHandler())
+start = time.perf_counter()
+with contextlib.redirect_stdout(sys.stderr):
+    import server
+imported = time.perf_counter()
+loaded_after_import = [m for m in heavy if m in sys.modules]
+client = server.app.test_client()
+body = {"Client ID": "cold-start", "Software Version": "1.0.0"}
+timings = []
+for n in range(2):
+    t = time.perf_counter()
+    res = client.post("/api/ping", json=body)
+    timings.append(time.perf_counter() - t)
+    assert res.status_code == 200, res.data
+loaded_after_request = [m for m in heavy if m in sys.modules]
+from auth import AuthHolder
+t = time.perf_counter()
+AuthHolder().twilio
+twilio = time.perf_counter() - t
+print(json.dumps({
+    "import_server_ms": (imported - start) * 1000,
+    "first_request_ms": timings[0] * 1000,
+    "second_request_ms": timings[1] * 1000,
+    "first_twilio_client_ms": twilio * 1000,
+    "loaded_after_import": loaded_after_import,
+    "loaded_after_first_request": loaded_after_request
+}))
+"""
+
+def write_config(work_dir, repo_dir, overrides):
+    """
+    Write config.yml and info.yml for the run into work_dir, based on config.yml.TEMPLATE
+    """
+    import yaml
+    with open(os.path.join(repo_dir, "config.yml.TEMPLATE")) as f:
+        conf = yaml.load(f, Loader=yaml.FullLoader)
+    conf.update({
+        "test_mode": True,
+        "database_type": "memory",
+        "sqlite_local_filepath": os.path.join(work_dir, "cold_start.db"),
+        "twilio_acc_sid": "ACcoldstart",
+        "twilio_auth_token": "coldstart",
+        "twilio_from_phone": "+15550000000",
+        "console_log_level": "warning",
+        "logfile_log_level": "warning",
+        "logfile_name": os.path.join(work_dir, "cold_start")
+    })
+    for override in overrides:
+        key, value = override.split("=", 1)
+        conf[key] = yaml.load(value, Loader=yaml.FullLoader)
+    with open(os.path.join(work_dir, "config.yml"), "w") as f:
+        yaml.dump(conf, f)
+    shutil.copy(os.path.join(repo_dir, "info.yml"), os.path.join(work_dir, "info.yml"))
+
+def run_once(work_dir, repo_dir):
+    """
+    :returns dict: Timings of one fresh interpreter, plus its total wall time including interpreter startup
+    """
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", CHILD_SCRIPT, repo_dir, ",".join(HEAVY_MODULES)], cwd=work_dir,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    result = json.loads(out.stdout.decode().strip().splitlines()[-1])
+    result["process_total_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start and first-request latency of a fresh server process")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to start")
+    parser.add_argument("--repo", default=REPO_DIR, help="Checkout to measure. Defaults to this one")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a config.yml value, ex: --set database_type=sqlite_local")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    args = parser.parse_args()
+    repo_dir = os.path.abspath(args.repo)
+
+    work_dir = tempfile.mkdtemp(prefix="cold_start_")
+    try:
+        write_config(work_dir, repo_dir, args.set)
+        runs = [run_once(work_dir, repo_dir) for n in range(max(1, args.runs))]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = {}
+    for key in ["process_total_ms", "import_server_ms", "first_request_ms", "second_request_ms", "first_twilio_client_ms"]:
+        values = sorted(run[key] for run in runs)
+        summary[key] = {"median": round(statistics.median(values), 2), "min": round(values[0], 2), "max": round(values[-1], 2)}
+    results = {
+        "repo": repo_dir,
+        "python": sys.version.split()[0],
+        "runs": len(runs),
+        "overrides": args.set,
+        "results": summary,
+        "loaded_after_import": runs[-1]["loaded_after_import"],
+        "loaded_after_first_request": runs[-1]["loaded_after_first_request"]
+    }
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+from utils import ConfigProvider, get_timestamp
+from loggingutils import LoggingUtils, setup_logging
+from metrics import Metrics
+from tracing import Tracer
+from retention import LogRetention
+
+_INITIALIZED = False
+
+def init_logger():
+    """
+    Set up console and file logging from the config
+
+    :returns: 1 if logging couldn't be set up, otherwise None
+    """
+    config = ConfigProvider()
+    server_start_time = get_timestamp()
+    try:
+        server_logfile_name = f"{config.logfile_name}_{server_start_time}"
+    except:
+        server_logfile_name = f"demo_app_server_{server_start_time}"
+    if (not setup_logging(console_log_output="stdout", console_log_level=config.console_log_level, console_log_color=config.console_log_color,
+                        logfile_file=server_logfile_name + ".log", logfile_log_level=config.logfile_log_level, logfile_log_color=config.logfile_log_color,
+                        log_line_template=f"%(color_on)s[%(asctime)s] [%(threadName)s] {'[%(trace_id)s] ' if config.tracing_enabled else ''}[%(levelname)-8s] %(message)s%(color_off)s",
+                        queue_enabled=config.log_queue_enabled, queue_size=config.log_queue_size, queue_overflow=config.log_queue_overflow,
+                        queue_sample_rate=config.log_queue_sample_rate, logfile_per_process=config.logfile_per_process, log_format=config.log_format,
+                        sample_rates=config.log_sample_rates, trace_ids=config.tracing_enabled)):
+        print("Failed to setup logging, aborting.")
+        return 1
+
+def init_process():
+    """
+    Process setup shared by the WSGI app (server.py) and the ASGI app (asgi.py): the startup message, logging, metrics, tracing
+    and the log retention timer. Only the first call does anything.
+
+    Firestore, Twilio and sqlite clients aren't made here. AuthHolder makes them on first use, in the process using them
+    """
+    global _INITIALIZED
+    if _INITIALIZED:
+        return
+    _INITIALIZED = True
+    config = ConfigProvider()
+    LoggingUtils().print_startup_message()
+    init_logger()
+    if config.metrics_enabled is True:
+        Metrics()
+    if config.tracing_enabled is True:
+        Tracer()
+    if config.log_retention_enabled is True:
+        LogRetention().start()
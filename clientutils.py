@@ -1,35 +1,75 @@
-import logging
+import logging, threading
 from utils import *
-from fsio import FirestoreIO
+from storage import get_backend
+from async_storage import get_async_backend
+from writebuffer import WriteBehindBuffer
+from pingcoalescer import PingCoalescer
+from logshards import LogShardLayout
+from instrumentation import instrument
 
 class ClientUtils:
 
+    PING_LOG_PATH = "/Logging/Last Ping Log"
+    SMS_LOG_PATH = "/Logging/SMS Log"
+
     def __init__(self):
         """
-        Helper class full of random methods useful for wrangling/logging client data
+        Helper class full of random methods useful for wrangling/logging client data.
+        Talks to whichever storage backend is registered under database_type (see storage.get_backend()). The backend is looked up
+        on first use, so importing the server doesn't load its client library (ex: Firestore's, with gRPC) in a --preload master.
         """
-        self.__FIRESTORE_PING_LOG_PATH = "/Logging/Last Ping Log"
-        self.__SMS_LOG_PATH = "/Logging/SMS Log"
         self.__conf = ConfigProvider()
-        if self.__conf.database_type == "firestore":
-            self.__fsio = FirestoreIO()
-        else:
-            self.__fsio = None
+        self.__ping_layout = LogShardLayout(self.PING_LOG_PATH)
+        self.__sms_layout = LogShardLayout(self.SMS_LOG_PATH)
+        self.__resolved = None
+        self.__resolve_lock = threading.Lock()
+
+    @property
+    def __db(self):
+        return self.__resolve()[0]
 
+    @property
+    def __write_buffer(self):
+        return self.__resolve()[1]
+
+    @property
+    def __ping_coalescer(self):
+        return self.__resolve()[2]
+
+    def __resolve(self):
+        """
+        Look up the storage backend, and make the write-behind buffer and ping coalescer that go with it, the first time any is needed
+
+        :returns tuple: (backend or None, WriteBehindBuffer or None, PingCoalescer or None)
+        """
+        if self.__resolved is None:
+            with self.__resolve_lock:
+                if self.__resolved is None:
+                    db = get_backend(self.__conf.database_type)
+                    write_buffer, ping_coalescer = None, None
+                    if db is not None and db.native_logs is False and self.__conf.write_behind_enabled is True:
+                        write_buffer = WriteBehindBuffer()
+                    if db is not None and self.__conf.ping_coalesce_enabled is True:
+                        ping_coalescer = PingCoalescer(self.__write_ping)
+                    self.__resolved = (db, write_buffer, ping_coalescer)
+        return self.__resolved
 
     def log_client_ping(self, timestamp, client_id, client_ip, client_version):
         """
-        Log the IP and timestamp by client ID
+        Log the IP and timestamp by client ID. With ping_coalesce_enabled the ping is held for up to ping_coalesce_window seconds
+        and only the newest ping per client is written.
 
         :param str timestamp: Timestamp
         :param str client_id: Client Identifier
         :param str client_ip: Client IP Address
         :param str client_version: Client software version number
         """
-        if self.__conf.database_type == "firestore":
-            self.__log_client_ping_firestore(timestamp, client_id, client_ip, client_version)
-        else:
+        if self.__db is None:
             logging.error(f"ClientUtils: log_client_ping: database_type {self.__conf.database_type} not currently supported.")
+        elif self.__ping_coalescer is not None:
+            self.__ping_coalescer.submit(client_id, timestamp, client_ip, client_version)
+        else:
+            self.__write_ping(client_id, {"timestamp": timestamp, "last ip": client_ip, "client version": client_version})
 
     def log_sms_sent(self, timestamp, client_id, message_contents, to_phone, success_bool):
         """
@@ -41,49 +81,188 @@ class ClientUtils:
         :param str to_phone: Phone number the message was sent to
         :param bool success_bool: True if you didn't get any errors sending it, False if you did
         """
-        if self.__conf.database_type == "firestore":
-            self.__log_sms_sent_firestore(timestamp, client_id, message_contents, to_phone, success_bool)
-        else:
+        if self.__db is None:
             logging.error(f"ClientUtils: log_sms_sent: database_type {self.__conf.database_type} not currently supported.")
-        
-    def __log_sms_sent_firestore(self, timestamp, client_id, message_contents, to_phone, success_bool):
+        elif self.__db.native_logs is True:
+            self.__log_sms_rows_native(client_id, [(client_id, timestamp, message_contents, to_phone, success_bool)])
+        else:
+            self.__log_sms_sent_doc(timestamp, client_id, {
+                "message_contents": message_contents,
+                "to_phone": to_phone,
+                "success": bool(success_bool)
+            })
+
+    def log_sms_broadcast(self, timestamp, client_id, message_contents, results):
+        """
+        Log a broadcast as a single merge into the SMS log instead of one write per recipient
+
+        :param str timestamp: Timestamp
+        :param str client_id: Client Identifier
+        :param str message_contents: String contents of the message sent
+        :param dict results: Phone -> True if sent, False if an error occurred
+        """
+        if self.__db is None:
+            logging.error(f"ClientUtils: log_sms_broadcast: database_type {self.__conf.database_type} not currently supported.")
+        elif self.__db.native_logs is True:
+            self.__log_sms_rows_native(client_id, [(client_id, timestamp, message_contents, phone, res) for phone, res in results.items()])
+        else:
+            self.__log_sms_sent_doc(timestamp, client_id, {
+                "message_contents": message_contents,
+                "broadcast": True,
+                "recipients": {phone: bool(res) for phone, res in results.items()},
+                "success": all(results.values())
+            })
+
+    def read_ping_log(self):
+        """
+        Read the ping log as one combined dict, whatever backend or log_shard_mode it is stored in
+
+        :returns dict: {"clients": {client_id: {"timestamp": ..., "last ip": ..., "client version": ...}}} or None if an error occured
+        """
+        if self.__db is None:
+            logging.error(f"ClientUtils: read_ping_log: database_type {self.__conf.database_type} not currently supported.")
+            return None
+        elif self.__db.native_logs is True:
+            return self.__db.read_ping_log()
+        return self.__ping_layout.read_combined(self.__db)
+
+    def read_sms_log(self):
+        """
+        Read the SMS log as one combined dict, whatever backend or log_shard_mode it is stored in
+
+        :returns dict: {"clients": {client_id: {timestamp: {...}}}} or None if an error occured
+        """
+        if self.__db is None:
+            logging.error(f"ClientUtils: read_sms_log: database_type {self.__conf.database_type} not currently supported.")
+            return None
+        elif self.__db.native_logs is True:
+            return self.__db.read_sms_log()
+        return self.__sms_layout.read_combined(self.__db)
+
+    def __write_ping(self, client_id, ping_fields):
+        """
+        Write a ping to the storage backend. Also the PingCoalescer sink.
+
+        :param str client_id: Client Identifier
+        :param dict ping_fields: Any of "timestamp", "last ip" and "client version". Only these fields are merged into the client's entry
+
+        :returns bool: True if the write succeeded or was queued
         """
-        Log sms sent firestore
+        if self.__db.native_logs is True:
+            row = (client_id, ping_fields.get("timestamp"), ping_fields.get("last ip"), ping_fields.get("client version"))
+            w_res = self.__db.log_client_pings([row])
+        else:
+            path, part_dict = self.__ping_layout.doc_for_client(client_id, ping_fields)
+            w_res = self.__write_log_doc(path, part_dict)
+        if w_res is not True:
+            logging.error(f"ClientUtils: __write_ping: Error occured trying to log PING from {client_id} v{ping_fields.get('client version')} @ {ping_fields.get('last ip')}")
+            return False
+        return True
+
+    def __log_sms_rows_native(self, client_id, rows):
+        """
+        Log sms sent to a native_logs backend. Every row is written in one call
+
+        :param list rows: List of (client_id, timestamp, message_contents, to_phone, success_bool) tuples
+        """
+        if self.__db.log_sms_rows(rows) is not True:
+            logging.error(f"ClientUtils: __log_sms_rows_native: Error occurred trying to log SEND_TEXT from {client_id}")
+
+    def __log_sms_sent_doc(self, timestamp, client_id, sms_entry):
+        """
+        Log sms sent to the SMS log documents
+
+        :param str timestamp: Timestamp, used as the entry's key
+        :param str client_id: Client Identifier
+        :param dict sms_entry: The entry to log under the timestamp
         """
-        if self.__fsio is None:
-            logging.error("ClientUtils: __log_sms_sent_firestore: Trying to run a firestore logger when database_type is set to something other than 'firestore'")
+        path, part_dict = self.__sms_layout.doc_for_client(client_id, {
+            timestamp: sms_entry
+        })
+        w_res = self.__write_log_doc(path, part_dict)
+        if w_res is not True:
+            logging.error(f"ClientUtils: __log_sms_sent_doc: Error occurred trying to log SEND_TEXT from {client_id}")
+
+    def __write_log_doc(self, path, part_dict):
+        """
+        Merge a log document. Goes through the write-behind buffer when write_behind_enabled is set, otherwise writes synchronously.
+
+        :returns: True if queued, otherwise the result of the backend's write_doc()
+        """
+        if self.__write_buffer is not None:
+            return self.__write_buffer.put(path, part_dict)
+        return self.__db.write_doc(path, part_dict)
+
+instrument(ClientUtils, "client_utils", ["log_client_ping", "log_sms_sent", "log_sms_broadcast", "read_ping_log", "read_sms_log"], timed=False)
+
+class AsyncClientUtils:
+
+    def __init__(self):
+        """
+        Async version of ClientUtils' logging methods for the async server (see asgi.py). Writes the same documents or rows through
+        async_storage.get_async_backend(). Ping coalescing and the write-behind buffer are thread-based and not used here; with a
+        coroutine per request there is no thread pool for them to relieve.
+        """
+        self.__conf = ConfigProvider()
+        self.__ping_layout = LogShardLayout(ClientUtils.PING_LOG_PATH)
+        self.__sms_layout = LogShardLayout(ClientUtils.SMS_LOG_PATH)
+        self.__db = get_async_backend(self.__conf.database_type)
+
+    async def log_client_ping(self, timestamp, client_id, client_ip, client_version):
+        """
+        See ClientUtils.log_client_ping()
+        """
+        if self.__db is None:
+            logging.error(f"AsyncClientUtils: log_client_ping: database_type {self.__conf.database_type} not currently supported.")
+            return
+        if self.__db.native_logs is True:
+            w_res = await self.__db.log_client_pings([(client_id, timestamp, client_ip, client_version)])
+        else:
+            path, part_dict = self.__ping_layout.doc_for_client(client_id, {"timestamp": timestamp, "last ip": client_ip, "client version": client_version})
+            w_res = await self.__db.write_doc(path, part_dict)
+        if w_res is not True:
+            logging.error(f"AsyncClientUtils: log_client_ping: Error occured trying to log PING from {client_id} v{client_version} @ {client_ip}")
+
+    async def log_sms_sent(self, timestamp, client_id, message_contents, to_phone, success_bool):
+        """
+        See ClientUtils.log_sms_sent()
+        """
+        if self.__db is None:
+            logging.error(f"AsyncClientUtils: log_sms_sent: database_type {self.__conf.database_type} not currently supported.")
+        elif self.__db.native_logs is True:
+            await self.__log_sms_rows_native(client_id, [(client_id, timestamp, message_contents, to_phone, success_bool)])
         else:
-            part_dict = {
-                "clients": {
-                    client_id: {
-                        timestamp: {
-                            "message_contents": message_contents,
-                            "to_phone": to_phone,
-                            "success": bool(success_bool)
-                        }
-                    }
-                }
-            }
-            w_res = self.__fsio.write_doc(self.__SMS_LOG_PATH, part_dict)
-            if w_res is not True:
-                logging.error(f"ClientUtils: __log_sms_sent_firestore: Error occurred trying to log SEND_TEXT from {client_id}")
-        
-    def __log_client_ping_firestore(self, timestamp, client_id, client_ip, client_version):
-        """
-        Log client IP firestore
-        """
-        if self.__fsio is None:
-            logging.error("ClientUtils: __log_client_ping_firestore: Trying to run a firestore logger when database_type is set to something other than 'firestore'")
+            await self.__log_sms_sent_doc(timestamp, client_id, {
+                "message_contents": message_contents,
+                "to_phone": to_phone,
+                "success": bool(success_bool)
+            })
+
+    async def log_sms_broadcast(self, timestamp, client_id, message_contents, results):
+        """
+        See ClientUtils.log_sms_broadcast()
+        """
+        if self.__db is None:
+            logging.error(f"AsyncClientUtils: log_sms_broadcast: database_type {self.__conf.database_type} not currently supported.")
+        elif self.__db.native_logs is True:
+            await self.__log_sms_rows_native(client_id, [(client_id, timestamp, message_contents, phone, res) for phone, res in results.items()])
         else:
-            part_dict = {
-                "clients": {
-                    client_id: {
-                        "timestamp": timestamp,
-                        "last ip": client_ip,
-                        "client version": client_version
-                    }
-                }
-            }
-            w_res = self.__fsio.write_doc(self.__FIRESTORE_PING_LOG_PATH, part_dict)
-            if w_res is not True:
-                logging.error(f"ClientUtils: __log_client_ping_firestore: Error occured trying to log PING from {client_id} v{client_version} @ {client_ip}")
\ No newline at end of file
+            await self.__log_sms_sent_doc(timestamp, client_id, {
+                "message_contents": message_contents,
+                "broadcast": True,
+                "recipients": {phone: bool(res) for phone, res in results.items()},
+                "success": all(results.values())
+            })
+
+    async def __log_sms_rows_native(self, client_id, rows):
+        if await self.__db.log_sms_rows(rows) is not True:
+            logging.error(f"AsyncClientUtils: __log_sms_rows_native: Error occurred trying to log SEND_TEXT from {client_id}")
+
+    async def __log_sms_sent_doc(self, timestamp, client_id, sms_entry):
+        path, part_dict = self.__sms_layout.doc_for_client(client_id, {
+            timestamp: sms_entry
+        })
+        if await self.__db.write_doc(path, part_dict) is not True:
+            logging.error(f"AsyncClientUtils: __log_sms_sent_doc: Error occurred trying to log SEND_TEXT from {client_id}")
+
+instrument(AsyncClientUtils, "client_utils", ["log_client_ping", "log_sms_sent", "log_sms_broadcast"], timed=False)
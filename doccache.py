@@ -0,0 +1,154 @@
+import copy, logging, threading, time
+from collections import OrderedDict
+from utils import ConfigProvider, Singleton
+
+class DocumentCache(metaclass=Singleton):
+
+    # Stored for paths known not to exist, so repeated existence checks don't hit the database either
+    MISSING = object()
+
+    def __init__(self):
+        """
+        Process-wide read-through cache of documents by path for FirestoreIO, bounded by firestore_cache_max_entries (least recently
+        used entries are evicted first) and firestore_cache_ttl seconds. Documents are copied on the way in and out.
+        Only writes made through this process invalidate entries; writes from other processes show up once the entry expires.
+
+        Functions:\n
+        -- -- -- -- -- --
+        get(): Get a cached document
+        put(): Cache a document, or DocumentCache.MISSING for a path that doesn't exist
+        invalidate(): Drop a path's entry
+        clear(): Drop every entry
+        get_stats(): Counters for hits, misses and evictions
+        """
+        self.__conf = ConfigProvider()
+        self.__max_entries = max(1, self.__conf.firestore_cache_max_entries)
+        self.__ttl = max(0.0, self.__conf.firestore_cache_ttl)
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0
+        }
+
+    def get(self, path):
+        """
+        :param str path: Document path
+
+        :returns: Copy of the cached document, DocumentCache.MISSING if the document is known not to exist, or None if not cached
+        """
+        with self.__lock:
+            entry = self.__entries.get(path)
+            if entry is None:
+                self.__stats["misses"] += 1
+                return None
+            expires_at, doc = entry
+            if time.monotonic() >= expires_at:
+                del self.__entries[path]
+                self.__stats["expirations"] += 1
+                self.__stats["misses"] += 1
+                return None
+            self.__entries.move_to_end(path)
+            self.__stats["hits"] += 1
+        if doc is self.MISSING:
+            return doc
+        return copy.deepcopy(doc)
+
+    def put(self, path, doc):
+        """
+        Cache a document, evicting the least recently used entries past firestore_cache_max_entries
+
+        :param str path: Document path
+        :param doc: Document dict, or DocumentCache.MISSING
+        """
+        if doc is not self.MISSING and type(doc) is not dict:
+            logging.warning(f"DocumentCache: put: Not caching a {type(doc)} for path {path}")
+            return
+        if doc is not self.MISSING:
+            doc = copy.deepcopy(doc)
+        with self.__lock:
+            self.__entries[path] = (time.monotonic() + self.__ttl, doc)
+            self.__entries.move_to_end(path)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+                self.__stats["evictions"] += 1
+
+    def invalidate(self, path):
+        """
+        Drop a path's entry, if any. Call after writing to the path
+
+        :param str path: Document path
+        """
+        with self.__lock:
+            if self.__entries.pop(path, None) is not None:
+                self.__stats["invalidations"] += 1
+
+    def clear(self):
+        """
+        Drop every entry
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def get_stats(self):
+        """
+        Cache counters since startup. "expirations" are entries found past firestore_cache_ttl, also counted as misses.
+
+        :returns dict: Copy of the counters plus the current number of entries
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["entries"] = len(self.__entries)
+        return stats
+
+class RefCache(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Process-wide cache of Firestore document and collection references by path, bounded by firestore_ref_cache_size (least recently
+        used entries are evicted first). References are cheap value objects bound to a client; building them still walks the path
+        and allocates on every call, which adds up on the logging hot path. Entries are dropped if the client changes.
+
+        Functions:\n
+        -- -- -- -- -- --
+        get(): Get the cached reference for a path, building it on a miss
+        clear(): Drop every entry
+        """
+        self.__max_entries = max(1, ConfigProvider().firestore_ref_cache_size)
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__client = None
+
+    def get(self, client, path, build):
+        """
+        :param client: Firestore client the reference belongs to
+        :param str path: Document or collection path
+        :param build: Callable making the reference on a miss
+
+        :returns: The reference
+        """
+        with self.__lock:
+            if client is not self.__client:
+                self.__entries.clear()
+                self.__client = client
+            ref = self.__entries.get(path)
+            if ref is not None:
+                self.__entries.move_to_end(path)
+                return ref
+        ref = build()
+        with self.__lock:
+            if client is self.__client:
+                self.__entries[path] = ref
+                while len(self.__entries) > self.__max_entries:
+                    self.__entries.popitem(last=False)
+        return ref
+
+    def clear(self):
+        """
+        Drop every entry
+        """
+        with self.__lock:
+            self.__entries.clear()
@@ -1,7 +1,21 @@
-import logging
+import copy, logging, threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from auth import AuthHolder
-
-class FirestoreIO():
+from utils import ConfigProvider, RateLimiter
+from doccache import DocumentCache, RefCache
+from instrumentation import instrument
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import DELETE_FIELD
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from storage import StorageBackend, register_backend, normalize_query, parse_path, InvalidPathError
+
+class FirestoreIO(StorageBackend):
+
+    # Firestore rejects WriteBatch commits with more than 500 operations
+    MAX_BATCH_SIZE = 500
+    # Subcollection listings run at once by a recursive purge_collection(). Firestore lists one document's subcollections per round trip
+    MAX_LIST_IN_FLIGHT = 32
 
     def __init__(self):
         """
@@ -10,14 +24,36 @@ class FirestoreIO():
         Functions:\n
         -- -- -- -- -- --
         write_doc(): Write a document
+        write_docs(): Write many documents using batched writes
         read_doc(): Read a document
+        read_docs(): Read many documents using get_all
         delete_doc(): Delete a document
+        delete_docs(): Delete many documents using batched deletes
+        purge_collection(): Delete every document in a collection, and optionally every subcollection below it
+        delete_fields(): Delete fields from a document
         check_exists(): Check if a document exists
-        copy_doc(): Copy a document
+        read_collection(): Read every document in a collection
+        list_doc_paths(): Page through the document paths of a collection, including docs that only hold subcollections
+        list_subcollections(): List the subcollections of a document
+        copy_doc(): Copy a document, or a whole subtree with recursive=True
         read_docs_query(): Searches all docs in a given collection that match a formatted query and returns the matches as a nested dictionary
+        stream_query(): Yields the docs in a collection matching several where-clauses as they stream in, with order_by, limit, select and start_after
+
+        With firestore_cache_enabled, documents are read through the process-wide DocumentCache (see doccache.py).
+        Paths are parsed once per process (see storage.parse_path()) and their references reused through RefCache
         """
         self.__auth = AuthHolder()
-        self.__firestore = self.__auth.firestore
+        self.__conf = ConfigProvider()
+        self.__refs = RefCache()
+        if self.__conf.firestore_cache_enabled is True:
+            self.__cache = DocumentCache()
+        else:
+            self.__cache = None
+
+    @property
+    def __firestore(self):
+        # Fetched on every use instead of kept, so an instance made before a fork never uses the parent's client
+        return self.__auth.firestore
 
     def write_doc(self, path, write_dict):
         """
@@ -35,19 +71,59 @@ class FirestoreIO():
         if type(write_dict) is not dict:
             logging.error(f"FirestoreIO: write_doc: type(write_dict) is not dict.")
             return None
-        name = self.__is_valid_document_path(path)[1]
-        if name is None or name == "" or name == " ":
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
             logging.error(f"FirestoreIO: write_doc: Invalid document path: {path}")
             return None
-        c_handle = self.__make_coll_handle(path)
-        if c_handle is None:
-            logging.warning("FirestoreIO: write_doc: An issue occured trying to make the collection handle")
         try:
-            c_handle.document(name).set(write_dict, merge=True)
+            d_ref.set(write_dict, merge=True)
             return True
         except Exception as e:
             logging.error(e)
             return False
+        finally:
+            # After the write, so a read racing it can't cache the old document. Also on failure; we can't tell whether it reached the database
+            self.__invalidate(path)
+
+    def write_docs(self, items):
+        """
+        Merge many documents into Firestore using WriteBatch commits instead of one round trip per document.
+        Batches are split at Firestore's limit of 500 operations; each batch succeeds or fails as a whole.
+
+        :param list items: List of (path, write_dict) tuples. Paths follow the same rules as write_doc()
+
+        :returns list: One result per item, in order. True if written, False if the batch holding the item failed, None if the item was invalid.
+
+        Ex: results = FirestoreIO.write_docs([("/Logging/Doc1", {"a": 1}), ("/Logging/Doc2", {"b": 2})])
+        """
+        results = [None] * len(items)
+        pending = []
+        for i, item in enumerate(items):
+            path, write_dict = item
+            if type(write_dict) is not dict:
+                logging.error(f"FirestoreIO: write_docs: type(write_dict) is not dict for path {path}")
+                continue
+            d_ref = self.__make_doc_ref(path)
+            if d_ref is None:
+                logging.error(f"FirestoreIO: write_docs: Invalid document path: {path}")
+                continue
+            pending.append((i, path, d_ref, write_dict))
+        for start in range(0, len(pending), self.MAX_BATCH_SIZE):
+            chunk = pending[start:start + self.MAX_BATCH_SIZE]
+            try:
+                batch = self.__firestore.batch()
+                for i, path, d_ref, write_dict in chunk:
+                    batch.set(d_ref, write_dict, merge=True)
+                batch.commit()
+                committed = True
+            except Exception as e:
+                logging.error(f"FirestoreIO: write_docs: An exception occured committing a batch of {len(chunk)} writes")
+                logging.error(e)
+                committed = False
+            for i, path, d_ref, write_dict in chunk:
+                results[i] = committed
+                self.__invalidate(path)
+        return results
 
     def read_doc(self, path):
         """
@@ -61,26 +137,116 @@ class FirestoreIO():
                        if type(doc_dict) is not dict:
                            print("Error")
         """
-        name = self.__is_valid_document_path(path)[1]
-        if name is None or name == "" or name == " ":
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
             logging.error(f"FirestoreIO: read_doc: Invalid document path: {path}")
             return None
-        c_handle = self.__make_coll_handle(path)
-        if c_handle is None:
-            logging.error("FirestoreIO: read_doc: An issue occured trying to make the collection handle")
-            return None
+        if self.__cache is not None:
+            cached = self.__cache.get(path)
+            if type(cached) is dict:
+                return cached
+            elif cached is DocumentCache.MISSING:
+                logging.warning("FirestoreIO: read_doc: Your doc at path: %s appears to not exist! Check that it exists first and try again!", path)
+                return None
         try:
-            doc = c_handle.document(name).get()
+            doc = d_ref.get()
             if(doc.exists):
-                return doc.to_dict()
+                doc_dict = doc.to_dict()
+                if self.__cache is not None:
+                    self.__cache.put(path, doc_dict)
+                return doc_dict
             else:
-                logging.warning(f"FirestoreIO: read_doc: Your doc at path: {path} appears to not exist! Check that it exists first and try again!")
+                if self.__cache is not None:
+                    self.__cache.put(path, DocumentCache.MISSING)
+                logging.warning("FirestoreIO: read_doc: Your doc at path: %s appears to not exist! Check that it exists first and try again!", path)
                 return None
         except Exception as e:
             logging.error(f"FirestoreIO: read_doc: An unknown exception occured trying to read your doc at {path}")
             logging.error(e)
             return None
             
+    def read_docs(self, paths):
+        """
+        Read many documents with get_all, up to 500 per round trip, instead of one get per document
+
+        :param list paths: Document paths. Same rules as read_doc()
+
+        :returns list: One result per path, in order. The doc's dict, False if the doc doesn't exist, None if the path is invalid or the read failed
+
+        Ex: docs = FirestoreIO.read_docs(["/Links/Doc1", "/Links/Doc2"])
+        """
+        results = [None] * len(paths)
+        refs = {}
+        for i, path in enumerate(paths):
+            if self.__cache is not None:
+                cached = self.__cache.get(path)
+                if type(cached) is dict:
+                    results[i] = cached
+                    continue
+                elif cached is DocumentCache.MISSING:
+                    results[i] = False
+                    continue
+            if path in refs:
+                refs[path][1].append(i)
+                continue
+            d_ref = self.__make_doc_ref(path)
+            if d_ref is None:
+                logging.error(f"FirestoreIO: read_docs: Invalid document path: {path}")
+                continue
+            refs[path] = (d_ref, [i])
+        pending = list(refs.items())
+        for start in range(0, len(pending), self.MAX_BATCH_SIZE):
+            chunk = pending[start:start + self.MAX_BATCH_SIZE]
+            by_ref_path = {d_ref.path: path for path, (d_ref, indexes) in chunk}
+            found = {}
+            try:
+                for doc in self.__firestore.get_all([d_ref for path, (d_ref, indexes) in chunk]):
+                    found[by_ref_path[doc.reference.path]] = doc.to_dict() if doc.exists else False
+            except Exception as e:
+                logging.error(f"FirestoreIO: read_docs: An unknown exception occured reading a batch of {len(chunk)} documents")
+                logging.error(e)
+                continue
+            for path, (d_ref, indexes) in chunk:
+                doc = found.get(path)
+                if self.__cache is not None and doc is not None:
+                    self.__cache.put(path, doc if doc is not False else DocumentCache.MISSING)
+                for n, i in enumerate(indexes):
+                    # Every caller gets its own copy of a doc asked for more than once
+                    results[i] = copy.deepcopy(doc) if n > 0 and type(doc) is dict else doc
+        return results
+
+    def delete_fields(self, path, field_paths):
+        """
+        Delete fields from a document in one update, leaving the rest of the document alone
+
+        :param str path: Document path
+        :param list field_paths: Fields to delete. Each is a list of keys from the top of the document down, ex: ["clients", "client 1", "2024-01-01-00:00:00"].
+                                 Keys may hold any character, so they are never split on '.'
+
+        :returns: True if deleted, False if the document doesn't exist or the update failed, None if the path or a field path is invalid
+        """
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
+            logging.error(f"FirestoreIO: delete_fields: Invalid document path: {path}")
+            return None
+        if type(field_paths) is not list or not all(type(f) is list and len(f) > 0 and all(type(k) is str for k in f) for f in field_paths):
+            logging.error(f"FirestoreIO: delete_fields: field_paths must be a list of lists of keys. Got: {field_paths}")
+            return None
+        if len(field_paths) == 0:
+            return True
+        try:
+            d_ref.update({FieldPath(*f).to_api_repr(): DELETE_FIELD for f in field_paths})
+            return True
+        except NotFound:
+            logging.warning("FirestoreIO: delete_fields: Your doc at path: %s appears to not exist!", path)
+            return False
+        except Exception as e:
+            logging.error(f"FirestoreIO: delete_fields: An unknown exception occured deleting {len(field_paths)} fields from {path}")
+            logging.error(e)
+            return False
+        finally:
+            self.__invalidate(path)
+
     def check_exists(self, path):
         """
         Check if a document exists at a given path
@@ -89,29 +255,94 @@ class FirestoreIO():
 
         :returns boolean: True if exists, False otherwise. Will return None if an error occured.
         """
-        doc = self.read_doc(path)
-        if type(doc) is not dict:
-            return doc
-        else:
-            return True
+        if self.__cache is not None:
+            cached = self.__cache.get(path)
+            if type(cached) is dict:
+                return True
+            elif cached is DocumentCache.MISSING:
+                return False
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
+            logging.error(f"FirestoreIO: check_exists: Invalid document path: {path}")
+            return None
+        try:
+            doc = d_ref.get()
+        except Exception as e:
+            logging.error(f"FirestoreIO: check_exists: An unknown exception occured trying to read your doc at {path}")
+            logging.error(e)
+            return None
+        if self.__cache is not None:
+            self.__cache.put(path, doc.to_dict() if doc.exists else DocumentCache.MISSING)
+        return doc.exists
         
+    def read_collection(self, collection_path):
+        """
+        Read every document in a collection. Does not descend into subcollections.
+
+        :param str collection_path: Collection path. Must begin and end with a '/'. Ex: "/Logging/Last Ping Log/Clients/"
+
+        :returns dict: A dict where each key is a Doc id and each value is that Doc's dict. Returns None if an error occurred
+        """
+        c_handle = self.__make_coll_handle(collection_path)
+        if c_handle is None:
+            logging.error(f"FirestoreIO: read_collection: Invalid collection path: {collection_path}")
+            return None
+        return self.__execute_query(c_handle)
+
+    def list_doc_paths(self, collection_path, page_size=300):
+        """
+        Page through the paths of every document in a collection without reading the documents. Includes documents that don't
+        exist themselves but hold subcollections.
+
+        :param str collection_path: Collection path. Must begin and end with a '/'
+        :param int page_size: Document references fetched per round trip
+
+        :returns: Generator of document paths in doc id order, or None if the path is invalid. If paging fails partway the error is logged
+                  and the generator yields a final None, so callers can tell a short listing from a complete one
+        """
+        c_handle = self.__make_coll_handle(collection_path)
+        if c_handle is None:
+            logging.error(f"FirestoreIO: list_doc_paths: Invalid collection path: {collection_path}")
+            return None
+        return self.__list_doc_paths(c_handle, collection_path, page_size)
+
+    def list_subcollections(self, path):
+        """
+        List the subcollections of a document
+
+        :param str path: Document path, or "/" for the root collections
+
+        :returns list: Collection paths, each beginning and ending with a '/'. None if an error occurred
+        """
+        try:
+            if path == "/":
+                colls = self.__firestore.collections()
+            else:
+                d_ref = self.__make_doc_ref(path)
+                if d_ref is None:
+                    logging.error(f"FirestoreIO: list_subcollections: Invalid document path: {path}")
+                    return None
+                colls = d_ref.collections()
+            return [f"/{c_ref.id}/" if path == "/" else f"{path}/{c_ref.id}/" for c_ref in colls]
+        except Exception as e:
+            logging.error(f"FirestoreIO: list_subcollections: An unknown exception occured listing the subcollections of {path}")
+            logging.error(e)
+            return None
+
     def read_docs_by_query(self, collection_path, query_list):
         """Takes the following params to construct and execute a query on all of the Docs in a Collection:
 
         :param str collection_path: A String formatted path that must start with a / and end with a / (last folder must always be a collection)
-        :param list query_list: A list used for formulating the query.
+        :param list query_list: A [field, op, value] list used for formulating the query, or a list of them that must all match. Values keep their type.
 
         :returns dict: A dict where the matching Doc id is the key, and the document's Dict is the Doc's dict. Returns None if an error occurred
         
         Example Usage: query_results = FirestoreIO.read_docs_by_query("/ExampleCollection/", ["email", "==", "test@test.net"])
+                       query_results = FirestoreIO.read_docs_by_query("/ExampleCollection/", [["age", ">=", 18], ["active", "==", True]])
         
         Example Results: {'ExampleMatchingDocName': {'name': 'Bob McFakeName', 'email': 'test@test.net', ...}, {...}, ...}
         """
-        c_handle = self.__make_coll_handle(collection_path)
-        if c_handle is None:
-            logging.error("FirestoreIO: read_docs_by_query: Issue occured making collection handle")
-            return None
-        q_ref = self.__construct_query_ref(c_handle, query_list)
+        q_ref = self.__construct_query_ref(collection_path, query_list)
         if q_ref is None:
             logging.error("FirestoreIO: read_docs_by_query: Issue occured constructing query reference")
             return None
@@ -121,44 +352,196 @@ class FirestoreIO():
             return None
         return res
 
-    def delete_doc(self, path):
+    def stream_query(self, collection_path, where=None, order_by=None, limit=None, select=None, start_after=None):
         """
-        Delete a document using a valid path.
+        Query a collection and yield the matching docs as they stream in from Firestore, without holding the result set in memory.
+
+        :param str collection_path: Collection path. Must begin and end with a '/'
+        :param list where: A [field, op, value] clause, or a list of clauses that must all match. Values keep their type. Nested fields are separated by '.'
+        :param order_by: A field name, or a list of field names and [field, "ASCENDING"|"DESCENDING"] pairs
+        :param int limit: Maximum number of docs to yield
+        :param list select: Only return these fields
+        :param start_after: Doc id of the last doc of the previous page, or a dict of its order_by field values
+
+        :returns: Generator of (doc_id, doc_dict) tuples, or None if the path or query is invalid. Errors while streaming are logged and end the generator
+
+        Ex: for doc_id, doc in FirestoreIO.stream_query("/Users/", where=[["age", ">=", 18]], order_by="age", limit=100):
+                print(doc_id, doc)
+        """
+        q_ref = self.__construct_query_ref(collection_path, where, order_by, limit, select, start_after)
+        if q_ref is None:
+            logging.error("FirestoreIO: stream_query: Issue occured constructing query reference")
+            return None
+        return self.__stream(q_ref, collection_path)
+
+    def delete_doc(self, path, blind=False):
+        """
+        Delete a document using a valid path. Takes one round trip: the delete carries an exists precondition, so Firestore
+        reports a missing document instead of us reading it first.
 
         :param str path: Valid document path. Must begin but not end in '/'
+        :param bool blind: Skip the precondition. Deleting a document that doesn't exist then also returns True
 
         :returns: True if document is deleted, False if the document didn't exist, and None if an error has occured.
         """
-        exists = self.check_exists(path)
-        if exists is False:
-            return exists
-        elif exists is None:
+        d_ref = self.__make_doc_ref(path)
+        if d_ref is None:
+            logging.error(f"FirestoreIO: delete_doc: Invalid document path: {path}")
             return None
-        else:
-            name = self.__is_valid_document_path(path)[1]
-            if name is None or name == "" or name == " ":
-                logging.error(f"FirestoreIO: delete_doc: Invalid document path: {path}")
-                return None
-            c_handle = self.__make_coll_handle(path)
-            if c_handle is None:
-                logging.error("FirestoreIO: delete_doc: An issue occured while trying to make the collection handle")
-                return None
+        try:
+            if blind is True:
+                d_ref.delete()
+            else:
+                d_ref.delete(option=self.__firestore.write_option(exists=True))
+            if self.__cache is not None:
+                self.__cache.put(path, DocumentCache.MISSING)
+            return True
+        except NotFound:
+            if self.__cache is not None:
+                self.__cache.put(path, DocumentCache.MISSING)
+            return False
+        except Exception as e:
+            self.__invalidate(path)
+            logging.error("FirestoreIO: delete_doc: An unknown exception occured tryign to execute firestore delete command")
+            logging.error(e)
+            return None
+
+    def delete_docs(self, paths):
+        """
+        Delete many documents using WriteBatch commits split at Firestore's limit of 500 operations.
+        Unlike delete_doc() this doesn't read the documents first, so deleting a doc that doesn't exist also counts as deleted.
+
+        :param list paths: Document paths. Same rules as delete_doc()
+
+        :returns list: One result per path, in order. True if deleted, False if the batch holding the path failed, None if the path was invalid
+        """
+        results = [None] * len(paths)
+        pending = []
+        for i, path in enumerate(paths):
+            d_ref = self.__make_doc_ref(path)
+            if d_ref is None:
+                logging.error(f"FirestoreIO: delete_docs: Invalid document path: {path}")
+                continue
+            pending.append((i, path, d_ref))
+        for start in range(0, len(pending), self.MAX_BATCH_SIZE):
+            chunk = pending[start:start + self.MAX_BATCH_SIZE]
             try:
-                c_handle.document(name).delete()
-                return True
+                batch = self.__firestore.batch()
+                for i, path, d_ref in chunk:
+                    batch.delete(d_ref)
+                batch.commit()
+                committed = True
             except Exception as e:
-                logging.error("FirestoreIO: delete_doc: An unknown exception occured tryign to execute firestore delete command")
+                logging.error(f"FirestoreIO: delete_docs: An exception occured committing a batch of {len(chunk)} deletes")
                 logging.error(e)
-                return None
+                committed = False
+            for i, path, d_ref in chunk:
+                results[i] = committed
+                if committed is True and self.__cache is not None:
+                    self.__cache.put(path, DocumentCache.MISSING)
+                else:
+                    self.__invalidate(path)
+        return results
+
+    def purge_collection(self, collection_path, recursive=False, rate=None, max_in_flight=None):
+        """
+        Delete every document in a collection. Document paths are paged through and deleted in batches of up to 500 by a pool of
+        threads, capped at rate deletes per second. Firestore doesn't delete subcollections with their parent document, so with
+        recursive every subcollection below the collection is purged too. That takes one listing round trip per document, run
+        MAX_LIST_IN_FLIGHT at a time, so leave it off when the collection has no subcollections.
+
+        :param str collection_path: Collection path. Must begin and end with a '/'
+        :param bool recursive: Also purge subcollections
+        :param float rate: Maximum deletes per second. Defaults to firestore_purge_rate. 0 disables the cap
+        :param int max_in_flight: Maximum number of batches being deleted at once. Defaults to firestore_purge_workers
 
-    # TODO: Add a recursive copy function
-    def copy_doc(self, from_path, to_path):
+        :returns dict: {"deleted": int, "failed": int, "collections": int}, or None if the path is invalid. The purge is complete when "failed" is 0
+        """
+        if self.__make_coll_handle(collection_path) is None:
+            logging.error(f"FirestoreIO: purge_collection: Invalid collection path: {collection_path}")
+            return None
+        rate = self.__conf.firestore_purge_rate if rate is None else rate
+        workers = max(1, self.__conf.firestore_purge_workers if max_in_flight is None else max_in_flight)
+        limiter = RateLimiter(rate, burst=max(rate, self.MAX_BATCH_SIZE))
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(workers)
+        stats = {"deleted": 0, "failed": 0, "collections": 0}
+        pending = [collection_path]
+
+        def purge_batch(paths):
+            try:
+                if recursive is True:
+                    for subs in lister.map(self.list_subcollections, paths):
+                        if subs is None:
+                            with lock:
+                                stats["failed"] += 1
+                            continue
+                        with lock:
+                            pending.extend(subs)
+                limiter.acquire(len(paths))
+                results = self.delete_docs(paths)
+                with lock:
+                    stats["deleted"] += results.count(True)
+                    stats["failed"] += len(results) - results.count(True)
+            except Exception as e:
+                logging.error(f"FirestoreIO: purge_collection: An unknown exception occured deleting a batch of {len(paths)} documents")
+                logging.error(e)
+                with lock:
+                    stats["failed"] += len(paths)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="FirestorePurge") as executor, \
+             ThreadPoolExecutor(max_workers=self.MAX_LIST_IN_FLIGHT, thread_name_prefix="FirestorePurgeList") as lister:
+            futures = []
+            while True:
+                with lock:
+                    coll = pending.pop() if len(pending) > 0 else None
+                if coll is None:
+                    # Running batches may still find subcollections
+                    wait(futures)
+                    futures = []
+                    with lock:
+                        if len(pending) == 0:
+                            break
+                    continue
+                batch = []
+                for path in self.list_doc_paths(coll, page_size=self.MAX_BATCH_SIZE) or [None]:
+                    if path is None:
+                        with lock:
+                            stats["failed"] += 1
+                        break
+                    batch.append(path)
+                    if len(batch) >= self.MAX_BATCH_SIZE:
+                        slots.acquire()
+                        futures.append(executor.submit(purge_batch, batch))
+                        batch = []
+                if len(batch) > 0:
+                    slots.acquire()
+                    futures.append(executor.submit(purge_batch, batch))
+                with lock:
+                    stats["collections"] += 1
+        logging.info("FirestoreIO: purge_collection: Purged %s: %s", collection_path, stats)
+        return stats
+
+    def copy_doc(self, from_path, to_path, recursive=False, checkpoint_file=None, progress_callback=None):
         """
         Copy a document from point a to point b.
         Will overwrite existing docs at to_path
 
+        :param bool recursive: Also copy every subcollection under from_path, using batched, concurrent writes. See treecopy.TreeCopier
+        :param str checkpoint_file: recursive only. Progress is saved here so a failed copy can be resumed by running it again
+        :param progress_callback: recursive only. Called with a stats dict as the copy progresses
+
         :returns: True if success, None if an error has occurreds
         """
+        if recursive is True:
+            from treecopy import TreeCopier
+            stats = TreeCopier(self, checkpoint_file=checkpoint_file, progress_callback=progress_callback).copy(from_path, to_path)
+            if stats is None or stats["failed"] > 0:
+                logging.error(f"FirestoreIO: copy_doc: Recursive copy of {from_path} to {to_path} did not complete. Stats: {stats}")
+                return None
+            return True
         doc = self.read_doc(from_path)
         if type(doc) is not dict:
             logging.error("FirestoreIO: copy_doc: An error occured trying to read doc to copy. Does doc exist?")
@@ -169,109 +552,134 @@ class FirestoreIO():
             return None
         return True
 
-    def __make_coll_handle(self, path):
+    def __invalidate(self, path):
         """
-        Make a collection hnadle for the write_doc function
-
-        :param str path: Path
-
-        :returns: firestore collection handle made via .collection() or None if err
+        Drop a path from the document cache, if enabled
         """
-        path_chopped = self.__is_valid_collection_path(path)[0]
-        if path_chopped is None:
-            logging.error(f"FirestoreIO: __make_coll_handle: Unable to continue. Path is not valid. Path: {path}")
-            return None
-        else:
-            try:
-                coll_handle = self.__firestore.collection(path_chopped)
-                return coll_handle
-            except Exception as e:
-                logging.error(f"FirestoreIO: __make_coll_handle: An unknonw exception occured making a collection handle for path {path}")
-                logging.error(e)
-                return None
+        if self.__cache is not None:
+            self.__cache.invalidate(path)
 
-    def __is_valid_document_path(self, path):
+    def __make_doc_ref(self, path):
         """
-        Validates a document path string
+        Get the document reference for a document path, from the reference cache
 
         :param str path: Document path
 
-        :returns list of str: [chopped_path, document_name] 
-
-        Document paths must be of type str and begin with a '/' but must not end with a '/' and require an odd number of '/'
+        :returns: firestore document reference or None if err
         """
-        if type(path) != str or path == "" or path == " ":
-            logging.error(f"FirestoreIO: __is_valid_document_path: Document path is not string or is an empty string. Your path: {path}")
-            return None
-        elif path[0] != "/":
-            logging.error(f"FirestoreIO: __is_valid_document_path: Document path MUST begin with '/'. Your path: {path}")
+        parsed = self.__parse(path, True, "__make_doc_ref")
+        if parsed is None:
             return None
-        elif path[-1] == "/":
-            logging.error(f"FirestoreIO: __is_valid_document_path: Document path MUST NOT end in '/'. Your path: {path}")
+        try:
+            return self.__refs.get(self.__firestore, parsed.path, lambda: self.__firestore.document(parsed.relative_path))
+        except Exception as e:
+            logging.error(f"FirestoreIO: __make_doc_ref: An unknown exception occured making a document reference for path {path}")
+            logging.error(e)
             return None
-        else:
-            list_slash_pos = []
-            counter = 0
-            forward_slash_count = 0
-            for char in path:
-                if char == "/":
-                    forward_slash_count += 1
-                    list_slash_pos.append(counter)
-                counter += 1
-            if forward_slash_count % 2 != 0:
-                logging.error(f"FirestoreIO: __is_valid_document_path: Path has an odd number of '/'. You are trying to operate on a collection. Your path: {path}")
-                return None
-            else:
-                return [path[1:list_slash_pos[len(list_slash_pos)-1]], path[list_slash_pos[len(list_slash_pos)-1]+1:len(path)]]
 
-    def __is_valid_collection_path(self, path):
+    def __make_coll_handle(self, path):
         """
-        Validates a collection path string
+        Get the collection handle for a collection path, from the reference cache
 
         :param str path: Collection path
 
-        Collection paths must be of type str and begin and end with a '/' and require an even number of '/'
+        :returns: firestore collection handle made via .collection() or None if err
         """
-        if type(path) != str or path == "" or path == " ":
-            logging.error(f"FirestoreIO: __is_valid_collection_path: Collection path is not string or is an empty string. Your path: {path}")
+        parsed = self.__parse(path, False, "__make_coll_handle")
+        if parsed is None:
             return None
-        elif path[0] != "/":
-            logging.error(f"FirestoreIO: __is_valid_collection_path: Collection path MUST begin with '/'. Your path: {path}")
+        try:
+            return self.__refs.get(self.__firestore, parsed.path, lambda: self.__firestore.collection(parsed.relative_path))
+        except Exception as e:
+            logging.error(f"FirestoreIO: __make_coll_handle: An unknown exception occured making a collection handle for path {path}")
+            logging.error(e)
             return None
-        elif path[-1] != "/":
-            logging.error(f"FirestoreIO: __is_valid_collection_path: Document path MUST end in '/'. Your path: {path}")
+
+    def __parse(self, path, document, caller):
+        """
+        Parse a path with storage.parse_path(), which validates each distinct path once and memoizes the result
+
+        :param bool document: True if path must be a document path, False if it must be a collection path
+        :param str caller: Method name for the log line
+
+        :returns StoragePath: The parsed path, or None if it is invalid or the wrong kind of path
+        """
+        try:
+            parsed = parse_path(path)
+        except InvalidPathError as e:
+            logging.error(f"FirestoreIO: {caller}: {e}")
             return None
-        else:
-            return path[1:len(path)-1]
+        if parsed.is_document is not document:
+            logging.error(f"FirestoreIO: {caller}: Expected a {'document' if document else 'collection'} path. Your path: {path}")
+            return None
+        return parsed
 
-    def __construct_query_ref(self, collection_handle, query_list):
+    def __construct_query_ref(self, collection_path, where, order_by=None, limit=None, select=None, start_after=None):
         """Construct the query reference
            
-           :param collection_handle: The collection handle made by __make_collection_handle().
-           :param list query_list: A list used for formatting the query.
+           :param str collection_path: Collection path. Must begin and end with a '/'
+           See stream_query() for the other params
 
-           :returns: A query reference made with collection_handle.where("", "", "")
+           :returns: A query reference, or None if the path or query is invalid
 
            NOTE: If using spaces in your keys (NOT the collection), you must escape them:
            https://stackoverflow.com/a/53048641
         """
-        if len(query_list) > 3:
-            logging.error("FirestoreIO: __construct_query_ref: You tried to pass a query_list with more than 3 elements")
+        query = normalize_query(where, order_by, limit, select, start_after)
+        if query is None:
+            logging.error(f"FirestoreIO: __construct_query_ref: Invalid query for {collection_path}")
+            return None
+        clauses, orders, limit, select, start_after = query
+        c_handle = self.__make_coll_handle(collection_path)
+        if c_handle is None:
+            logging.error(f"FirestoreIO: __construct_query_ref: Invalid collection path: {collection_path}")
             return None
-        counter = 0
-        while counter < len(query_list):
-            if isinstance(query_list[counter], str) is False:
-                logging.warning("FirestoreIO: __construct_query_ref: You tried to pass something that wasn't a string into your query_list! We will cast for you this time, but please fix it")
-                query_list[counter] = str(query_list[counter])
-            counter += 1
         try:
-            query_ref = collection_handle.where(f'{query_list[0]}', f'{query_list[1]}', f'{query_list[2]}')
+            query_ref = c_handle
+            for field, op, value in clauses:
+                query_ref = query_ref.where(filter=FieldFilter(field, op, value))
+            for field, direction in orders:
+                query_ref = query_ref.order_by(field, direction=direction)
+            if select is not None:
+                query_ref = query_ref.select(select)
+            if type(start_after) is str:
+                cursor = c_handle.document(start_after).get()
+                if not cursor.exists:
+                    logging.error(f"FirestoreIO: __construct_query_ref: start_after doc {start_after} doesn't exist in {collection_path}")
+                    return None
+                query_ref = query_ref.start_after(cursor)
+            elif start_after is not None:
+                query_ref = query_ref.start_after(start_after)
+            if limit is not None:
+                query_ref = query_ref.limit(limit)
             return query_ref
         except Exception as e:
             logging.error("FirestoreIO: __construct_query_ref: An unknown error occured trying to construct your query_ref for you. Please investigate.")
             logging.error(e)
             return None
 
+    def __list_doc_paths(self, c_handle, collection_path, page_size):
+        try:
+            for d_ref in c_handle.list_documents(page_size=page_size):
+                yield collection_path + d_ref.id
+        except Exception as e:
+            logging.error(f"FirestoreIO: __list_doc_paths: An Exception occured while listing the documents of {collection_path}")
+            logging.error(e)
+            yield None
+
+    def __stream(self, query_ref, collection_path):
+        """
+        Generator over a query's results
+
+        :returns: Generator of (doc_id, doc_dict) tuples
+        """
+        try:
+            for doc in query_ref.stream():
+                yield doc.id, doc.to_dict()
+        except Exception as e:
+            logging.error(f"FirestoreIO: __stream: An Exception occured while streaming query results from {collection_path}")
+            logging.error(e)
+
     def __execute_query(self, query_ref):
         """Execute Firestore read query
            :param query_ref: A query_ref returned by __construct_query_ref()
@@ -279,17 +687,18 @@ class FirestoreIO():
            :returns dict docs_dicts_dict: Dictionary where keys are doc ids and values are document dictionaries made with doc.to_dict(). If no matches to query, empty. If err, None
         """
         doc_dicts_dict = {}
-        docs = None
         try:
-            docs = query_ref.stream()
-            docs = list(docs)
+            for doc in query_ref.stream():
+                if str(doc.id) in doc_dicts_dict:
+                    logging.warning("FirestoreIO: __execute_query: Duplicate key in doc_dicts_dict, this is a firestore data structure issue! Will overwrite previous entry!")
+                doc_dicts_dict[f'{doc.id}'] = doc.to_dict()
         except Exception as e:
             logging.error(f"FirestoreIO: __execute_query: An Exception occured while trying to execute your query! Returning None. Stacktrace: \n\n{e}")
             return None
-        for doc in docs:
-            if str(doc.id) in doc_dicts_dict:
-                logging.warning(f"FirestoreIO: __execute_query: Duplicate key in doc_dicts_dict, this is a firestore data structure issue! Will overwrite previous entry!")
-                doc_dicts_dict[f'{doc.id}'] = doc.to_dict()
-            else:
-                doc_dicts_dict[f'{doc.id}'] = doc.to_dict()
-        return doc_dicts_dict
\ No newline at end of file
+        return doc_dicts_dict
+
+# Generators (stream_query(), list_doc_paths()) are left out since the call returns before any work is done
+TIMED_METHODS = ["write_doc", "write_docs", "read_doc", "read_docs", "delete_doc", "delete_docs", "delete_fields", "check_exists",
+                 "read_collection", "read_docs_by_query", "list_subcollections", "purge_collection", "copy_doc"]
+instrument(FirestoreIO, "firestore", TIMED_METHODS, kind="CLIENT")
+register_backend("firestore", FirestoreIO)
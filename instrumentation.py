@@ -0,0 +1,84 @@
+import functools, inspect
+
+# Hooks told about every instrumented call. Metrics and Tracer register themselves here once enabled. Checked on every call
+_HOOKS = ()
+
+class InstrumentedCall():
+
+    def __init__(self, component, operation, kind, timed):
+        """
+        An instrumented method, as passed to the hooks. Made once per method by instrument()
+
+        :param str component: Ex: "firestore"
+        :param str operation: Method name. Ex: "read_doc"
+        :param str kind: Zipkin span kind, or None
+        :param bool timed: False if Metrics should leave the call out of app_backend_call_duration_seconds
+        """
+        self.component = component
+        self.operation = operation
+        self.name = f"{component}.{operation}"
+        self.kind = kind
+        self.timed = timed
+
+def register(hook):
+    """
+    Tell a hook about every instrumented call from now on. The hook implements call_started(call), which returns a token, and
+    call_finished(call, token, error), which gets that token back along with the exception the call raised, or None
+
+    :param hook: Ex: the Metrics or Tracer instance
+    """
+    global _HOOKS
+    if hook not in _HOOKS:
+        _HOOKS = _HOOKS + (hook,)
+
+def instrument(cls, component, method_names, kind=None, timed=True):
+    """
+    Wrap some of a class's methods so the registered hooks see each call: Metrics times them into app_backend_call_duration_seconds
+    and Tracer records a child span named "<component>.<method>". Call it right after the class definition. While no hook is
+    registered the wrappers only check one module global. Async methods are followed until they finish
+
+    :param cls: Class to patch
+    :param str component: Ex: "firestore"
+    :param list method_names: Names of the methods to instrument
+    :param str kind: Zipkin span kind. "CLIENT" for calls leaving the process
+    :param bool timed: False to only trace the calls. Ex: ClientUtils, whose time is already counted by the backends it calls
+    """
+    for method_name in method_names:
+        setattr(cls, method_name, _wrap(getattr(cls, method_name), InstrumentedCall(component, method_name, kind, timed)))
+
+def _wrap(func, call):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            hooks = _HOOKS
+            if len(hooks) == 0:
+                return await func(*args, **kwargs)
+            tokens = [hook.call_started(call) for hook in hooks]
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                _finish(hooks, call, tokens, e)
+                raise
+            _finish(hooks, call, tokens, None)
+            return result
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        hooks = _HOOKS
+        if len(hooks) == 0:
+            return func(*args, **kwargs)
+        tokens = [hook.call_started(call) for hook in hooks]
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            _finish(hooks, call, tokens, e)
+            raise
+        _finish(hooks, call, tokens, None)
+        return result
+    return wrapper
+
+def _finish(hooks, call, tokens, error):
+    # Last started, first finished, so the hooks nest
+    for hook, token in zip(reversed(hooks), reversed(tokens)):
+        hook.call_finished(call, token, error)
@@ -1,7 +1,8 @@
 from utils import InfoProivder, ConfigProvider, get_timestamp
 from colorama import Fore, Style
+from tracing import current_span
 
-import os, sys, logging
+import os, sys, json, itertools, logging, logging.handlers, queue, threading, atexit
 
 def windows_enable_ansi_terminal():
     if (sys.platform == "win32"):
@@ -69,20 +70,189 @@ class LogFormatter(logging.Formatter):
     def __init__(self, color, *args, **kwargs):
         super(LogFormatter, self).__init__(*args, **kwargs)
         self.color = color
+        # One formatter per level with its color codes already in the template, so format() never has to add fields to the record
+        fmt = self._style._fmt
+        self.__plain = logging.Formatter(self.__fill(fmt, "", ""), datefmt=self.datefmt)
+        self.__by_level = {}
+        if self.color is True:
+            for level, code in self.COLOR_CODES.items():
+                self.__by_level[level] = logging.Formatter(self.__fill(fmt, code, self.RESET_CODE), datefmt=self.datefmt)
 
-    def format(self, record, *args, **kwargs):
-        if self.color is True and record.levelno in self.COLOR_CODES:
-            record.color_on = self.COLOR_CODES[record.levelno]
-            record.color_off = self.RESET_CODE
-        else:
-            record.color_on = ""
-            record.color_off = ""
-        return super(LogFormatter, self).format(record, *args, **kwargs)
+    def format(self, record):
+        return self.__by_level.get(record.levelno, self.__plain).format(record)
+
+    def __fill(self, fmt, color_on, color_off):
+        return fmt.replace("%(color_on)s", color_on.replace("%", "%%")).replace("%(color_off)s", color_off.replace("%", "%%"))
+
+
+class JSONLogFormatter(logging.Formatter):
+
+    # Attributes every LogRecord has. Anything else on a record came from extra={...} and is written as its own field
+    RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__.keys()) | {"message", "asctime", "color_on", "color_off", "taskName"}
+
+    def __init__(self, *args, **kwargs):
+        """
+        Formats each record as one JSON object per line: "time", "level", "thread", "message", plus any fields passed with
+        extra={...}, ex: logging.info("PING from %s", cid, extra={"event": "ping", "client_id": cid, "route": "/api/ping"})
+        """
+        super(JSONLogFormatter, self).__init__(*args, **kwargs)
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
 
+    def __init__(self, rates):
+        """
+        Keeps 1 of every N records of each event type. Records are tagged with extra={"event": "ping"}; untagged records,
+        events without a rate and WARNING and above always pass. Installed on the root logger, so dropped records are never formatted
+
+        :param dict rates: Event type to N. Ex: {"ping": 10}
+        """
+        super(SamplingFilter, self).__init__()
+        self.rates = {str(event): max(1, int(n)) for event, n in rates.items()}
+        self.__counters = {event: itertools.count() for event in self.rates}
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        rate = self.rates.get(event) if event is not None else None
+        if rate is None or rate == 1 or record.levelno >= logging.WARNING:
+            return True
+        return next(self.__counters[event]) % rate == 0
+
+
+LOG_QUEUE_OVERFLOW_POLICIES = ["block", "drop", "sample"]
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue, overflow="block", sample_rate=10):
+        """
+        QueueHandler for a bounded queue. Logging threads only put the record on the queue; a QueueListener thread formats and writes it,
+        so request threads never wait on the terminal or the disk, or on each other for a handler lock.
+
+        What happens once the queue is full depends on overflow:
+        block: Wait for room. Nothing is lost, but a stalled listener stalls the logging threads
+        drop: Drop the record
+        sample: Once the queue is 3/4 full, keep 1 of every sample_rate records below WARNING. WARNING and above wait for room
+        Dropped records are counted and reported with a warning once the queue has room again.
+
+        :param queue.Queue log_queue: Queue with a maxsize
+        :param str overflow: One of LOG_QUEUE_OVERFLOW_POLICIES
+        :param int sample_rate: sample only. Keep 1 of every sample_rate records under pressure
+        """
+        super(BoundedQueueHandler, self).__init__(log_queue)
+        self.overflow = overflow
+        self.sample_rate = max(1, sample_rate)
+        self.__high_water = max(1, (log_queue.maxsize * 3) // 4)
+        self.__lock = threading.Lock()
+        self.__seen = 0
+        self.__dropped = 0
 
-def setup_logging(console_log_output, console_log_level, console_log_color, logfile_file, logfile_log_level, logfile_log_color, log_line_template):
+    def emit(self, record):
+        try:
+            if self.overflow == "sample" and record.levelno < logging.WARNING and self.queue.qsize() >= self.__high_water:
+                with self.__lock:
+                    self.__seen += 1
+                    keep = self.__seen % self.sample_rate == 0
+                    if not keep:
+                        self.__dropped += 1
+                if not keep:
+                    return
+            # Decide before prepare() so dropped records are never formatted
+            if self.overflow == "block" or (self.overflow == "sample" and record.levelno >= logging.WARNING):
+                self.queue.put(self.prepare(record))
+            else:
+                try:
+                    self.queue.put_nowait(self.prepare(record))
+                except queue.Full:
+                    with self.__lock:
+                        self.__dropped += 1
+                    return
+            if self.__dropped > 0:
+                self.__report_dropped()
+        except Exception:
+            self.handleError(record)
+
+    def __report_dropped(self):
+        with self.__lock:
+            dropped = self.__dropped
+            self.__dropped = 0
+        if dropped == 0:
+            return
+        warning = logging.makeLogRecord({
+            "name": "root",
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": f"BoundedQueueHandler: Log queue was full, {dropped} records dropped ({self.overflow})"
+        })
+        try:
+            self.queue.put_nowait(warning)
+        except queue.Full:
+            with self.__lock:
+                self.__dropped += dropped
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # The queue may be full, so wait for room instead of raising queue.Full
+        self.queue.put(self._sentinel)
+
+class TraceContextFilter(logging.Filter):
+
+    def filter(self, record):
+        """
+        Adds trace_id and span_id (see tracing.py) to every record, "-" outside a traced request. Installed on the handlers
+        attached to the root logger, so it runs in the logging thread where the trace context is
+        """
+        span = current_span()
+        record.trace_id = span.trace_id if span is not None else "-"
+        record.span_id = span.span_id if span is not None else "-"
+        return True
+
+# Handlers and listener installed on the root logger by the last setup_logging() call
+_LOGGING_STATE = {"handlers": [], "owned": [], "filter": None, "listener": None, "pid": None, "args": None}
+_FORK_HOOK_REGISTERED = False
+
+def setup_logging(console_log_output, console_log_level, console_log_color, logfile_file, logfile_log_level, logfile_log_color, log_line_template,
+                  queue_enabled=False, queue_size=10000, queue_overflow="block", queue_sample_rate=10, logfile_per_process=False, log_format="text",
+                  sample_rates=None, trace_ids=False):
+        """
+        Set up the root logger with a console and a log file handler. Calling it again replaces the handlers from the last call.
+
+        With queue_enabled, the root logger only gets a BoundedQueueHandler and one listener thread writes to the console and the file.
+        With logfile_per_process, the process id is added to the log file name. Processes forked after setup_logging() (ex: gunicorn
+        workers with --preload) set their logging up again in the child, since the listener thread doesn't survive a fork.
+        log_format "json" writes one JSON object per record with JSONLogFormatter instead of log_line_template.
+        sample_rates installs a SamplingFilter on the root logger. Ex: {"ping": 10} keeps 1 of every 10 PING lines
+        trace_ids adds trace_id and span_id to every record with TraceContextFilter, for use in log_line_template or the JSON output
+
+        :returns bool: True if logging was set up
+        """
+        global _FORK_HOOK_REGISTERED
+        if queue_overflow not in LOG_QUEUE_OVERFLOW_POLICIES:
+            print(f"Failed to set up log queue: invalid overflow policy: '{queue_overflow}'. Use one of {LOG_QUEUE_OVERFLOW_POLICIES}")
+            return False
+        if log_format not in ["text", "json"]:
+            print(f"Failed to set log format: invalid format: '{log_format}'. Use \"text\" or \"json\"")
+            return False
+        args = dict(locals())
         logger = logging.getLogger()
         logger.setLevel(logging.DEBUG)
+        _remove_installed_handlers(logger)
         console_log_output = console_log_output.lower()
         if console_log_output == "stdout":
             console_log_output = sys.stdout
@@ -97,9 +267,14 @@ def setup_logging(console_log_output, console_log_level, console_log_color, logf
         except Exception as e:
             print(f"Failed to set console log level: invalid level {console_log_level}\n", e)
             return False
-        console_formatter = LogFormatter(fmt=log_line_template, color=console_log_color)
+        if log_format == "json":
+            console_formatter = JSONLogFormatter()
+        else:
+            console_formatter = LogFormatter(fmt=log_line_template, color=console_log_color)
         console_handler.setFormatter(console_formatter)
-        logger.addHandler(console_handler)
+        if logfile_per_process is True:
+            root, ext = os.path.splitext(logfile_file)
+            logfile_file = f"{root}_{os.getpid()}{ext}"
         try:
             logfile_handler = logging.FileHandler(logfile_file)
         except Exception as e:
@@ -110,7 +285,66 @@ def setup_logging(console_log_output, console_log_level, console_log_color, logf
         except Exception as e:
             print(f"Failed to set log file log level: invalid level: '{logfile_log_level}'\n", e)
             return False
-        logfile_formatter = LogFormatter(fmt=log_line_template, color=logfile_log_color)
+        if log_format == "json":
+            logfile_formatter = JSONLogFormatter()
+        else:
+            logfile_formatter = LogFormatter(fmt=log_line_template, color=logfile_log_color)
         logfile_handler.setFormatter(logfile_formatter)
-        logger.addHandler(logfile_handler)
-        return True
\ No newline at end of file
+        if sample_rates:
+            _LOGGING_STATE["filter"] = SamplingFilter(sample_rates)
+            logger.addFilter(_LOGGING_STATE["filter"])
+        if queue_enabled is True:
+            log_queue = queue.Queue(maxsize=max(1, queue_size))
+            queue_handler = BoundedQueueHandler(log_queue, overflow=queue_overflow, sample_rate=queue_sample_rate)
+            listener = BoundedQueueListener(log_queue, console_handler, logfile_handler, respect_handler_level=True)
+            listener.start()
+            logger.addHandler(queue_handler)
+            _LOGGING_STATE["handlers"] = [queue_handler]
+            _LOGGING_STATE["listener"] = listener
+            # The listener also owns console_handler and logfile_handler, and closes them once it has written everything queued
+            _LOGGING_STATE["owned"] = [console_handler, logfile_handler]
+        else:
+            logger.addHandler(console_handler)
+            logger.addHandler(logfile_handler)
+            _LOGGING_STATE["handlers"] = [console_handler, logfile_handler]
+            _LOGGING_STATE["listener"] = None
+            _LOGGING_STATE["owned"] = []
+        if trace_ids is True:
+            for handler in _LOGGING_STATE["handlers"]:
+                handler.addFilter(TraceContextFilter())
+        _LOGGING_STATE["pid"] = os.getpid()
+        _LOGGING_STATE["args"] = args
+        if _FORK_HOOK_REGISTERED is False:
+            atexit.register(shutdown_logging)
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=_setup_logging_after_fork)
+            _FORK_HOOK_REGISTERED = True
+        return True
+
+def shutdown_logging():
+    """
+    Flush and stop the log queue listener, if any. Runs at exit
+    """
+    _remove_installed_handlers(logging.getLogger())
+
+def _remove_installed_handlers(logger):
+    for handler in _LOGGING_STATE["handlers"]:
+        logger.removeHandler(handler)
+    if _LOGGING_STATE["filter"] is not None:
+        logger.removeFilter(_LOGGING_STATE["filter"])
+        _LOGGING_STATE["filter"] = None
+    listener = _LOGGING_STATE["listener"]
+    # A forked child inherits the listener object but not its thread, so only the process that started it stops it
+    if listener is not None and _LOGGING_STATE["pid"] == os.getpid():
+        listener.stop()
+    for handler in _LOGGING_STATE["handlers"] + _LOGGING_STATE["owned"]:
+        handler.close()
+    _LOGGING_STATE["handlers"] = []
+    _LOGGING_STATE["listener"] = None
+    _LOGGING_STATE["owned"] = []
+
+def _setup_logging_after_fork():
+    args = _LOGGING_STATE["args"]
+    if args is None or (args["queue_enabled"] is not True and args["logfile_per_process"] is not True):
+        return
+    setup_logging(**args)
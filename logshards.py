@@ -0,0 +1,176 @@
+import logging, sys, zlib
+from urllib.parse import quote
+from utils import ConfigProvider
+
+class LogShardLayout:
+
+    VALID_MODES = ["monolithic", "per_client", "hashed"]
+
+    def __init__(self, base_path, mode=None, shard_count=None):
+        """
+        Maps log entries to the documents that hold them. Every layout stores entries with the same shape as the original
+        monolithic log document ({"clients": {client_id: ...}}), only spread over more documents:
+
+        monolithic: Everything in base_path. One hot document, capped at 1 MiB. The original layout.
+        per_client: One document per client at <base_path>/Clients/<client id>
+        hashed: log_shard_count documents at <base_path>/Shards/shard-NNN, picked by a stable hash of the client id
+
+        Functions:\n
+        -- -- -- -- -- --
+        doc_for_client(): Path and merge dict for one client's entry
+        read_combined(): Rebuild the combined {"clients": {...}} view from whichever documents the layout uses
+        read_layout_docs(): Read every document the layout uses, with its path
+        archive_path_for_client(): Path of the archive document for a client's entries from one month
+        migrate_from_monolithic(): Split the monolithic document into this layout's documents
+
+        :param str base_path: Path of the monolithic log document. Ex: "/Logging/Last Ping Log"
+        :param str mode: One of VALID_MODES. Defaults to log_shard_mode from the config
+        :param int shard_count: Number of shards in "hashed" mode. Defaults to log_shard_count from the config
+        """
+        self.__conf = ConfigProvider()
+        self.base_path = base_path
+        self.mode = mode if mode is not None else self.__conf.log_shard_mode
+        if self.mode not in self.VALID_MODES:
+            logging.error(f"LogShardLayout: Invalid log_shard_mode '{self.mode}'. Valid modes are {self.VALID_MODES}. Using 'monolithic'")
+            self.mode = "monolithic"
+        self.shard_count = max(1, shard_count if shard_count is not None else self.__conf.log_shard_count)
+
+    def doc_for_client(self, client_id, entry):
+        """
+        Get the document path and merge dict for a client's log entry
+
+        :param str client_id: Client Identifier
+        :param dict entry: The client's entry, ex: {"timestamp": ..., "last ip": ...}
+
+        :returns tuple: (path, part_dict) ready for StorageBackend.write_doc()
+        """
+        return self.path_for_client(client_id), {"clients": {client_id: entry}}
+
+    def path_for_client(self, client_id):
+        """
+        :param str client_id: Client Identifier
+
+        :returns str: Path of the document holding this client's entries
+        """
+        if self.mode == "per_client":
+            return f"{self.base_path}/Clients/{self.__doc_id(client_id)}"
+        elif self.mode == "hashed":
+            return self.__shard_path(zlib.crc32(str(client_id).encode("utf-8")) % self.shard_count)
+        return self.base_path
+
+    def shard_paths(self):
+        """
+        :returns list: Every shard document path in "hashed" mode, or [base_path] in "monolithic" mode. Empty in "per_client" mode since those are listed by reading the collection.
+        """
+        if self.mode == "hashed":
+            return [self.__shard_path(n) for n in range(self.shard_count)]
+        elif self.mode == "monolithic":
+            return [self.base_path]
+        return []
+
+    def archive_path_for_client(self, client_id, month):
+        """
+        :param str client_id: Client Identifier
+        :param str month: "YYYY-MM"
+
+        :returns str: Path of the document archiving this client's entries from that month. Ex: "<base_path> Archive/Months/2024-01/Clients/<client id>"
+        """
+        return f"{self.base_path} Archive/Months/{month}/Clients/{self.__doc_id(client_id)}"
+
+    def read_layout_docs(self, db):
+        """
+        Read every document the layout uses
+
+        :param db: StorageBackend instance
+
+        :returns list: (path, doc) tuples, or None if an error occured listing per-client documents
+        """
+        if self.mode == "per_client":
+            docs = db.read_collection(f"{self.base_path}/Clients/")
+            if docs is None:
+                return None
+            return [(f"{self.base_path}/Clients/{doc_id}", doc) for doc_id, doc in docs.items()]
+        # Shards that haven't been written yet don't exist, so unreadable shards are skipped
+        paths = self.shard_paths()
+        return [(path, doc) for path, doc in zip(paths, db.read_docs(paths)) if type(doc) is dict]
+
+    def read_combined(self, db):
+        """
+        Rebuild the old combined view of the log from the layout's documents
+
+        :param db: StorageBackend instance
+
+        :returns dict: {"clients": {client_id: entry, ...}} or None if an error occured listing per-client documents
+        """
+        docs = self.read_layout_docs(db)
+        if docs is None:
+            return None
+        combined = {}
+        for path, doc in docs:
+            clients = doc.get("clients", {})
+            if type(clients) is dict:
+                combined.update(clients)
+        return {"clients": combined}
+
+    def migrate_from_monolithic(self, db, delete_source=False):
+        """
+        Split the monolithic document at base_path into this layout's documents using batched writes.
+        Safe to run more than once since every write is a merge.
+
+        :param db: StorageBackend instance
+        :param bool delete_source: Delete the monolithic document once every entry has been copied
+
+        :returns int: Number of clients migrated, or None if an error occured
+        """
+        if self.mode == "monolithic":
+            logging.warning(f"LogShardLayout: migrate_from_monolithic: Layout for {self.base_path} is monolithic, nothing to migrate")
+            return 0
+        source = db.read_doc(self.base_path)
+        if type(source) is not dict:
+            logging.info(f"LogShardLayout: migrate_from_monolithic: No readable monolithic document at {self.base_path}, nothing to migrate")
+            return 0
+        grouped = {}
+        for client_id, entry in source.get("clients", {}).items():
+            path, part_dict = self.doc_for_client(client_id, entry)
+            if path not in grouped:
+                grouped[path] = {"clients": {}}
+            grouped[path]["clients"].update(part_dict["clients"])
+        results = db.write_docs(list(grouped.items()))
+        failed = [path for path, res in zip(grouped.keys(), results) if res is not True]
+        if len(failed) > 0:
+            logging.error(f"LogShardLayout: migrate_from_monolithic: {len(failed)} of {len(grouped)} shard writes failed for {self.base_path}. Source was left in place")
+            return None
+        migrated = len(source.get("clients", {}))
+        logging.info(f"LogShardLayout: migrate_from_monolithic: Migrated {migrated} clients from {self.base_path} into {len(grouped)} {self.mode} documents")
+        if delete_source is True and db.delete_doc(self.base_path) is not True:
+            logging.error(f"LogShardLayout: migrate_from_monolithic: Migration succeeded but deleting {self.base_path} failed")
+        return migrated
+
+    def __shard_path(self, n):
+        return f"{self.base_path}/Shards/shard-{n:03d}"
+
+    def __doc_id(self, client_id):
+        """
+        Make a Firestore-safe document id out of a client id. Ids are not reversed; the client id is kept in the document body.
+        """
+        doc_id = quote(str(client_id), safe=" ")
+        if doc_id in [".", ".."] or (doc_id.startswith("__") and doc_id.endswith("__")):
+            doc_id = "%" + doc_id
+        return doc_id
+
+if __name__ == "__main__":
+    # Usage: python logshards.py [--delete-source]
+    # Splits the monolithic ping and SMS log documents into the layout set by log_shard_mode in config.yml
+    from storage import get_backend
+    from clientutils import ClientUtils
+    logging.basicConfig(level=logging.INFO)
+    delete_source = "--delete-source" in sys.argv[1:]
+    db = get_backend()
+    if db is None or db.native_logs is True:
+        print("logshards: The configured database_type does not store logs as documents, nothing to migrate")
+        sys.exit(1 if db is None else 0)
+    failed = False
+    for path in [ClientUtils.PING_LOG_PATH, ClientUtils.SMS_LOG_PATH]:
+        if LogShardLayout(path).migrate_from_monolithic(db, delete_source=delete_source) is None:
+            failed = True
+    sys.exit(1 if failed else 0)
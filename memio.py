@@ -0,0 +1,194 @@
+import copy, logging, threading
+from utils import Singleton
+from storage import StorageBackend, register_backend, split_document_path, is_valid_collection_path, normalize_query, match_clause
+
+class MemoryStore(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Process-wide document store behind MemoryIO. Maps document paths to document dicts
+        """
+        self.docs = {}
+        self.lock = threading.RLock()
+
+    def clear(self):
+        """
+        Drop every document
+        """
+        with self.lock:
+            self.docs.clear()
+
+class MemoryIO(StorageBackend):
+
+    blocking = False
+
+    def __init__(self):
+        """
+        In-memory, thread-safe storage backend with FirestoreIO's path rules, merge rules and return values. Nothing is persisted
+        and nothing leaves the process, so the server runs with no credentials and no network. Meant for test mode and benchmarks.
+        Every MemoryIO in the process shares one MemoryStore. Documents are copied on the way in and out.
+        """
+        self.__store = MemoryStore()
+
+    def write_doc(self, path, write_dict):
+        """
+        Merge a document. See FirestoreIO.write_doc()
+
+        :returns: True if written, None if the path or write_dict is invalid
+        """
+        if type(write_dict) is not dict or split_document_path(path) is None:
+            logging.error(f"MemoryIO: write_doc: Invalid document path or write_dict for path {path}")
+            return None
+        write_dict = copy.deepcopy(write_dict)
+        with self.__store.lock:
+            if path in self.__store.docs:
+                self.__deep_merge(self.__store.docs[path], write_dict)
+            else:
+                self.__store.docs[path] = write_dict
+        return True
+
+    def write_docs(self, items):
+        """
+        Merge many documents under one lock. See FirestoreIO.write_docs()
+        """
+        with self.__store.lock:
+            return [self.write_doc(path, write_dict) for path, write_dict in items]
+
+    def read_doc(self, path):
+        """
+        :returns dict: Copy of the doc, or None if the path is invalid or the doc doesn't exist
+        """
+        if split_document_path(path) is None:
+            logging.error(f"MemoryIO: read_doc: Invalid document path: {path}")
+            return None
+        with self.__store.lock:
+            doc = self.__store.docs.get(path)
+            return copy.deepcopy(doc) if doc is not None else None
+
+    def read_docs(self, paths):
+        """
+        Read many documents under one lock. See FirestoreIO.read_docs()
+        """
+        results = []
+        with self.__store.lock:
+            for path in paths:
+                if split_document_path(path) is None:
+                    logging.error(f"MemoryIO: read_docs: Invalid document path: {path}")
+                    results.append(None)
+                elif path in self.__store.docs:
+                    results.append(copy.deepcopy(self.__store.docs[path]))
+                else:
+                    results.append(False)
+        return results
+
+    def check_exists(self, path):
+        """
+        :returns boolean: True if exists, False otherwise. None if the path is invalid
+        """
+        if split_document_path(path) is None:
+            return None
+        with self.__store.lock:
+            return path in self.__store.docs
+
+    def delete_doc(self, path, blind=False):
+        """
+        :param bool blind: Return True even if the document didn't exist. See FirestoreIO.delete_doc()
+
+        :returns: True if document is deleted, False if the document didn't exist, and None if the path is invalid
+        """
+        if split_document_path(path) is None:
+            logging.error(f"MemoryIO: delete_doc: Invalid document path: {path}")
+            return None
+        with self.__store.lock:
+            return self.__store.docs.pop(path, None) is not None or blind is True
+
+    def delete_docs(self, paths):
+        """
+        Delete many documents under one lock. See FirestoreIO.delete_docs()
+        """
+        results = []
+        with self.__store.lock:
+            for path in paths:
+                if split_document_path(path) is None:
+                    logging.error(f"MemoryIO: delete_docs: Invalid document path: {path}")
+                    results.append(None)
+                else:
+                    self.__store.docs.pop(path, None)
+                    results.append(True)
+        return results
+
+    def delete_fields(self, path, field_paths):
+        """
+        Delete fields from a document. See FirestoreIO.delete_fields()
+
+        :returns: True if deleted, False if the document doesn't exist, None if the path or a field path is invalid
+        """
+        if split_document_path(path) is None or type(field_paths) is not list or not all(type(f) is list and len(f) > 0 for f in field_paths):
+            logging.error(f"MemoryIO: delete_fields: Invalid document path {path} or field_paths {field_paths}")
+            return None
+        with self.__store.lock:
+            doc = self.__store.docs.get(path)
+            if doc is None:
+                return False
+            for field in field_paths:
+                self.__delete_field(doc, field)
+        return True
+
+    def copy_doc(self, from_path, to_path):
+        """
+        :returns: True if success, None if the source doesn't exist or a path is invalid
+        """
+        with self.__store.lock:
+            doc = self.read_doc(from_path)
+            if type(doc) is not dict:
+                logging.error("MemoryIO: copy_doc: An error occured trying to read doc to copy. Does doc exist?")
+                return None
+            if self.write_doc(to_path, doc) is not True:
+                return None
+        return True
+
+    def read_collection(self, collection_path):
+        """
+        :returns dict: Doc id -> doc dict for every doc directly in the collection. None if the path is invalid
+        """
+        return self.read_docs_by_query(collection_path, None)
+
+    def read_docs_by_query(self, collection_path, query_list):
+        """
+        :param str collection_path: Collection path. Must begin and end with a '/'
+        :param list query_list: [field, operator, value], or a list of them that must all match. Nested fields are separated by '.'. None matches every doc
+
+        :returns dict: Doc id -> doc dict for every match. None if the path or query is invalid
+        """
+        if not is_valid_collection_path(collection_path):
+            logging.error(f"MemoryIO: read_docs_by_query: Invalid collection path: {collection_path}")
+            return None
+        query = normalize_query(query_list, None, None, None, None)
+        if query is None:
+            logging.error(f"MemoryIO: read_docs_by_query: Invalid query_list {query_list}")
+            return None
+        res = {}
+        with self.__store.lock:
+            for path, doc in self.__store.docs.items():
+                split = split_document_path(path)
+                if split[0] != collection_path:
+                    continue
+                if all(match_clause(doc, clause) for clause in query[0]):
+                    res[split[1]] = copy.deepcopy(doc)
+        return res
+
+    def __delete_field(self, doc, field):
+        current = doc
+        for key in field[:-1]:
+            current = current.get(key) if type(current) is dict else None
+        if type(current) is dict:
+            current.pop(field[-1], None)
+
+    def __deep_merge(self, target, source):
+        for key, value in source.items():
+            if type(value) is dict and type(target.get(key)) is dict:
+                self.__deep_merge(target[key], value)
+            else:
+                target[key] = value
+
+register_backend("memory", MemoryIO)
@@ -0,0 +1,267 @@
+import atexit, bisect, glob, itertools, json, logging, os, threading, time, weakref
+from utils import ConfigProvider, Singleton, RepeatedTimer
+import instrumentation
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+METRIC_HELP = {
+    "app_http_requests_total": ("counter", "Requests handled, by route, method and status code"),
+    "app_http_request_duration_seconds": ("histogram", "Request latency, by route and method"),
+    "app_backend_call_duration_seconds": ("histogram", "Time spent in storage and SMS calls, by component and operation"),
+    "app_backend_call_errors_total": ("counter", "Storage and SMS calls that raised, by component and operation"),
+    "app_admission_rejections_total": ("counter", "Requests answered 429 by admission control, by route and reason")
+}
+
+class Metrics(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Process-wide request and backend call metrics, served in the Prometheus text format by /metrics when metrics_enabled is set.
+
+        Every thread counts into its own shard, so the hot path takes no lock; shards are only summed when metrics are scraped.
+        When a thread exits its shard is folded into a retired total, so short-lived request threads don't pile up shards.
+        With several gunicorn workers, set metrics_dir: each process writes its totals there every metrics_flush_interval seconds
+        and at exit, and a scrape of any worker adds up every process's file, so the numbers cover the whole server.
+
+        Functions:\n
+        -- -- -- -- -- --
+        inc(): Add to a counter
+        observe(): Record a value in a histogram
+        call_started(): instrumentation hook. Start timing an instrumented call
+        call_finished(): instrumentation hook. Record an instrumented call's latency and error
+        snapshot(): Totals of this process
+        flush(): Write this process's totals to metrics_dir
+        render(): Totals of every process in the Prometheus text format
+        """
+        self.__conf = ConfigProvider()
+        self.enabled = self.__conf.metrics_enabled
+        self.__metrics_dir = self.__conf.metrics_dir
+        self.__lock = threading.Lock()
+        self.__timer = None
+        # Not restarted by __reset(), so a finalizer left over from before a fork can't retire a new shard
+        self.__shard_ids = itertools.count()
+        self.__reset()
+        if self.enabled is not True:
+            return
+        if self.__metrics_dir != "":
+            try:
+                os.makedirs(self.__metrics_dir, exist_ok=True)
+            except Exception as e:
+                logging.error(f"Metrics: __init__: Unable to create metrics_dir {self.__metrics_dir}. Metrics will only cover this process")
+                logging.error(e)
+                self.__metrics_dir = ""
+        self.__start_flushing()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__after_fork)
+        instrumentation.register(self)
+
+    def inc(self, name, labels, value=1):
+        """
+        :param str name: Counter name
+        :param tuple labels: Tuple of (label, value) pairs
+        :param value: Amount to add
+        """
+        counters = self.__shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        :param str name: Histogram name
+        :param tuple labels: Tuple of (label, value) pairs
+        :param float value: Observed value, in seconds for the latency histograms
+        """
+        histograms = self.__shard()[1]
+        key = (name, labels)
+        hist = histograms.get(key)
+        if hist is None:
+            # One slot per bucket, one for values above the last bucket, then the sum
+            hist = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        hist[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        hist[-1] += value
+
+    def call_started(self, call):
+        """
+        :param instrumentation.InstrumentedCall call: The method being called
+
+        :returns: Start time, or None if the call isn't timed
+        """
+        if call.timed is not True:
+            return None
+        return time.perf_counter()
+
+    def call_finished(self, call, token, error):
+        """
+        :param instrumentation.InstrumentedCall call: The method that was called
+        :param token: call_started()'s return value
+        :param error: Exception the call raised, or None
+        """
+        if token is None:
+            return
+        labels = (("component", call.component), ("operation", call.operation))
+        if error is not None:
+            self.inc("app_backend_call_errors_total", labels)
+        self.observe("app_backend_call_duration_seconds", labels, time.perf_counter() - token)
+
+    def snapshot(self):
+        """
+        :returns dict: {"counters": {(name, labels): value}, "histograms": {(name, labels): slots}} summed over this process's threads
+        """
+        counters = {}
+        histograms = {}
+        with self.__lock:
+            shards = list(self.__shards.values())
+            # Retired totals only change under the lock, so they are summed while holding it
+            self.__merge_shard(counters, histograms, self.__retired)
+        for shard in shards:
+            self.__merge_shard(counters, histograms, shard)
+        return {"counters": counters, "histograms": histograms}
+
+    def __merge_shard(self, counters, histograms, shard):
+        shard_counters, shard_histograms = shard
+        for key, value in list(shard_counters.items()):
+            counters[key] = counters.get(key, 0) + value
+        for key, slots in list(shard_histograms.items()):
+            self.__add_slots(histograms, key, slots)
+
+    def render(self):
+        """
+        :returns str: Totals of this process, plus every other process's file in metrics_dir, in the Prometheus text format
+        """
+        totals = self.snapshot()
+        if self.__metrics_dir != "":
+            own_file = self.__file_path()
+            for path in glob.glob(os.path.join(self.__metrics_dir, "metrics_*.json")):
+                if path != own_file:
+                    self.__merge_file(totals, path)
+        return self.__format(totals)
+
+    def __shard(self):
+        shard = getattr(self.__local, "shard", None)
+        if shard is None:
+            shard = ({}, {})
+            key = next(self.__shard_ids)
+            # Only this thread's local holds the owner, so it is collected when the thread exits
+            owner = _ShardOwner()
+            finalizer = weakref.finalize(owner, self.__retire, key)
+            finalizer.atexit = False
+            with self.__lock:
+                self.__shards[key] = shard
+            self.__local.shard = shard
+            self.__local.owner = owner
+        return shard
+
+    def __retire(self, key):
+        """
+        Fold the shard of a thread that has exited into the retired totals
+        """
+        with self.__lock:
+            shard = self.__shards.pop(key, None)
+            if shard is not None:
+                self.__merge_shard(self.__retired[0], self.__retired[1], shard)
+
+    def __reset(self):
+        self.__local = threading.local()
+        self.__shards = {}
+        self.__retired = ({}, {})
+
+    def __add_slots(self, histograms, key, slots):
+        total = histograms.get(key)
+        if total is None:
+            histograms[key] = list(slots)
+        else:
+            for i, value in enumerate(slots):
+                total[i] += value
+
+    def __file_path(self):
+        return os.path.join(self.__metrics_dir, f"metrics_{os.getpid()}.json")
+
+    def __start_flushing(self):
+        if self.__metrics_dir == "":
+            return
+        self.__timer = RepeatedTimer(max(1.0, self.__conf.metrics_flush_interval), self.flush)
+        atexit.register(self.flush)
+
+    def flush(self):
+        """
+        Write this process's totals to its file in metrics_dir
+        """
+        if self.__metrics_dir == "":
+            return
+        totals = self.snapshot()
+        data = {
+            "counters": [[name, list(labels), value] for (name, labels), value in totals["counters"].items()],
+            "histograms": [[name, list(labels), slots] for (name, labels), slots in totals["histograms"].items()]
+        }
+        path = self.__file_path()
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.error(f"Metrics: flush: Unable to write {path}")
+            logging.error(e)
+
+    def __merge_file(self, totals, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"Metrics: __merge_file: Unable to read {path}")
+            logging.error(e)
+            return
+        for name, labels, value in data.get("counters", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            totals["counters"][key] = totals["counters"].get(key, 0) + value
+        for name, labels, slots in data.get("histograms", []):
+            if len(slots) == len(LATENCY_BUCKETS) + 2:
+                self.__add_slots(totals["histograms"], (name, tuple(tuple(pair) for pair in labels)), slots)
+
+    def __after_fork(self):
+        # The child starts from zero under its own pid; the parent's totals stay in the parent's file
+        self.__lock = threading.Lock()
+        self.__reset()
+        self.__timer = None
+        self.__start_flushing()
+
+    def __format(self, totals):
+        lines = []
+        by_name = {}
+        for (name, labels), value in totals["counters"].items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), slots in totals["histograms"].items():
+            by_name.setdefault(name, []).append((labels, slots))
+        for name in sorted(by_name.keys()):
+            kind, help_text = METRIC_HELP.get(name, ("counter", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != "histogram":
+                    lines.append(f"{name}{self.__labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.__labels(labels + (('le', str(bound)),))} {cumulative}")
+                cumulative += value[len(LATENCY_BUCKETS)]
+                lines.append(f"{name}_bucket{self.__labels(labels + (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{name}_sum{self.__labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{self.__labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def __labels(self, labels):
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(f'{k}="{self.__escape(v)}"' for k, v in labels) + "}"
+
+    def __escape(self, value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class _ShardOwner():
+    """
+    Held only by a thread's local storage, so it is collected when the thread exits. See Metrics.__shard()
+    """
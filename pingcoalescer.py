@@ -0,0 +1,151 @@
+import logging, os, threading, atexit
+from collections import OrderedDict
+from utils import ConfigProvider, Singleton, RepeatedTimer
+
+class PingCoalescer(metaclass=Singleton):
+
+    def __init__(self, sink):
+        """
+        Coalesces pings per Client ID before they reach the database. Within each ping_coalesce_window only the newest ping
+        per client is kept, and when the window closes only the fields that changed since that client's last write are handed to sink.
+        A ping whose write fails is kept for the next flush unless a newer ping from that client has arrived in the meantime.
+        A forked child starts with no pending pings and its own window timer.
+
+        Functions:\n
+        -- -- -- -- -- --
+        submit(): Record a ping
+        flush(): Write out the newest ping of every client seen since the last flush
+        get_stats(): Counters for received, absorbed and written pings
+
+        :param sink: Callable taking (client_id, changed_fields_dict) that writes a ping. Must return True on success. Only the first instance's sink is used.
+        """
+        self.__conf = ConfigProvider()
+        self.__sink = sink
+        self.__window = max(0.05, self.__conf.ping_coalesce_window)
+        self.__max_clients = max(1, self.__conf.ping_coalesce_max_clients)
+        self.__last_written = OrderedDict()
+        self.__start()
+        atexit.register(self.shutdown)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__start)
+
+    def __start(self):
+        """
+        Start with no pending pings, zeroed counters, fresh locks and a window timer. Also run in a forked child, where the
+        timer thread doesn't exist and the locks may have been held by one of the parent's threads
+        """
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__pending = {}
+        self.__overflow_flush_running = False
+        self.__stats = {
+            "received": 0,
+            "absorbed": 0,
+            "written": 0,
+            "unchanged": 0,
+            "failed": 0
+        }
+        self.__timer = RepeatedTimer(self.__window, self.flush)
+
+    def submit(self, client_id, timestamp, client_ip, client_version):
+        """
+        Record a ping. Replaces any ping from the same client that is still waiting in the current window.
+
+        :param str client_id: Client Identifier
+        :param str timestamp: Timestamp
+        :param str client_ip: Client IP Address
+        :param str client_version: Client software version number
+        """
+        fields = {
+            "timestamp": timestamp,
+            "last ip": client_ip,
+            "client version": client_version
+        }
+        with self.__lock:
+            self.__stats["received"] += 1
+            if client_id in self.__pending:
+                self.__stats["absorbed"] += 1
+            self.__pending[client_id] = fields
+            start_overflow_flush = len(self.__pending) >= self.__max_clients and self.__overflow_flush_running is False
+            if start_overflow_flush:
+                self.__overflow_flush_running = True
+        if start_overflow_flush:
+            threading.Thread(target=self.__overflow_flush, name="PingCoalescerFlush", daemon=True).start()
+
+    def flush(self):
+        """
+        Write out the newest ping of every client seen since the last flush, merging only the fields that changed
+
+        :returns int: Number of clients written
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                pending = self.__pending
+                self.__pending = {}
+            written = 0
+            for client_id, fields in pending.items():
+                last = self.__last_written.get(client_id, {})
+                changed = {}
+                for key, value in fields.items():
+                    if last.get(key) != value:
+                        changed[key] = value
+                if len(changed) == 0:
+                    with self.__lock:
+                        self.__stats["unchanged"] += 1
+                    continue
+                try:
+                    w_res = self.__sink(client_id, changed)
+                except Exception as e:
+                    logging.error(f"PingCoalescer: flush: An unknown exception occured writing PING from {client_id}")
+                    logging.error(e)
+                    w_res = False
+                if w_res is True:
+                    written += 1
+                    self.__remember(client_id, fields)
+                else:
+                    with self.__lock:
+                        self.__stats["failed"] += 1
+                        # Retry on the next flush, unless the client has pinged again since
+                        if client_id not in self.__pending:
+                            self.__pending[client_id] = fields
+            with self.__lock:
+                self.__stats["written"] += written
+            if len(pending) > 0:
+                logging.debug(f"PingCoalescer: flush: Wrote {written} of {len(pending)} clients. Totals: {self.get_stats()}")
+            return written
+
+    def shutdown(self):
+        """
+        Stop the window timer and flush whatever is still pending. Registered with atexit.
+        """
+        self.__timer.stop()
+        self.flush()
+
+    def __overflow_flush(self):
+        """
+        Flush triggered by submit() once ping_coalesce_max_clients clients are pending
+        """
+        try:
+            self.flush()
+        finally:
+            with self.__lock:
+                self.__overflow_flush_running = False
+
+    def get_stats(self):
+        """
+        Ping counters since startup. "absorbed" pings were replaced by a newer ping from the same client before being written,
+        "unchanged" ones matched what was already written, "written" ones reached the database and "failed" ones errored on write.
+
+        :returns dict: Copy of the counters
+        """
+        with self.__lock:
+            return dict(self.__stats)
+
+    def __remember(self, client_id, fields):
+        """
+        Remember the last written fields for a client, evicting the least recently written client past ping_coalesce_max_clients
+        """
+        self.__last_written[client_id] = fields
+        self.__last_written.move_to_end(client_id)
+        while len(self.__last_written) > self.__max_clients:
+            self.__last_written.popitem(last=False)
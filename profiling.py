@@ -0,0 +1,201 @@
+import cProfile, hmac, io, logging, os, pstats, random, re, sys, threading, time
+from collections import Counter
+from flask import request, g
+from utils import ConfigProvider, Singleton
+
+class RequestProfiler(metaclass=Singleton):
+
+    # Request header that profiles a single request when it carries profiling_header_token
+    HEADER = "X-Profile-Token"
+    # Deepest stack kept by the latency sampler
+    MAX_STACK_DEPTH = 64
+
+    def __init__(self):
+        """
+        Opt-in request profiling for the Flask app. Two ways to catch a slow request:
+
+        Sampled requests (profiling_sample_rate of them, or any request with an X-Profile-Token header matching profiling_header_token)
+        run under cProfile and dump a .prof file (open it with pstats or snakeviz) plus a .txt with time by function and the call tree.
+        cProfile only runs on one request at a time; others that get picked while it is busy go unprofiled.
+
+        With profiling_latency_threshold_ms, a sampler thread records the stacks of requests in flight every profiling_sample_interval_ms.
+        Requests that end up slower than the threshold dump those stacks as a .folded file (flamegraph input) plus a .txt with time by function.
+
+        Dumps go to profiling_dir, keeping the newest profiling_max_files files. install() only adds request hooks when profiling_enabled
+        is set or profiling_header_token is not empty, so an idle server pays nothing.
+
+        Functions:\n
+        -- -- -- -- -- --
+        install(): Add the profiling hooks to a Flask app
+        """
+        self.__conf = ConfigProvider()
+        self.__enabled = self.__conf.profiling_enabled is True
+        self.__sample_rate = max(0.0, min(1.0, self.__conf.profiling_sample_rate)) if self.__enabled else 0.0
+        self.__threshold = max(0.0, self.__conf.profiling_latency_threshold_ms) / 1000 if self.__enabled else 0.0
+        self.__interval = max(1.0, self.__conf.profiling_sample_interval_ms) / 1000
+        self.__token = self.__conf.profiling_header_token
+        self.__dir = self.__conf.profiling_dir
+        self.__max_files = max(2, self.__conf.profiling_max_files)
+        self.__cprofile_lock = threading.Lock()
+        self.__dump_lock = threading.Lock()
+        self.__in_flight = {}
+        self.__sampler = None
+
+    def install(self, app):
+        """
+        Add the profiling hooks to a Flask app. Does nothing if profiling is switched off
+
+        :param app: Flask app
+        """
+        if not self.__enabled and self.__token == "":
+            return
+        try:
+            os.makedirs(self.__dir, exist_ok=True)
+        except Exception as e:
+            logging.error(f"RequestProfiler: install: Unable to create profiling_dir {self.__dir}. Profiling is off")
+            logging.error(e)
+            return
+        app.before_request(self.__before_request)
+        app.teardown_request(self.__teardown_request)
+        if self.__threshold > 0:
+            self.__start_sampler()
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=self.__after_fork)
+        logging.info(f"RequestProfiler: install: Profiling to {self.__dir}. Sample rate {self.__sample_rate}, latency threshold {self.__threshold * 1000}ms, header {'on' if self.__token != '' else 'off'}")
+
+    def __start_sampler(self):
+        self.__sampler = threading.Thread(target=self.__sample_stacks, name="RequestProfilerSampler", daemon=True)
+        self.__sampler.start()
+
+    def __after_fork(self):
+        # The sampler thread doesn't survive a fork, and the locks may have been held by one of the parent's threads
+        self.__cprofile_lock = threading.Lock()
+        self.__dump_lock = threading.Lock()
+        self.__in_flight = {}
+        self.__start_sampler()
+
+    def __before_request(self):
+        g.profile_start = time.perf_counter()
+        if self.__wants_cprofile() and self.__cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                g.profiler = profiler
+            except Exception as e:
+                # Another profiler (ex: a debugger) is already active
+                self.__cprofile_lock.release()
+                logging.warning(f"RequestProfiler: __before_request: Unable to start cProfile: {e}")
+                return
+        elif self.__threshold > 0:
+            self.__in_flight[threading.get_ident()] = Counter()
+
+    def __teardown_request(self, exc):
+        start = g.get("profile_start")
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        profiler = g.get("profiler")
+        if profiler is not None:
+            profiler.disable()
+            g.profiler = None
+            self.__cprofile_lock.release()
+            self.__dump_cprofile(profiler, elapsed)
+            return
+        stacks = self.__in_flight.pop(threading.get_ident(), None)
+        if stacks is not None and elapsed >= self.__threshold:
+            self.__dump_stacks(stacks, elapsed)
+
+    def __wants_cprofile(self):
+        if self.__token != "":
+            token = request.headers.get(self.HEADER)
+            if token is not None and hmac.compare_digest(token, self.__token):
+                return True
+        return self.__sample_rate > 0 and random.random() < self.__sample_rate
+
+    def __sample_stacks(self):
+        """
+        Sampler thread. Adds the current stack of every tracked request thread to that request's counter
+        """
+        while True:
+            time.sleep(self.__interval)
+            if len(self.__in_flight) == 0:
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in list(self.__in_flight.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stacks[";".join(reversed(names))] += 1
+            del frames
+
+    def __dump_cprofile(self, profiler, elapsed):
+        base = self.__dump_base(elapsed)
+        try:
+            profiler.dump_stats(base + ".prof")
+            out = io.StringIO()
+            stats = pstats.Stats(profiler, stream=out)
+            out.write(f"{request.method} {request.path} took {elapsed * 1000:.2f}ms\n\n")
+            stats.sort_stats("tottime").print_stats(30)
+            stats.sort_stats("cumulative").print_stats(30)
+            stats.print_callees(30)
+            with open(base + ".txt", "w") as f:
+                f.write(out.getvalue())
+        except Exception as e:
+            logging.error(f"RequestProfiler: __dump_cprofile: Unable to write {base}")
+            logging.error(e)
+            return
+        self.__rotate()
+
+    def __dump_stacks(self, stacks, elapsed):
+        base = self.__dump_base(elapsed)
+        interval_ms = self.__interval * 1000
+        self_time = Counter()
+        total_time = Counter()
+        for stack, count in stacks.items():
+            names = stack.split(";")
+            self_time[names[-1]] += count
+            for name in set(names):
+                total_time[name] += count
+        try:
+            with open(base + ".folded", "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(base + ".txt", "w") as f:
+                f.write(f"{request.method} {request.path} took {elapsed * 1000:.2f}ms, {sum(stacks.values())} samples every {interval_ms:g}ms\n\n")
+                f.write("Self time by function (ms)\n")
+                for name, count in self_time.most_common(30):
+                    f.write(f"{count * interval_ms:10.1f}  {name}\n")
+                f.write("\nTotal time by function (ms)\n")
+                for name, count in total_time.most_common(30):
+                    f.write(f"{count * interval_ms:10.1f}  {name}\n")
+        except Exception as e:
+            logging.error(f"RequestProfiler: __dump_stacks: Unable to write {base}")
+            logging.error(e)
+            return
+        self.__rotate()
+
+    def __dump_base(self, elapsed):
+        route = re.sub(r"[^A-Za-z0-9]+", "_", request.path).strip("_") or "root"
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.__dir, f"{stamp}_{os.getpid()}_{threading.get_ident()}_{route}_{int(elapsed * 1000)}ms")
+
+    def __rotate(self):
+        """
+        Delete the oldest dumps past profiling_max_files
+        """
+        with self.__dump_lock:
+            try:
+                paths = [os.path.join(self.__dir, name) for name in os.listdir(self.__dir)]
+                paths.sort(key=os.path.getmtime)
+                for path in paths[:max(0, len(paths) - self.__max_files)]:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.error(f"RequestProfiler: __rotate: Unable to rotate {self.__dir}")
+                logging.error(e)
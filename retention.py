@@ -0,0 +1,208 @@
+import logging, os, sys, threading, atexit
+from datetime import datetime, timedelta
+from utils import ConfigProvider, Singleton, RepeatedTimer, RateLimiter
+from storage import get_backend
+from logshards import LogShardLayout
+from clientutils import ClientUtils
+
+class LogRetention(metaclass=Singleton):
+
+    # Format of the log timestamps, see utils.get_timestamp(). Fixed width, so timestamps compare correctly as strings
+    TIMESTAMP_FORMAT = "%Y-%m-%d-%H:%M:%S"
+
+    def __init__(self):
+        """
+        Retention job for the SMS and ping logs. SMS entries older than sms_log_max_age_days, or past the newest
+        sms_log_max_entries_per_client of their client, expire. So do ping log clients that haven't pinged in ping_log_max_age_days.
+        With log_retention_archive, expired entries are first merged into compact archive documents, one per client per month
+        (see LogShardLayout.archive_path_for_client()), or into the archive tables on native_logs backends.
+
+        Documents are handled log_retention_batch_size at a time, with each batch's archive writes committed together, and
+        passes are capped at log_retention_rate writes per second so a large backlog doesn't crowd out request traffic.
+        Entries whose key isn't a log timestamp are never touched.
+
+        Run it every log_retention_interval seconds with start() (the server does when log_retention_enabled is set), or once
+        from cron with `python retention.py [--dry-run]`. With several gunicorn workers, prefer cron: each worker runs its own timer,
+        including workers forked from a --preload master after start().
+
+        Functions:\n
+        -- -- -- -- -- --
+        run(): Run one retention pass over both logs
+        start(): Run a pass every log_retention_interval seconds
+        stop(): Stop the timer
+        """
+        self.__conf = ConfigProvider()
+        self.__backend = None
+        self.__sms_layout = LogShardLayout(ClientUtils.SMS_LOG_PATH)
+        self.__ping_layout = LogShardLayout(ClientUtils.PING_LOG_PATH)
+        self.__batch_size = max(1, self.__conf.log_retention_batch_size)
+        rate = self.__conf.log_retention_rate
+        self.__limiter = RateLimiter(rate, burst=max(rate, self.__batch_size * 2))
+        self.__run_lock = threading.Lock()
+        self.__timer = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__after_fork)
+
+    @property
+    def __db(self):
+        # Looked up on first use, so start() at import doesn't load the backend's client library before a fork
+        if self.__backend is None:
+            self.__backend = get_backend(self.__conf.database_type)
+        return self.__backend
+
+    def start(self):
+        """
+        Run a retention pass every log_retention_interval seconds, in the background
+        """
+        if self.__timer is None:
+            self.__timer = RepeatedTimer(max(1.0, self.__conf.log_retention_interval), self.run)
+            atexit.register(self.stop)
+
+    def __after_fork(self):
+        # The timer thread doesn't survive a fork, and a pass running in the parent may have held the run lock
+        self.__run_lock = threading.Lock()
+        if self.__timer is not None:
+            self.__timer = RepeatedTimer(max(1.0, self.__conf.log_retention_interval), self.run)
+
+    def stop(self):
+        """
+        Stop the timer. A pass that is already running finishes
+        """
+        if self.__timer is not None:
+            self.__timer.stop()
+            self.__timer = None
+
+    def run(self, dry_run=False):
+        """
+        Run one retention pass over the SMS and ping logs. Skipped if a pass is already running
+
+        :param bool dry_run: Only count what would expire. Not supported on native_logs backends
+
+        :returns dict: {"docs_scanned": int, "sms_expired": int, "pings_expired": int, "failed": int}, or None if the pass couldn't run
+        """
+        if self.__db is None:
+            logging.error(f"LogRetention: run: database_type {self.__conf.database_type} not currently supported.")
+            return None
+        if not self.__run_lock.acquire(blocking=False):
+            logging.warning("LogRetention: run: A retention pass is already running, skipping this one")
+            return None
+        try:
+            sms_cutoff = self.__cutoff(self.__conf.sms_log_max_age_days)
+            ping_cutoff = self.__cutoff(self.__conf.ping_log_max_age_days)
+            max_entries = max(0, self.__conf.sms_log_max_entries_per_client)
+            stats = {"docs_scanned": 0, "sms_expired": 0, "pings_expired": 0, "failed": 0}
+            if self.__db.native_logs is True:
+                if dry_run is True:
+                    logging.error("LogRetention: run: dry_run is not supported on native_logs backends")
+                    return None
+                res = self.__db.expire_logs(sms_cutoff, max_entries, ping_cutoff, archive=self.__conf.log_retention_archive,
+                                            batch_size=self.__batch_size, limiter=self.__limiter)
+                if res is None:
+                    stats["failed"] += 1
+                else:
+                    stats.update(res)
+            else:
+                if sms_cutoff is not None or max_entries > 0:
+                    self.__run_layout(self.__sms_layout, "sms_expired", lambda doc: self.__expired_sms(doc, sms_cutoff, max_entries), stats, dry_run)
+                if ping_cutoff is not None:
+                    self.__run_layout(self.__ping_layout, "pings_expired", lambda doc: self.__expired_pings(doc, ping_cutoff), stats, dry_run)
+            logging.info(f"LogRetention: run: {'Dry run' if dry_run else 'Retention pass'} finished: {stats}")
+            return stats
+        finally:
+            self.__run_lock.release()
+
+    def __run_layout(self, layout, stat, find_expired, stats, dry_run):
+        """
+        Expire entries from every document of a log layout, log_retention_batch_size documents at a time
+
+        :param find_expired: Callable taking a log document and returning a list of (field_path, archive_path, client_id, key, entry)
+        """
+        docs = layout.read_layout_docs(self.__db)
+        if docs is None:
+            logging.error(f"LogRetention: __run_layout: Unable to list the documents of {layout.base_path}")
+            stats["failed"] += 1
+            return
+        for start in range(0, len(docs), self.__batch_size):
+            plan = []
+            for path, doc in docs[start:start + self.__batch_size]:
+                stats["docs_scanned"] += 1
+                expired = find_expired(doc)
+                if len(expired) > 0:
+                    plan.append((path, expired))
+            if len(plan) == 0:
+                continue
+            if dry_run is True:
+                stats[stat] += sum(len(expired) for path, expired in plan)
+                continue
+            archived = {}
+            if self.__conf.log_retention_archive is True:
+                grouped = {}
+                for path, expired in plan:
+                    for field_path, archive_path, client_id, key, entry in expired:
+                        clients = grouped.setdefault(archive_path, {"clients": {}})["clients"]
+                        if key is None:
+                            clients[client_id] = entry
+                        else:
+                            clients.setdefault(client_id, {})[key] = entry
+                self.__limiter.acquire(len(grouped))
+                archived = dict(zip(grouped.keys(), self.__db.write_docs(list(grouped.items()))))
+            for path, expired in plan:
+                # Only drop entries from a document once all of its archive writes went through
+                if self.__conf.log_retention_archive is True and not all(archived.get(e[1]) is True for e in expired):
+                    logging.error(f"LogRetention: __run_layout: Archiving entries from {path} failed, leaving them in place")
+                    stats["failed"] += 1
+                    continue
+                self.__limiter.acquire(1)
+                if self.__db.delete_fields(path, [e[0] for e in expired]) is True:
+                    stats[stat] += len(expired)
+                else:
+                    logging.error(f"LogRetention: __run_layout: Deleting {len(expired)} expired entries from {path} failed")
+                    stats["failed"] += 1
+
+    def __expired_sms(self, doc, cutoff, max_entries):
+        expired = []
+        for client_id, entries in self.__clients(doc).items():
+            if type(entries) is not dict:
+                continue
+            timestamps = sorted([ts for ts in entries.keys() if self.__is_timestamp(ts)], reverse=True)
+            for n, ts in enumerate(timestamps):
+                if (cutoff is not None and ts < cutoff) or (max_entries > 0 and n >= max_entries):
+                    expired.append((["clients", client_id, ts], self.__sms_layout.archive_path_for_client(client_id, ts[:7]), client_id, ts, entries[ts]))
+        return expired
+
+    def __expired_pings(self, doc, cutoff):
+        # A client that pings between the read and the delete loses that ping until its next one
+        expired = []
+        for client_id, entry in self.__clients(doc).items():
+            ts = entry.get("timestamp") if type(entry) is dict else None
+            if self.__is_timestamp(ts) and ts < cutoff:
+                expired.append((["clients", client_id], self.__ping_layout.archive_path_for_client(client_id, ts[:7]), client_id, None, entry))
+        return expired
+
+    def __clients(self, doc):
+        clients = doc.get("clients") if type(doc) is dict else None
+        return clients if type(clients) is dict else {}
+
+    def __cutoff(self, days):
+        """
+        :returns str: Timestamp days ago, or None if days is 0 or less
+        """
+        if days <= 0:
+            return None
+        return (datetime.now() - timedelta(days=days)).strftime(self.TIMESTAMP_FORMAT)
+
+    def __is_timestamp(self, value):
+        if type(value) is not str or len(value) != 19:
+            return False
+        try:
+            datetime.strptime(value, self.TIMESTAMP_FORMAT)
+            return True
+        except ValueError:
+            return False
+
+if __name__ == "__main__":
+    # Usage: python retention.py [--dry-run]
+    # Runs one retention pass over the SMS and ping logs using the limits in config.yml. Suitable for cron
+    logging.basicConfig(level=logging.INFO)
+    stats = LogRetention().run(dry_run="--dry-run" in sys.argv[1:])
+    sys.exit(0 if stats is not None and stats["failed"] == 0 else 1)
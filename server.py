@@ -1,11 +1,15 @@
-from auth import AuthHolder
-import os, sys, logging
-from sms_utils import TwilioDispatcher
+import os, sys, time, logging
+from sms_utils import TwilioDispatcher, SMSBroadcaster
 from clientutils import ClientUtils
-from flask import Flask, request
+from sms_queue import SMSDispatchQueue
+from metrics import Metrics
+from profiling import RequestProfiler
+from tracing import Tracer
+from admission import AdmissionController
+from flask import Flask, request, g
 from flask_classful import FlaskView, route
 from utils import *
-from loggingutils import LoggingUtils, setup_logging
+from bootstrap import init_process
 
 config = ConfigProvider()
 HOST = config.host
@@ -13,22 +17,78 @@ PORT = config.port
 DEBUG = config.debug_mode
 
 app = Flask(__name__)
-AuthHolder()
-log = LoggingUtils()
-log.print_startup_message()
-def init_logger():
-
-    server_start_time = get_timestamp()
-    try:
-        server_logfile_name = f"{config.logfile_name}_{server_start_time}"
-    except:
-        server_logfile_name = f"demo_app_server_{server_start_time}"
-    if (not setup_logging(console_log_output="stdout", console_log_level=config.console_log_level, console_log_color=config.console_log_color,
-                        logfile_file=server_logfile_name + ".log", logfile_log_level=config.logfile_log_level, logfile_log_color=config.logfile_log_color,
-                        log_line_template="%(color_on)s[%(asctime)s] [%(threadName)s] [%(levelname)-8s] %(message)s%(color_off)s")):
-        print("Failed to setup logging, aborting.")
-        return 1
-init_logger()
+# Runs once per process on import
+init_process()
+
+RequestProfiler().install(app)
+
+if config.tracing_enabled is True:
+    tracer = Tracer()
+
+    @app.before_request
+    def start_trace():
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        g.trace_span = tracer.start_request(request.headers, f"{request.method} {route}")
+
+    @app.after_request
+    def tag_trace(response):
+        span = g.get("trace_span")
+        if span is not None:
+            span.tags["http.method"] = request.method
+            span.tags["http.path"] = request.path
+            span.tags["http.status_code"] = response.status_code
+            response.headers["X-Request-ID"] = span.tags.get("request_id", span.trace_id)
+        return response
+
+    @app.teardown_request
+    def end_trace(exc):
+        span = g.pop("trace_span", None)
+        if span is not None:
+            tracer.end_span(span, error=exc)
+
+if config.log_request_events is True or config.metrics_enabled is True:
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        latency = time.perf_counter() - g.get("request_start", time.perf_counter())
+        if config.metrics_enabled is True:
+            # The url rule rather than the path, so unknown paths can't grow the number of series
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            metrics = Metrics()
+            metrics.inc("app_http_requests_total", (("route", route), ("method", request.method), ("status", str(response.status_code))))
+            metrics.observe("app_http_request_duration_seconds", (("route", route), ("method", request.method)), latency)
+        if config.log_request_events is True:
+            latency_ms = round(latency * 1000, 2)
+            body_json = request.get_json(silent=True)
+            cid = body_json.get("Client ID") if type(body_json) is dict else None
+            logging.debug("%s %s %s %sms", request.method, request.path, response.status_code, latency_ms,
+                          extra={"event": "request", "route": request.path, "status": response.status_code, "latency_ms": latency_ms, "client_id": cid})
+        return response
+
+if config.admission_enabled is True:
+    admission = AdmissionController()
+
+    @app.before_request
+    def admit_request():
+        if request.url_rule is None:
+            return None
+        body_json = request.get_json(silent=True)
+        cid = body_json.get("Client ID") if type(body_json) is dict else None
+        rejection = admission.admit(request.url_rule.rule, cid, request.remote_addr)
+        if rejection is None:
+            g.admitted_route = request.url_rule.rule
+            return None
+        retry_after, reason = rejection
+        return RequestUtils().failure_template(f"Too many requests ({reason} limit). Retry in {retry_after} seconds"), 429, {"Retry-After": str(retry_after)}
+
+    @app.teardown_request
+    def release_admission(exc):
+        route = g.pop("admitted_route", None)
+        if route is not None:
+            admission.release(route)
 
 class RequestHandler(FlaskView):
     route_base = '/'
@@ -42,6 +102,10 @@ class RequestHandler(FlaskView):
         self.__r_utils = RequestUtils()
         self.__c_utils = ClientUtils()
         self.__td = TwilioDispatcher()
+        if self.__conf.sms_dispatch_mode == "queued":
+            self.__sms_queue = SMSDispatchQueue()
+        else:
+            self.__sms_queue = None
 
     @route('/api/ping', methods=['POST'])
     def ping(self):
@@ -60,14 +124,15 @@ class RequestHandler(FlaskView):
             ip = request.remote_addr
             cid = body_json["Client ID"]
             v = body_json["Software Version"]
-            logging.info(f"{ts}: PING from {cid} @ {ip} v{v}")
+            logging.info("%s: PING from %s @ %s v%s", ts, cid, ip, v, extra={"event": "ping", "client_id": cid, "route": "/api/ping"})
             self.__c_utils.log_client_ping(ts, cid, ip, v)
             return self.__r_utils.blank_success_template()
 
     @route('/api/send_test_message', methods=['POST'])
     def send_text(self):
         """
-        Send a text to a phone number
+        Send a text to a phone number. With sms_dispatch_mode set to "queued" the message is queued and a 202 with its
+        "Message ID" is returned right away; look up the result with /api/sms_status.
         """
         mandatory_keys = ["Client ID", "SMS Body", "Phone"]
         v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
@@ -77,6 +142,11 @@ class RequestHandler(FlaskView):
             body_json = request.get_json()
             message_body = body_json["SMS Body"]
             to_phone = body_json["Phone"]
+            if self.__sms_queue is not None:
+                message_id = self.__sms_queue.enqueue(body_json["Client ID"], message_body, to_phone)
+                if message_id is None:
+                    return self.__r_utils.failure_template("SMS queue is full, try again later"), 503
+                return self.__r_utils.queued_template(message_id), 202
             t_res = self.__td.dispatch(message_body, to_phone)
             timestamp = get_timestamp()
             self.__c_utils.log_sms_sent(timestamp, body_json["Client ID"], message_body, to_phone, t_res)
@@ -85,11 +155,73 @@ class RequestHandler(FlaskView):
             else:
                 return self.__r_utils.blank_success_template()
 
+    @route('/api/broadcast_message', methods=['POST'])
+    def broadcast_text(self):
+        """
+        Send one text to a list of phone numbers. Sends fan out over the broadcast thread pool under the sms_broadcast_rate cap,
+        and the per-recipient results are logged with a single write. A broadcast must be able to finish within sms_broadcast_max_wait:
+        more recipients than the cap allows in that time are refused, and a 503 is returned while other broadcasts hold the send slots.
+
+        Required Keys: "Client ID" (str), "SMS Body" (str), "Phones" (list of str)
+        """
+        mandatory_keys = ["Client ID", "SMS Body", "Phones"]
+        v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
+        if v is not True:
+            return v
+        body_json = request.get_json()
+        phones = body_json["Phones"]
+        if type(phones) is not list or len(phones) == 0 or not all(type(phone) is str for phone in phones):
+            return self.__r_utils.failure_template_null_values(["Phones"])
+        broadcaster = SMSBroadcaster()
+        max_recipients = broadcaster.max_recipients()
+        if len(phones) > max_recipients:
+            return self.__r_utils.failure_template(f"Too many recipients. The limit is {max_recipients}")
+        message_body = body_json["SMS Body"]
+        results = broadcaster.broadcast(message_body, phones)
+        if results is None:
+            return self.__r_utils.failure_template("Too many broadcasts in progress, try again later"), 503
+        self.__c_utils.log_sms_broadcast(get_timestamp(), body_json["Client ID"], message_body, results)
+        sent = sum(1 for res in results.values() if res is True)
+        if sent == 0:
+            res = self.__r_utils.failure_template("An unknown error occured trying to send SMS")
+        else:
+            res = self.__r_utils.blank_success_template()
+        res["Results"] = results
+        res["Sent"] = sent
+        res["Failed"] = len(results) - sent
+        return res
+
+    @route('/api/sms_status', methods=['POST'])
+    def sms_status(self):
+        """
+        Look up a message queued by /api/send_test_message. 404 unless "Client ID" is the client that queued it
+
+        Required Keys: "Client ID" (str), "Message ID" (str)
+        """
+        mandatory_keys = ["Client ID", "Message ID"]
+        v = self.__r_utils.combined_key_value_checks(mandatory_keys, request)
+        if v is not True:
+            return v
+        if self.__sms_queue is None:
+            return self.__r_utils.failure_template("SMS dispatch is not queued on this server"), 400
+        body_json = request.get_json()
+        status = self.__sms_queue.get_status(body_json["Message ID"], body_json["Client ID"])
+        if status is None:
+            return self.__r_utils.failure_template("Unknown Message ID"), 404
+        res = self.__r_utils.blank_success_template()
+        res.update(status)
+        return res
+
+    @route('/metrics', methods=['GET'])
+    def metrics(self):
+        """
+        Request counts, per-route latency histograms and Firestore/Twilio call timings in the Prometheus text format. 404 unless metrics_enabled is set
+        """
+        if self.__conf.metrics_enabled is not True:
+            return self.__r_utils.failure_template("Metrics are not enabled on this server"), 404
+        return Metrics().render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 RequestHandler.register(app)
 
 if __name__ == '__main__':
-    AuthHolder()
-    log = LoggingUtils()
-    log.print_startup_message()
-    init_logger()
     app.run(debug=DEBUG, host=HOST, port=PORT)
\ No newline at end of file
@@ -0,0 +1,144 @@
+import logging, os, threading, queue, uuid, atexit, time
+from collections import OrderedDict
+from utils import ConfigProvider, Singleton, get_timestamp
+from sms_utils import TwilioDispatcher
+from clientutils import ClientUtils
+
+class SMSDispatchQueue(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Queued SMS dispatch. Requests enqueue a message and get a message ID back right away, while a bounded pool of
+        sender threads drains the queue, sends through TwilioDispatcher and logs results through ClientUtils.log_sms_sent().
+
+        Message statuses are kept in memory for the last sms_status_retention messages and are per process, so under
+        gunicorn a status lookup has to reach the worker that accepted the message. A forked child (ex: a worker of a --preload
+        master) starts with an empty queue and its own sender threads.
+
+        Functions:\n
+        -- -- -- -- -- --
+        enqueue(): Queue a message for sending
+        get_status(): Look up a message by ID
+        shutdown(): Stop accepting messages and give the senders time to drain the queue
+        """
+        self.__conf = ConfigProvider()
+        self.__max_statuses = max(1, self.__conf.sms_status_retention)
+        self.__closed = False
+        self.__start()
+        atexit.register(self.shutdown)
+        if hasattr(os, "register_at_fork"):
+            # The sender threads don't survive a fork, so a child that inherits the queue needs its own
+            os.register_at_fork(after_in_child=self.__start)
+
+    def __start(self):
+        """
+        Start with an empty queue and no statuses, and start the sender threads. Messages the parent had queued are left for the parent to send
+        """
+        self.__queue = queue.Queue(maxsize=max(1, self.__conf.sms_queue_depth))
+        self.__statuses = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__workers = []
+        for n in range(max(1, self.__conf.sms_worker_count)):
+            worker = threading.Thread(target=self.__worker_loop, name=f"SMSSender-{n}", daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def enqueue(self, client_id, message_body, to_phone):
+        """
+        Queue a message for sending
+
+        :param str client_id: Client Identifier of the requester
+        :param str message_body: String formatted message body
+        :param str to_phone: Phone to send the SMS to
+
+        :returns str: The message ID, or None if the queue is full or shutting down
+        """
+        if self.__closed:
+            return None
+        message_id = uuid.uuid4().hex
+        self.__set_status(message_id, {
+            "SMS Status": "Queued",
+            "Client ID": client_id,
+            "Phone": to_phone,
+            "Queued At": get_timestamp()
+        })
+        try:
+            self.__queue.put_nowait((message_id, client_id, message_body, to_phone))
+        except queue.Full:
+            logging.warning(f"SMSDispatchQueue: enqueue: Queue is full ({self.__queue.maxsize} messages). Rejecting SEND_TEXT from {client_id}")
+            with self.__lock:
+                self.__statuses.pop(message_id, None)
+            return None
+        return message_id
+
+    def get_status(self, message_id, client_id):
+        """
+        Look up a message by ID. Only the client that queued a message can see it
+
+        :param str message_id: ID returned by enqueue()
+        :param str client_id: Client Identifier of the requester
+
+        :returns dict: Copy of the message's status, or None if the ID is unknown, has aged out or was queued by another client
+        """
+        with self.__lock:
+            status = self.__statuses.get(message_id)
+            if status is None or status["Client ID"] != client_id:
+                return None
+            return dict(status)
+
+    def shutdown(self, timeout=10.0):
+        """
+        Stop accepting messages and wait up to timeout seconds for the senders to finish what is already queued. Registered with atexit.
+
+        :param float timeout: Seconds to wait in total
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        for worker in self.__workers:
+            try:
+                self.__queue.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        deadline = time.monotonic() + timeout
+        for worker in self.__workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        if self.__queue.qsize() > 0:
+            logging.warning(f"SMSDispatchQueue: shutdown: {self.__queue.qsize()} messages were still queued at exit")
+
+    def __worker_loop(self):
+        """
+        Sender thread. Sends queued messages until it receives the None sentinel from shutdown()
+        """
+        td = TwilioDispatcher()
+        c_utils = ClientUtils()
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                return
+            message_id, client_id, message_body, to_phone = job
+            self.__update_status(message_id, {"SMS Status": "Sending"})
+            try:
+                t_res = td.dispatch(message_body, to_phone)
+            except Exception as e:
+                logging.error(f"SMSDispatchQueue: __worker_loop: An unknown exception occured sending message {message_id}")
+                logging.error(e)
+                t_res = False
+            timestamp = get_timestamp()
+            self.__update_status(message_id, {"SMS Status": "Sent" if t_res is True else "Failed", "Finished At": timestamp})
+            try:
+                c_utils.log_sms_sent(timestamp, client_id, message_body, to_phone, t_res)
+            except Exception as e:
+                logging.error(f"SMSDispatchQueue: __worker_loop: An unknown exception occured logging message {message_id}")
+                logging.error(e)
+
+    def __set_status(self, message_id, status):
+        with self.__lock:
+            self.__statuses[message_id] = status
+            while len(self.__statuses) > self.__max_statuses:
+                self.__statuses.popitem(last=False)
+
+    def __update_status(self, message_id, fields):
+        with self.__lock:
+            if message_id in self.__statuses:
+                self.__statuses[message_id].update(fields)
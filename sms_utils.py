@@ -1,6 +1,8 @@
-import logging
+import logging, contextvars, os, time
+from concurrent.futures import ThreadPoolExecutor
 from auth import AuthHolder
-from utils import ConfigProvider
+from utils import ConfigProvider, Singleton, RateLimiter
+from instrumentation import instrument
 
 class TwilioDispatcher():
 
@@ -10,7 +12,11 @@ class TwilioDispatcher():
         """
         self.__conf = ConfigProvider()
         self.__auth = AuthHolder()
-        self.__tw = self.__auth.twilio
+
+    @property
+    def __tw(self):
+        # Fetched on every send instead of in __init__, so requests that never send SMS never create the Twilio client
+        return self.__auth.twilio
 
     def dispatch(self, message_body, to_phone, twilio_msg_obj=None):
         """
@@ -41,4 +47,68 @@ class TwilioDispatcher():
             except Exception as e:
                 logging.error("An issue occured trying to construct or send an SMS via Twilio.\n", e)
                 return False
-        
\ No newline at end of file
+
+instrument(TwilioDispatcher, "twilio", ["dispatch"], kind="CLIENT")
+
+class SMSBroadcaster(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Sends one message to many phones over a bounded pool of sms_broadcast_workers threads. Sends from every broadcast in
+        the process share one sms_broadcast_rate messages/second cap so we stay under Twilio's account rate limit.
+
+        Each broadcast reserves its send slots up front and is refused if the last one is more than sms_broadcast_max_wait seconds
+        away, so a request never outlives the worker timeout waiting on the rate cap.
+
+        Functions:\n
+        -- -- -- -- -- --
+        max_recipients(): Most recipients one broadcast can have
+        broadcast(): Send a message to many phones
+        """
+        self.__conf = ConfigProvider()
+        self.__td = TwilioDispatcher()
+        self.__start()
+        if hasattr(os, "register_at_fork"):
+            # The pool's threads don't survive a fork, so a child that inherits the broadcaster needs its own
+            os.register_at_fork(after_in_child=self.__start)
+
+    def __start(self):
+        self.__pool = ThreadPoolExecutor(max_workers=max(1, self.__conf.sms_broadcast_workers), thread_name_prefix="SMSBroadcast")
+        self.__limiter = RateLimiter(self.__conf.sms_broadcast_rate)
+
+    def max_recipients(self):
+        """
+        :returns int: sms_broadcast_max_recipients, or fewer if sms_broadcast_rate can't send that many within sms_broadcast_max_wait
+        """
+        return int(min(self.__conf.sms_broadcast_max_recipients, self.__limiter.capacity(self.__conf.sms_broadcast_max_wait)))
+
+    def broadcast(self, message_body, to_phones):
+        """
+        Send a message to every phone in to_phones. Blocks until every send has finished.
+
+        :param str message_body: String formatted message body
+        :param list to_phones: Phones to send the SMS to. Duplicates are sent once
+
+        :returns dict: Phone -> True if sent, False if an exception occurred. None if the sends couldn't be scheduled within
+                       sms_broadcast_max_wait behind other broadcasts; nothing was sent
+        """
+        phones = list(dict.fromkeys(to_phones))
+        waits = self.__limiter.reserve(len(phones), self.__conf.sms_broadcast_max_wait)
+        if waits is None:
+            logging.warning(f"SMSBroadcaster: broadcast: {len(phones)} sends don't fit in sms_broadcast_max_wait behind other broadcasts. Refusing")
+            return None
+        start = time.monotonic()
+        # Each send runs in a copy of the caller's context, so its spans land in the request's trace
+        futures = [self.__pool.submit(contextvars.copy_context().run, self.__send_one, message_body, phone, start + wait) for phone, wait in zip(phones, waits)]
+        return {phone: future.result() for phone, future in zip(phones, futures)}
+
+    def __send_one(self, message_body, to_phone, send_at):
+        delay = send_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            return self.__td.dispatch(message_body, to_phone)
+        except Exception as e:
+            logging.error(f"SMSBroadcaster: __send_one: An unknown exception occured sending to {to_phone}")
+            logging.error(e)
+            return False
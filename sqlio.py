@@ -1,12 +1,518 @@
-import sqlite3
+import json, logging, time
 from auth import AuthHolder
+from storage import StorageBackend, register_backend, split_document_path, is_valid_collection_path
 
-class SQLLiteIO():
+class SQLLiteIO(StorageBackend):
+
+    native_logs = True
+
+    _SCHEMA_READY = False
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, collection TEXT NOT NULL, name TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection)",
+        "CREATE TABLE IF NOT EXISTS ping_log (client_id TEXT PRIMARY KEY, timestamp TEXT, last_ip TEXT, client_version TEXT)",
+        "CREATE INDEX IF NOT EXISTS ping_log_timestamp ON ping_log (timestamp)",
+        "CREATE TABLE IF NOT EXISTS sms_log (id INTEGER PRIMARY KEY AUTOINCREMENT, client_id TEXT NOT NULL, timestamp TEXT NOT NULL, message_contents TEXT, to_phone TEXT, success INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sms_log_client_timestamp ON sms_log (client_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS sms_log_timestamp ON sms_log (timestamp)",
+        "CREATE TABLE IF NOT EXISTS sms_log_archive (id INTEGER PRIMARY KEY, client_id TEXT NOT NULL, timestamp TEXT NOT NULL, message_contents TEXT, to_phone TEXT, success INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS ping_log_archive (client_id TEXT PRIMARY KEY, timestamp TEXT, last_ip TEXT, client_version TEXT)"
+    ]
+
+    # Statements are kept constant so sqlite3's per-connection statement cache reuses the prepared statements
+    SQL_READ_DOC = "SELECT data FROM documents WHERE path = ?"
+    SQL_EXISTS_DOC = "SELECT 1 FROM documents WHERE path = ?"
+    SQL_UPSERT_DOC = "INSERT INTO documents (path, collection, name, data, updated_at) VALUES (?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at"
+    SQL_DELETE_DOC = "DELETE FROM documents WHERE path = ?"
+    SQL_READ_COLLECTION = "SELECT name, data FROM documents WHERE collection = ?"
+    SQL_UPSERT_PING = ("INSERT INTO ping_log (client_id, timestamp, last_ip, client_version) VALUES (?, ?, ?, ?) ON CONFLICT (client_id) DO UPDATE SET "
+                       "timestamp = COALESCE(excluded.timestamp, timestamp), last_ip = COALESCE(excluded.last_ip, last_ip), client_version = COALESCE(excluded.client_version, client_version)")
+    SQL_INSERT_SMS = "INSERT INTO sms_log (client_id, timestamp, message_contents, to_phone, success) VALUES (?, ?, ?, ?, ?)"
+    SQL_READ_PINGS = "SELECT client_id, timestamp, last_ip, client_version FROM ping_log"
+    SQL_READ_SMS = "SELECT client_id, timestamp, message_contents, to_phone, success FROM sms_log ORDER BY client_id, timestamp, id"
+    # Rows older than the cutoff, or past the newest N of their client
+    SQL_EXPIRED_SMS = ("SELECT id FROM (SELECT id, timestamp, ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY timestamp DESC, id DESC) AS n FROM sms_log) "
+                       "WHERE timestamp < ? OR n > ? LIMIT ?")
+    SQL_EXPIRED_PINGS = "SELECT client_id FROM ping_log WHERE timestamp < ? LIMIT ?"
+
+    # Paths per read_docs() query, kept well under SQLite's bound parameter limit
+    MAX_BATCH_SIZE = 500
+
+    # Firestore query operators and their SQL equivalents
+    QUERY_OPS = {
+        "==": "=",
+        "!=": "!=",
+        "<": "<",
+        "<=": "<=",
+        ">": ">",
+        ">=": ">="
+    }
 
     def __init__(self):
         """
         WARNING! THIS IS A BETA! DEFAULT TO FIRESTORE UNTIL FURTHER TESTING!
 
-        An experimental SQLLite local database module as an alternative to the FSIO module.
+        A SQLite local database module as an alternative to the FSIO module. Documents use the same paths and merge rules as
+        FirestoreIO and are stored as JSON in the documents table. Ping and SMS logs get their own indexed tables.
+        Connections come from AuthHolder's SQLitePool: reads run in parallel, writes go through the pool's single writer.
+
+        Functions:\n
+        -- -- -- -- -- --
+        write_doc(): Write (merge) a document
+        write_docs(): Write (merge) many documents in one transaction
+        read_doc(): Read a document
+        read_docs(): Read many documents with one query per 500 paths
+        delete_doc(): Delete a document
+        delete_docs(): Delete many documents in one transaction
+        check_exists(): Check if a document exists
+        copy_doc(): Copy a document
+        read_collection(): Read every document in a collection
+        read_docs_by_query(): Searches all docs in a given collection that match a formatted query
+        log_client_pings(): Upsert rows into the ping log
+        log_sms_rows(): Insert rows into the SMS log
+        read_ping_log(): Read the ping log in the same shape as the Firestore ping log document
+        read_sms_log(): Read the SMS log in the same shape as the Firestore SMS log document
+        expire_logs(): Move expired SMS and ping log rows to the archive tables
+        """
+        self.__auth = AuthHolder()
+        if self.__pool is None:
+            logging.error("SQLLiteIO: No sqlite connection pool available. Check sqlite_local_filepath in your config.yml")
+        else:
+            self.__ensure_schema()
+
+    @property
+    def __pool(self):
+        # Fetched on every use instead of kept, so an instance made before a fork never uses the parent's connections
+        return self.__auth.sqlite_pool
+
+    def write_doc(self, path, write_dict):
+        """
+        Write a document, merging it into any existing document the same way FirestoreIO.write_doc() does
+
+        :param str path: Document path. Ex: "/ExampleCollection/ExampleDocument"
+        :param dict write_dict: Dict to merge into the document
+
+        :returns: True if we executed the write, False if an error occured on the sqlite write, None if an error occured locally.
+        """
+        res = self.write_docs([(path, write_dict)])
+        return res[0]
+
+    def write_docs(self, items):
+        """
+        Write (merge) many documents in a single transaction
+
+        :param list items: List of (path, write_dict) tuples
+
+        :returns list: One result per item, in order. True if written, False if the transaction failed, None if the item was invalid.
+        """
+        results = [None] * len(items)
+        if self.__pool is None:
+            return results
+        valid = []
+        for i, item in enumerate(items):
+            path, write_dict = item
+            split = split_document_path(path)
+            if split is None or type(write_dict) is not dict:
+                logging.error(f"SQLLiteIO: write_docs: Invalid document path or write_dict for path {path}")
+                continue
+            valid.append((i, path, split, write_dict))
+        if len(valid) == 0:
+            return results
+        try:
+            with self.__pool.writer() as con:
+                try:
+                    con.execute("BEGIN IMMEDIATE")
+                    merged = {}
+                    for i, path, split, write_dict in valid:
+                        if path not in merged:
+                            row = con.execute(self.SQL_READ_DOC, (path,)).fetchone()
+                            merged[path] = (split, json.loads(row[0]) if row is not None else {})
+                        self.__deep_merge(merged[path][1], write_dict)
+                    now = time.time()
+                    con.executemany(self.SQL_UPSERT_DOC, [(path, split[0], split[1], json.dumps(doc), now) for path, (split, doc) in merged.items()])
+                    con.execute("COMMIT")
+                    ok = True
+                except Exception:
+                    self.__rollback(con)
+                    raise
+        except Exception as e:
+            logging.error(f"SQLLiteIO: write_docs: An exception occured writing {len(valid)} documents")
+            logging.error(e)
+            ok = False
+        for i, path, split, write_dict in valid:
+            results[i] = ok
+        return results
+
+    def read_doc(self, path):
+        """
+        Read a document
+
+        :param str path: Document path
+
+        :returns dict: Your doc's data or None if an error occured or the doc didn't exist
+        """
+        if self.__pool is None or split_document_path(path) is None:
+            logging.error(f"SQLLiteIO: read_doc: Invalid document path: {path}")
+            return None
+        try:
+            with self.__pool.reader() as con:
+                row = con.execute(self.SQL_READ_DOC, (path,)).fetchone()
+        except Exception as e:
+            logging.error(f"SQLLiteIO: read_doc: An unknown exception occured trying to read your doc at {path}")
+            logging.error(e)
+            return None
+        if row is None:
+            logging.warning(f"SQLLiteIO: read_doc: Your doc at path: {path} appears to not exist! Check that it exists first and try again!")
+            return None
+        return json.loads(row[0])
+
+    def read_docs(self, paths):
+        """
+        Read many documents, up to MAX_BATCH_SIZE per query
+
+        :param list paths: Document paths
+
+        :returns list: One result per path, in order. The doc's dict, False if the doc doesn't exist, None if the path is invalid or an error occured
+        """
+        results = [None] * len(paths)
+        if self.__pool is None:
+            return results
+        valid = []
+        for i, path in enumerate(paths):
+            if split_document_path(path) is None:
+                logging.error(f"SQLLiteIO: read_docs: Invalid document path: {path}")
+                continue
+            valid.append((i, path))
+        for start in range(0, len(valid), self.MAX_BATCH_SIZE):
+            chunk = valid[start:start + self.MAX_BATCH_SIZE]
+            unique = list(dict.fromkeys(path for i, path in chunk))
+            sql = f"SELECT path, data FROM documents WHERE path IN ({', '.join('?' * len(unique))})"
+            try:
+                with self.__pool.reader() as con:
+                    found = dict(con.execute(sql, unique).fetchall())
+            except Exception as e:
+                logging.error(f"SQLLiteIO: read_docs: An unknown exception occured reading {len(unique)} documents")
+                logging.error(e)
+                continue
+            for i, path in chunk:
+                results[i] = json.loads(found[path]) if path in found else False
+        return results
+
+    def check_exists(self, path):
+        """
+        Check if a document exists at a given path
+
+        :param str path: Document path
+
+        :returns boolean: True if exists, False otherwise. Will return None if an error occured.
+        """
+        if self.__pool is None or split_document_path(path) is None:
+            return None
+        try:
+            with self.__pool.reader() as con:
+                return con.execute(self.SQL_EXISTS_DOC, (path,)).fetchone() is not None
+        except Exception as e:
+            logging.error(f"SQLLiteIO: check_exists: An unknown exception occured checking {path}")
+            logging.error(e)
+            return None
+
+    def delete_doc(self, path, blind=False):
+        """
+        Delete a document
+
+        :param str path: Document path
+        :param bool blind: Return True even if the document didn't exist. See FirestoreIO.delete_doc()
+
+        :returns: True if document is deleted, False if the document didn't exist, and None if an error has occured.
+        """
+        if self.__pool is None or split_document_path(path) is None:
+            logging.error(f"SQLLiteIO: delete_doc: Invalid document path: {path}")
+            return None
+        try:
+            with self.__pool.writer() as con:
+                cur = con.execute(self.SQL_DELETE_DOC, (path,))
+                return cur.rowcount > 0 or blind is True
+        except Exception as e:
+            logging.error(f"SQLLiteIO: delete_doc: An unknown exception occured deleting {path}")
+            logging.error(e)
+            return None
+
+    def delete_docs(self, paths):
+        """
+        Delete many documents in a single transaction
+
+        :param list paths: Document paths
+
+        :returns list: One result per path, in order. True if deleted or already missing, False if the transaction failed, None if the path is invalid
+        """
+        results = [None] * len(paths)
+        valid = []
+        for i, path in enumerate(paths):
+            if split_document_path(path) is None:
+                logging.error(f"SQLLiteIO: delete_docs: Invalid document path: {path}")
+                continue
+            valid.append(i)
+        if len(valid) == 0:
+            return results
+        ok = self.__executemany(self.SQL_DELETE_DOC, [(paths[i],) for i in valid], "delete_docs")
+        for i in valid:
+            results[i] = ok
+        return results
+
+    def delete_fields(self, path, field_paths):
+        """
+        Delete fields from a document. See FirestoreIO.delete_fields()
+
+        :returns: True if deleted, False if the document doesn't exist or the write failed, None if the path or a field path is invalid
+        """
+        if self.__pool is None or split_document_path(path) is None or type(field_paths) is not list or not all(type(f) is list and len(f) > 0 for f in field_paths):
+            logging.error(f"SQLLiteIO: delete_fields: Invalid document path {path} or field_paths {field_paths}")
+            return None
+        try:
+            with self.__pool.writer() as con:
+                try:
+                    con.execute("BEGIN IMMEDIATE")
+                    row = con.execute(self.SQL_READ_DOC, (path,)).fetchone()
+                    if row is None:
+                        con.execute("COMMIT")
+                        return False
+                    doc = json.loads(row[0])
+                    for field in field_paths:
+                        current = doc
+                        for key in field[:-1]:
+                            current = current.get(key) if type(current) is dict else None
+                        if type(current) is dict:
+                            current.pop(field[-1], None)
+                    split = split_document_path(path)
+                    con.execute(self.SQL_UPSERT_DOC, (path, split[0], split[1], json.dumps(doc), time.time()))
+                    con.execute("COMMIT")
+                    return True
+                except Exception:
+                    self.__rollback(con)
+                    raise
+        except Exception as e:
+            logging.error(f"SQLLiteIO: delete_fields: An exception occured deleting fields from {path}")
+            logging.error(e)
+            return False
+
+    def copy_doc(self, from_path, to_path):
+        """
+        Copy a document from point a to point b, merging into any existing doc at to_path
+
+        :returns: True if success, None if an error has occurred
+        """
+        doc = self.read_doc(from_path)
+        if type(doc) is not dict:
+            logging.error("SQLLiteIO: copy_doc: An error occured trying to read doc to copy. Does doc exist?")
+            return None
+        if self.write_doc(to_path, doc) is not True:
+            logging.error("SQLLiteIO: copy_doc: An unknown exception occured trying to write document in copy")
+            return None
+        return True
+
+    def read_collection(self, collection_path):
+        """
+        Read every document in a collection
+
+        :param str collection_path: Collection path. Must begin and end with a '/'
+
+        :returns dict: Doc id -> doc dict. None if an error occurred
+        """
+        if self.__pool is None or not is_valid_collection_path(collection_path):
+            logging.error(f"SQLLiteIO: read_collection: Invalid collection path: {collection_path}")
+            return None
+        try:
+            with self.__pool.reader() as con:
+                rows = con.execute(self.SQL_READ_COLLECTION, (collection_path,)).fetchall()
+        except Exception as e:
+            logging.error(f"SQLLiteIO: read_collection: An unknown exception occured reading {collection_path}")
+            logging.error(e)
+            return None
+        return {name: json.loads(data) for name, data in rows}
+
+    def read_docs_by_query(self, collection_path, query_list):
+        """
+        Search the docs in a collection. Same arguments as FirestoreIO.read_docs_by_query(), except values keep their type.
+
+        :param str collection_path: Collection path. Must begin and end with a '/'
+        :param list query_list: [field, operator, value]. Nested fields are separated by '.'
+
+        :returns dict: Doc id -> doc dict for every match. None if an error occurred
+        """
+        if self.__pool is None or not is_valid_collection_path(collection_path):
+            logging.error(f"SQLLiteIO: read_docs_by_query: Invalid collection path: {collection_path}")
+            return None
+        if type(query_list) is not list or len(query_list) != 3 or query_list[1] not in self.QUERY_OPS:
+            logging.error(f"SQLLiteIO: read_docs_by_query: Invalid query_list {query_list}. Supported operators are {list(self.QUERY_OPS)}")
+            return None
+        json_path = "$" + "".join('."' + part.replace('"', '""') + '"' for part in str(query_list[0]).split("."))
+        sql = f"SELECT name, data FROM documents WHERE collection = ? AND json_extract(data, ?) {self.QUERY_OPS[query_list[1]]} ?"
+        value = query_list[2]
+        if type(value) is bool:
+            value = int(value)
+        try:
+            with self.__pool.reader() as con:
+                rows = con.execute(sql, (collection_path, json_path, value)).fetchall()
+        except Exception as e:
+            logging.error(f"SQLLiteIO: read_docs_by_query: An Exception occured while trying to execute your query on {collection_path}")
+            logging.error(e)
+            return None
+        return {name: json.loads(data) for name, data in rows}
+
+    def log_client_pings(self, rows):
+        """
+        Upsert pings into the ping log in one transaction. None fields keep their stored value.
+
+        :param list rows: List of (client_id, timestamp, client_ip, client_version) tuples
+
+        :returns bool: True if written, False if an error occured
+        """
+        return self.__executemany(self.SQL_UPSERT_PING, rows, "log_client_pings")
+
+    def log_sms_rows(self, rows):
+        """
+        Insert sent SMS into the SMS log in one transaction
+
+        :param list rows: List of (client_id, timestamp, message_contents, to_phone, success_bool) tuples
+
+        :returns bool: True if written, False if an error occured
+        """
+        return self.__executemany(self.SQL_INSERT_SMS, [(r[0], r[1], r[2], r[3], 1 if r[4] else 0) for r in rows], "log_sms_rows")
+
+    def read_ping_log(self):
+        """
+        :returns dict: The ping log as {"clients": {client_id: {"timestamp": ..., "last ip": ..., "client version": ...}}}, or None if an error occured
+        """
+        rows = self.__fetchall(self.SQL_READ_PINGS, "read_ping_log")
+        if rows is None:
+            return None
+        return {"clients": {r[0]: {"timestamp": r[1], "last ip": r[2], "client version": r[3]} for r in rows}}
+
+    def read_sms_log(self):
+        """
+        :returns dict: The SMS log as {"clients": {client_id: {timestamp: {"message_contents": ..., "to_phone": ..., "success": ...}}}}, or None if an error occured
+        """
+        rows = self.__fetchall(self.SQL_READ_SMS, "read_sms_log")
+        if rows is None:
+            return None
+        clients = {}
+        for client_id, timestamp, message_contents, to_phone, success in rows:
+            clients.setdefault(client_id, {})[timestamp] = {"message_contents": message_contents, "to_phone": to_phone, "success": bool(success)}
+        return {"clients": clients}
+
+    def expire_logs(self, sms_cutoff, sms_max_entries, ping_cutoff, archive=True, batch_size=500, limiter=None):
         """
-        
\ No newline at end of file
+        Remove expired rows from the SMS and ping logs in batches, copying them to sms_log_archive and ping_log_archive first.
+        Each batch is its own transaction. Used by LogRetention.
+
+        :param str sms_cutoff: SMS rows with an older timestamp expire. None disables the age limit
+        :param int sms_max_entries: SMS rows past the newest sms_max_entries of their client expire. 0 disables the count limit
+        :param str ping_cutoff: Clients whose last ping is older than this expire. None disables ping expiry
+        :param bool archive: Copy expired rows to the archive tables before deleting them
+        :param int batch_size: Rows per transaction
+        :param limiter: utils.RateLimiter taking one token per row, or None
+
+        :returns dict: {"sms_expired": int, "pings_expired": int}, or None if an error occurred
+        """
+        if self.__pool is None:
+            return None
+        stats = {"sms_expired": 0, "pings_expired": 0}
+        batch_size = max(1, batch_size)
+        passes = []
+        if sms_cutoff is not None or sms_max_entries > 0:
+            max_entries = sms_max_entries if sms_max_entries > 0 else 2 ** 62
+            passes.append(("sms_expired", self.SQL_EXPIRED_SMS, (sms_cutoff or "", max_entries, batch_size), "sms_log", "sms_log_archive", "id"))
+        if ping_cutoff is not None:
+            passes.append(("pings_expired", self.SQL_EXPIRED_PINGS, (ping_cutoff, batch_size), "ping_log", "ping_log_archive", "client_id"))
+        try:
+            for stat, select_sql, params, table, archive_table, key in passes:
+                while True:
+                    with self.__pool.writer() as con:
+                        try:
+                            con.execute("BEGIN IMMEDIATE")
+                            keys = [row[0] for row in con.execute(select_sql, params).fetchall()]
+                            if len(keys) > 0:
+                                marks = ", ".join("?" * len(keys))
+                                if archive is True:
+                                    con.execute(f"INSERT OR REPLACE INTO {archive_table} SELECT * FROM {table} WHERE {key} IN ({marks})", keys)
+                                con.execute(f"DELETE FROM {table} WHERE {key} IN ({marks})", keys)
+                            con.execute("COMMIT")
+                        except Exception:
+                            self.__rollback(con)
+                            raise
+                    stats[stat] += len(keys)
+                    if len(keys) < batch_size:
+                        break
+                    if limiter is not None:
+                        limiter.acquire(len(keys))
+        except Exception as e:
+            logging.error(f"SQLLiteIO: expire_logs: An exception occured expiring log rows. Expired so far: {stats}")
+            logging.error(e)
+            return None
+        return stats
+
+    def __ensure_schema(self):
+        """
+        Create the tables and indexes once per process. The pool turns on WAL journaling for every connection
+        """
+        if SQLLiteIO._SCHEMA_READY:
+            return
+        try:
+            with self.__pool.writer() as con:
+                if SQLLiteIO._SCHEMA_READY:
+                    return
+                for statement in self.SCHEMA:
+                    con.execute(statement)
+                SQLLiteIO._SCHEMA_READY = True
+        except Exception as e:
+            logging.error("SQLLiteIO: __ensure_schema: An unknown exception occured creating the sqlite schema")
+            logging.error(e)
+
+    def __executemany(self, sql, rows, caller):
+        if self.__pool is None:
+            return False
+        try:
+            with self.__pool.writer() as con:
+                try:
+                    con.execute("BEGIN IMMEDIATE")
+                    con.executemany(sql, rows)
+                    con.execute("COMMIT")
+                    return True
+                except Exception:
+                    self.__rollback(con)
+                    raise
+        except Exception as e:
+            logging.error(f"SQLLiteIO: {caller}: An exception occured writing {len(rows)} rows")
+            logging.error(e)
+            return False
+
+    def __fetchall(self, sql, caller):
+        if self.__pool is None:
+            return None
+        try:
+            with self.__pool.reader() as con:
+                return con.execute(sql).fetchall()
+        except Exception as e:
+            logging.error(f"SQLLiteIO: {caller}: An unknown exception occured reading the log")
+            logging.error(e)
+            return None
+
+    def __rollback(self, con):
+        try:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+        except Exception as e:
+            logging.error(e)
+
+    def __deep_merge(self, target, source):
+        """
+        Merge source into target like a Firestore set(merge=True): nested dicts merge, everything else is replaced
+        """
+        for key, value in source.items():
+            if type(value) is dict and type(target.get(key)) is dict:
+                self.__deep_merge(target[key], value)
+            else:
+                target[key] = json.loads(json.dumps(value))
+
+register_backend("sqlite_local", SQLLiteIO)
@@ -0,0 +1,124 @@
+import sqlite3, threading, queue, logging, os
+from contextlib import contextmanager
+
+class SQLitePool():
+
+    VALID_SYNCHRONOUS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+    def __init__(self, filepath, max_readers=8, busy_timeout_ms=5000, cache_size_kib=16384, mmap_size=268435456, synchronous="NORMAL", acquire_timeout=5.0):
+        """
+        Thread-safe SQLite connection manager. Reads run in parallel on a bounded pool of read-only connections (WAL lets them
+        run alongside a write), and writes share one writer connection behind a lock so they are grouped into SQLite's single
+        writer instead of fighting over the database lock. Connections are never shared by two threads at once.
+
+        Every connection gets WAL journaling, the given synchronous level, page cache size, mmap size and busy timeout.
+        Connections opened before a fork are dropped and reopened in the child.
+
+        :param str filepath: SQLite database filepath
+        :param int max_readers: Maximum number of read connections
+        :param int busy_timeout_ms: How long a connection waits on a locked database before erroring
+        :param int cache_size_kib: Page cache size per connection in KiB
+        :param int mmap_size: Bytes of the database file to memory map. 0 disables
+        :param str synchronous: One of VALID_SYNCHRONOUS. NORMAL is safe with WAL
+        :param float acquire_timeout: Seconds to wait for a free read connection before erroring
+        """
+        self.__filepath = filepath
+        self.__max_readers = max(1, max_readers)
+        self.__busy_timeout_ms = max(0, busy_timeout_ms)
+        self.__cache_size_kib = max(0, cache_size_kib)
+        self.__mmap_size = max(0, mmap_size)
+        self.__synchronous = str(synchronous).upper()
+        if self.__synchronous not in self.VALID_SYNCHRONOUS:
+            logging.error(f"SQLitePool: Invalid synchronous level '{synchronous}'. Using 'NORMAL'")
+            self.__synchronous = "NORMAL"
+        self.__acquire_timeout = acquire_timeout
+        self.__lock = threading.Lock()
+        self.__reset()
+
+    @contextmanager
+    def reader(self):
+        """
+        Borrow a read-only connection. Use as: with pool.reader() as con: con.execute(...)
+
+        :raises sqlite3.OperationalError: If no read connection frees up within acquire_timeout seconds
+        """
+        self.__check_pid()
+        slots = self.__reader_slots
+        if not slots.acquire(timeout=self.__acquire_timeout):
+            raise sqlite3.OperationalError(f"SQLitePool: No read connection available after {self.__acquire_timeout}s ({self.__max_readers} in use)")
+        idle = self.__idle_readers
+        try:
+            try:
+                con = idle.get_nowait()
+            except queue.Empty:
+                con = self.__connect(read_only=True)
+            try:
+                yield con
+            finally:
+                if con.in_transaction:
+                    con.rollback()
+                idle.put(con)
+        finally:
+            slots.release()
+
+    @contextmanager
+    def writer(self):
+        """
+        Borrow the writer connection. Only one thread holds it at a time, so group related writes (executemany, one transaction)
+        inside a single with block. Use as: with pool.writer() as con: con.execute(...)
+        """
+        self.__check_pid()
+        with self.__writer_lock:
+            if self.__writer is None:
+                self.__writer = self.__connect(read_only=False)
+            yield self.__writer
+
+    def close(self):
+        """
+        Close every idle connection and the writer
+        """
+        with self.__lock:
+            while True:
+                try:
+                    self.__idle_readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            with self.__writer_lock:
+                if self.__writer is not None:
+                    self.__writer.close()
+                    self.__writer = None
+
+    def __reset(self):
+        """
+        Start over with no connections. Used at construction and in a forked child
+        """
+        self.__pid = os.getpid()
+        self.__reader_slots = threading.BoundedSemaphore(self.__max_readers)
+        self.__idle_readers = queue.LifoQueue()
+        self.__writer_lock = threading.Lock()
+        self.__writer = None
+
+    def __check_pid(self):
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    logging.debug("SQLitePool: __check_pid: Process forked, dropping inherited connections")
+                    self.__reset()
+
+    def __connect(self, read_only):
+        """
+        Open a connection and apply the pool's pragmas
+
+        :param bool read_only: Open with query_only so the connection can't write
+
+        :returns: sqlite3 Connection in autocommit mode, usable from any thread
+        """
+        con = sqlite3.connect(self.__filepath, timeout=self.__busy_timeout_ms / 1000, check_same_thread=False, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={self.__synchronous}")
+        con.execute(f"PRAGMA cache_size=-{int(self.__cache_size_kib)}")
+        con.execute(f"PRAGMA mmap_size={int(self.__mmap_size)}")
+        con.execute(f"PRAGMA busy_timeout={int(self.__busy_timeout_ms)}")
+        if read_only:
+            con.execute("PRAGMA query_only=ON")
+        return con
@@ -0,0 +1,517 @@
+import logging, importlib, threading, functools, sys
+from utils import ConfigProvider
+
+class StorageBackend():
+
+    # True if the backend stores ping and SMS logs in its own tables (log_client_pings() etc.) instead of log documents
+    native_logs = False
+    # True if calls wait on I/O. The async server runs blocking backends on a thread pool (see async_storage.py)
+    blocking = True
+
+    def __init__(self):
+        """
+        Interface every storage backend implements. ClientUtils and the request handlers only talk to backends through these
+        methods, and pick one by database_type through get_backend(). Paths and return values follow FirestoreIO:
+
+        Document paths begin with '/', don't end with '/' and have an even number of '/'. Ex: "/Collection/Document"
+        Collection paths begin and end with '/' and have an even number of '/'. Ex: "/Collection/Document/Subcollection/"
+        Writes merge like a Firestore set(merge=True): nested dicts merge, everything else is replaced.
+        Methods return None on local errors (ex: invalid path) and False when the database rejected the operation.
+
+        Functions:\n
+        -- -- -- -- -- --
+        write_doc(): Write (merge) a document
+        write_docs(): Write (merge) many documents
+        read_doc(): Read a document
+        read_docs(): Read many documents
+        delete_doc(): Delete a document
+        delete_docs(): Delete many documents
+        delete_fields(): Delete fields from a document
+        check_exists(): Check if a document exists
+        copy_doc(): Copy a document
+        read_collection(): Read every document in a collection
+        read_docs_by_query(): Read the documents in a collection matching a [field, op, value] query
+        stream_query(): Yield the documents in a collection matching several where-clauses, ordered, limited and paginated
+
+        Backends with native_logs = True also implement log_client_pings(), log_sms_rows(), read_ping_log() and read_sms_log()
+        """
+
+    def write_doc(self, path, write_dict):
+        raise NotImplementedError
+
+    def write_docs(self, items):
+        """
+        Default: one write_doc() per item. Backends override this with a real batch
+
+        :param list items: List of (path, write_dict) tuples
+
+        :returns list: One write_doc() result per item, in order
+        """
+        return [self.write_doc(path, write_dict) for path, write_dict in items]
+
+    def read_doc(self, path):
+        raise NotImplementedError
+
+    def read_docs(self, paths):
+        """
+        Default: one read_doc() per path, plus a check_exists() for each doc that couldn't be read. Backends override this with a real batch
+
+        :param list paths: Document paths
+
+        :returns list: One result per path, in order. The doc's dict, False if the doc doesn't exist, None if the path is invalid or an error occured
+        """
+        results = []
+        for path in paths:
+            doc = self.read_doc(path)
+            if type(doc) is dict:
+                results.append(doc)
+            else:
+                results.append(False if self.check_exists(path) is False else None)
+        return results
+
+    def delete_doc(self, path, blind=False):
+        raise NotImplementedError
+
+    def delete_docs(self, paths):
+        """
+        Default: one delete_doc() per path. Backends override this with a real batch
+
+        :param list paths: Document paths
+
+        :returns list: One result per path, in order. True if deleted or already missing, False if the database rejected the delete, None if the path is invalid
+        """
+        results = []
+        for path in paths:
+            res = self.delete_doc(path)
+            results.append(None if res is None else True)
+        return results
+
+    def delete_fields(self, path, field_paths):
+        raise NotImplementedError
+
+    def check_exists(self, path):
+        raise NotImplementedError
+
+    def copy_doc(self, from_path, to_path):
+        raise NotImplementedError
+
+    def read_collection(self, collection_path):
+        raise NotImplementedError
+
+    def read_docs_by_query(self, collection_path, query_list):
+        raise NotImplementedError
+
+    def stream_query(self, collection_path, where=None, order_by=None, limit=None, select=None, start_after=None):
+        """
+        Default: read_collection() and run the query in Python with run_query(). FirestoreIO overrides this to stream from the database.
+        See FirestoreIO.stream_query() for the arguments
+
+        :returns: Generator of (doc_id, doc_dict) tuples, or None if the path or query is invalid
+        """
+        query = normalize_query(where, order_by, limit, select, start_after)
+        if query is None:
+            logging.error(f"{type(self).__name__}: stream_query: Invalid query for {collection_path}")
+            return None
+        docs = self.read_collection(collection_path)
+        if docs is None:
+            return None
+        return iter(run_query(docs, *query))
+
+_BACKENDS = {}
+_REGISTRY_LOCK = threading.RLock()
+_MODULES_LOADED = False
+
+# Modules of the built-in backends, imported only when their backend is asked for, so a server that doesn't use Firestore never loads its client library
+BUILTIN_BACKEND_MODULES = {
+    "firestore": "fsio",
+    "sqlite_local": "sqlio",
+    "memory": "memio"
+}
+
+def register_backend(name, factory):
+    """
+    Register a storage backend so it can be selected with database_type. Call this at import time of the module defining the backend
+    and list that module in storage_backend_modules in config.yml; server.py doesn't need to change.
+
+    :param str name: database_type value that selects the backend
+    :param factory: Callable returning a StorageBackend. Called on every get_backend(), so keep shared state out of the instance
+    """
+    with _REGISTRY_LOCK:
+        if name in _BACKENDS:
+            logging.warning(f"storage: register_backend: Replacing storage backend '{name}'")
+        _BACKENDS[name] = factory
+
+def get_backend(name=None):
+    """
+    Get a storage backend instance
+
+    :param str name: Registered backend name. Defaults to database_type from the config
+
+    :returns: StorageBackend instance, or None if no backend is registered under that name
+    """
+    if name is None:
+        name = ConfigProvider().database_type
+    _load_backend_modules(name)
+    factory = _BACKENDS.get(name)
+    if factory is None:
+        logging.error(f"storage: get_backend: No storage backend registered for '{name}'. Registered backends: {backend_names()}")
+        return None
+    return factory()
+
+def backend_names():
+    """
+    :returns list: Names of the registered backends, plus the built-in ones that haven't been imported yet
+    """
+    return sorted(set(_BACKENDS.keys()) | set(BUILTIN_BACKEND_MODULES.keys()))
+
+def _load_backend_modules(name):
+    """
+    Import the storage_backend_modules from the config once, and the built-in backend called name if it isn't registered yet.
+    Importing a backend module registers it
+
+    :param str name: Backend about to be used
+    """
+    global _MODULES_LOADED
+    if _MODULES_LOADED and name in _BACKENDS:
+        return
+    with _REGISTRY_LOCK:
+        modules = [] if _MODULES_LOADED else list(ConfigProvider().storage_backend_modules)
+        if name not in _BACKENDS and name in BUILTIN_BACKEND_MODULES:
+            modules.append(BUILTIN_BACKEND_MODULES[name])
+        for module in modules:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                logging.error(f"storage: _load_backend_modules: Unable to import storage backend module '{module}'")
+                logging.error(e)
+        _MODULES_LOADED = True
+
+# Path helpers shared by the backends
+
+# Parsed paths kept by parse_path(). Backends see the same few thousand log and client paths over and over
+PATH_CACHE_SIZE = 8192
+
+class InvalidPathError(ValueError):
+    pass
+
+class StoragePath():
+
+    __slots__ = ("path", "parts", "is_document")
+
+    def __init__(self, path):
+        """
+        A validated, immutable document or collection path. Build them with parse_path(), which hands out one shared instance per path string,
+        so each path is only parsed and checked once per process. Construction raises InvalidPathError on an invalid path.
+
+        Document paths begin with '/', don't end with '/' and have an even number of '/'. Ex: "/Collection/Document"
+        Collection paths begin and end with '/' and have an even number of '/'. Ex: "/Collection/Document/Subcollection/"
+        Segments can't be empty, and a document's name can't be only whitespace.
+
+        :param str path: Document or collection path
+
+        Attributes:\n
+        -- -- -- -- -- --
+        path: The path string
+        parts: Tuple of the path's segments. Ex: ("Collection", "Document")
+        is_document: True for a document path, False for a collection path
+        """
+        if type(path) is not str:
+            raise InvalidPathError(f"Path must be a str. Got: {type(path)}")
+        if len(path) < 3 or path[0] != "/":
+            raise InvalidPathError(f"Path must begin with '/' and name at least one collection. Your path: {path}")
+        if path.count("/") % 2 != 0:
+            raise InvalidPathError(f"Path has an odd number of '/'. Document paths must not end in '/', collection paths must. Your path: {path}")
+        is_document = path[-1] != "/"
+        parts = tuple(path[1:].split("/") if is_document else path[1:-1].split("/"))
+        if "" in parts:
+            raise InvalidPathError(f"Path has an empty segment. Your path: {path}")
+        if is_document and parts[-1].strip() == "":
+            raise InvalidPathError(f"Document name must not be only whitespace. Your path: {path}")
+        object.__setattr__(self, "path", sys.intern(path))
+        object.__setattr__(self, "parts", parts)
+        object.__setattr__(self, "is_document", is_document)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StoragePath is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("StoragePath is immutable")
+
+    def __eq__(self, other):
+        return type(other) is StoragePath and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"StoragePath({self.path!r})"
+
+    @property
+    def name(self):
+        """
+        :returns str: Document name, or collection id for a collection path
+        """
+        return self.parts[-1]
+
+    @property
+    def collection_path(self):
+        """
+        :returns str: Path of the collection holding a document, or the path itself for a collection. Ex: "/Collection/"
+        """
+        if self.is_document:
+            return self.path[:len(self.path) - len(self.parts[-1])]
+        return self.path
+
+    @property
+    def relative_path(self):
+        """
+        :returns str: Path without the leading and trailing '/', as the Firestore client takes it. Ex: "Collection/Document"
+        """
+        return "/".join(self.parts)
+
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def _parse_str_path(path):
+    return StoragePath(path)
+
+def parse_path(path):
+    """
+    Parse and validate a path, memoized. Invalid paths aren't cached, so they raise every time
+
+    :param path: Path str, or a StoragePath which is returned as is
+
+    :returns StoragePath: Shared instance for this path
+    :raises InvalidPathError: If the path is invalid
+    """
+    if type(path) is StoragePath:
+        return path
+    if type(path) is not str:
+        raise InvalidPathError(f"Path must be a str. Got: {type(path)}")
+    return _parse_str_path(path)
+
+def split_document_path(path):
+    """
+    Split and validate a document path
+
+    :param str path: Document path. Ex: "/Collection/Document"
+
+    :returns list: [collection_path, document_name] where collection_path begins and ends with '/', or None if invalid
+    """
+    try:
+        parsed = parse_path(path)
+    except InvalidPathError:
+        return None
+    if not parsed.is_document:
+        return None
+    return [parsed.collection_path, parsed.name]
+
+def is_valid_collection_path(path):
+    """
+    :param str path: Collection path. Ex: "/Collection/"
+
+    :returns bool: True if path is a valid collection path
+    """
+    try:
+        return not parse_path(path).is_document
+    except InvalidPathError:
+        return False
+
+# Query helpers shared by the backends
+
+QUERY_OPS = ["==", "!=", "<", "<=", ">", ">=", "in", "not-in", "array-contains", "array-contains-any"]
+ORDER_DIRECTIONS = {"ASCENDING": "ASCENDING", "ASC": "ASCENDING", "DESCENDING": "DESCENDING", "DESC": "DESCENDING"}
+
+def normalize_query(where, order_by, limit, select, start_after):
+    """
+    Validate and normalize stream_query() arguments
+
+    :returns tuple: (where_clauses, order_fields, limit, select, start_after) where where_clauses is a list of (field, op, value)
+                    and order_fields a list of (field, direction). None if any argument is invalid
+    """
+    if where is None:
+        clauses = []
+    elif type(where) is list and len(where) == 3 and type(where[0]) is str and where[1] in QUERY_OPS:
+        clauses = [tuple(where)]
+    elif type(where) is list:
+        clauses = [tuple(c) for c in where if type(c) in [list, tuple] and len(c) == 3]
+        if len(clauses) != len(where):
+            logging.error(f"storage: normalize_query: where must be a [field, op, value] clause or a list of them. Got: {where}")
+            return None
+    else:
+        logging.error(f"storage: normalize_query: where must be a [field, op, value] clause or a list of them. Got: {where}")
+        return None
+    for field, op, value in clauses:
+        if type(field) is not str or field == "" or op not in QUERY_OPS:
+            logging.error(f"storage: normalize_query: Invalid where clause {[field, op, value]}. Supported operators are {QUERY_OPS}")
+            return None
+        if op in ["in", "not-in", "array-contains-any"] and type(value) is not list:
+            logging.error(f"storage: normalize_query: Operator {op} needs a list value. Got: {value}")
+            return None
+    if order_by is None:
+        orders = []
+    elif type(order_by) is str:
+        orders = [(order_by, "ASCENDING")]
+    elif type(order_by) is list:
+        orders = []
+        for item in order_by:
+            if type(item) is str:
+                orders.append((item, "ASCENDING"))
+            elif type(item) in [list, tuple] and len(item) == 2 and type(item[0]) is str and ORDER_DIRECTIONS.get(str(item[1]).upper()) is not None:
+                orders.append((item[0], ORDER_DIRECTIONS[str(item[1]).upper()]))
+            else:
+                logging.error(f"storage: normalize_query: Invalid order_by item {item}. Use a field name or [field, \"ASCENDING\"|\"DESCENDING\"]")
+                return None
+    else:
+        logging.error(f"storage: normalize_query: order_by must be a field name or a list. Got: {order_by}")
+        return None
+    if limit is not None and (type(limit) is not int or limit < 1):
+        logging.error(f"storage: normalize_query: limit must be a positive int. Got: {limit}")
+        return None
+    if select is not None and (type(select) is not list or not all(type(f) is str and f != "" for f in select)):
+        logging.error(f"storage: normalize_query: select must be a list of field names. Got: {select}")
+        return None
+    if start_after is not None:
+        if type(start_after) is dict and len(orders) == 0:
+            logging.error("storage: normalize_query: start_after field values need an order_by")
+            return None
+        elif type(start_after) not in [dict, str]:
+            logging.error(f"storage: normalize_query: start_after must be a doc id or a dict of order_by field values. Got: {start_after}")
+            return None
+    return (clauses, orders, limit, select, start_after)
+
+def get_field(doc, field):
+    """
+    :param dict doc: Document
+    :param str field: Field name. Nested fields are separated by '.'
+
+    :returns tuple: (True, value) if the field exists, otherwise (False, None)
+    """
+    current = doc
+    for part in field.split("."):
+        if type(current) is not dict or part not in current:
+            return (False, None)
+        current = current[part]
+    return (True, current)
+
+def match_clause(doc, clause):
+    """
+    Evaluate one (field, op, value) clause against a document like Firestore does: missing fields never match
+    and values of different types never compare equal or ordered
+
+    :returns bool: True if the document matches
+    """
+    field, op, value = clause
+    found, current = get_field(doc, field)
+    if not found:
+        return False
+    if op == "array-contains":
+        return type(current) is list and any(_compare(item, "==", value) for item in current)
+    if op == "array-contains-any":
+        return type(current) is list and type(value) is list and any(_compare(item, "==", v) for item in current for v in value)
+    if op == "in":
+        return type(value) is list and any(_compare(current, "==", v) for v in value)
+    if op == "not-in":
+        return type(value) is list and not any(_compare(current, "==", v) for v in value)
+    return _compare(current, op, value)
+
+def run_query(docs, clauses, orders, limit, select, start_after):
+    """
+    Run a normalized query (see normalize_query()) over documents held in memory. Results are ordered by the order_by fields,
+    then by doc id like Firestore; documents missing an order_by field are left out.
+
+    :param dict docs: Doc id -> doc dict
+
+    :returns list: (doc_id, doc_dict) tuples
+    """
+    matches = [(doc_id, doc) for doc_id, doc in docs.items() if all(match_clause(doc, c) for c in clauses)]
+    matches = [m for m in matches if all(get_field(m[1], field)[0] for field, direction in orders)]
+
+    def cmp_docs(a, b):
+        for field, direction in orders:
+            res = _cmp_values(get_field(a[1], field)[1], get_field(b[1], field)[1])
+            if res != 0:
+                return -res if direction == "DESCENDING" else res
+        return (a[0] > b[0]) - (a[0] < b[0])
+
+    matches.sort(key=functools.cmp_to_key(cmp_docs))
+    if type(start_after) is str:
+        ids = [doc_id for doc_id, doc in matches]
+        matches = matches[ids.index(start_after) + 1:] if start_after in ids else []
+    elif type(start_after) is dict:
+        def after_cursor(m):
+            for field, direction in orders:
+                if field not in start_after:
+                    break
+                res = _cmp_values(get_field(m[1], field)[1], start_after[field])
+                if res != 0:
+                    return (-res if direction == "DESCENDING" else res) > 0
+            return False
+        matches = [m for m in matches if after_cursor(m)]
+    if limit is not None:
+        matches = matches[:limit]
+    if select is not None:
+        matches = [(doc_id, _project(doc, select)) for doc_id, doc in matches]
+    return matches
+
+def _compare(a, op, b):
+    # Firestore never matches across types, and bools are not numbers
+    numbers = (int, float)
+    same_type = (type(a) is bool) == (type(b) is bool) and (type(a) is type(b) or (isinstance(a, numbers) and isinstance(b, numbers)))
+    if not same_type:
+        return op == "!="
+    try:
+        if op == "==":
+            return a == b
+        elif op == "!=":
+            return a != b
+        elif op == "<":
+            return a < b
+        elif op == "<=":
+            return a <= b
+        elif op == ">":
+            return a > b
+        elif op == ">=":
+            return a >= b
+    except TypeError:
+        return False
+    return False
+
+def _type_rank(value):
+    # Firestore's ordering of value types
+    if value is None:
+        return 0
+    elif type(value) is bool:
+        return 1
+    elif isinstance(value, (int, float)):
+        return 2
+    elif type(value) is str:
+        return 4
+    elif type(value) is bytes:
+        return 5
+    elif type(value) is list:
+        return 8
+    return 9
+
+def _cmp_values(a, b):
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return (rank_a > rank_b) - (rank_a < rank_b)
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return 0
+
+def _project(doc, fields):
+    res = {}
+    for field in fields:
+        found, value = get_field(doc, field)
+        if not found:
+            continue
+        target = res
+        parts = field.split(".")
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return res
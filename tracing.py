@@ -0,0 +1,208 @@
+import atexit, contextvars, json, logging, os, queue, re, threading, time
+from utils import ConfigProvider, Singleton
+import instrumentation
+
+# The span of the code currently running in this thread or task, or None
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+class Span():
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_us", "duration_us", "tags", "_start", "_token")
+
+    def __init__(self, trace_id, parent_id, name, kind=None, tags=None):
+        """
+        One timed operation of a trace. Made by Tracer.start_span()
+
+        :param str trace_id: 32 hex chars, shared by every span of a request
+        :param str parent_id: span_id of the enclosing span, or None for a root span
+        :param str name: Operation name. Ex: "firestore.write_doc"
+        :param str kind: Zipkin span kind ("SERVER", "CLIENT", ...) or None
+        :param dict tags: Extra key/values exported with the span
+        """
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.tags = tags if tags is not None else {}
+        self.start_us = int(time.time() * 1000000)
+        self.duration_us = None
+        self._start = time.perf_counter()
+        self._token = None
+
+    def to_zipkin(self, service_name):
+        """
+        :returns dict: The span in the Zipkin v2 JSON format
+        """
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": self.start_us,
+            "duration": self.duration_us,
+            "localEndpoint": {"serviceName": service_name},
+            "tags": {str(k): str(v) for k, v in self.tags.items()}
+        }
+        if self.parent_id is not None:
+            span["parentId"] = self.parent_id
+        if self.kind is not None:
+            span["kind"] = self.kind
+        return span
+
+class Tracer(metaclass=Singleton):
+
+    def __init__(self):
+        """
+        Per-request trace context. Each request gets a root span, taken from an incoming W3C traceparent header when there is one,
+        and calls into ClientUtils, the storage backends and TwilioDispatcher record child spans under it. The current span lives
+        in a contextvar, so concurrent requests never see each other's spans, and log lines get its trace_id (see loggingutils.TraceContextFilter).
+
+        Finished spans are put on a bounded queue and written by a background thread to tracing_file, one Zipkin v2 JSON span per line.
+        Request threads never wait on the file: when the queue is full spans are dropped and counted.
+
+        Functions:\n
+        -- -- -- -- -- --
+        start_request(): Start the root span of a request from its headers
+        start_span(): Start a child span of the current span
+        end_span(): Finish a span and queue it for export
+        call_started(): instrumentation hook. Start a child span for an instrumented call
+        call_finished(): instrumentation hook. End that span
+        flush(): Wait until every queued span is written
+        """
+        self.__conf = ConfigProvider()
+        self.enabled = self.__conf.tracing_enabled
+        self.__service_name = self.__conf.tracing_service_name
+        self.__queue = queue.Queue(maxsize=max(1, self.__conf.tracing_queue_size))
+        self.__dropped = 0
+        self.__writer = None
+        if self.enabled is not True:
+            return
+        self.__start_writer()
+        atexit.register(self.flush)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__after_fork)
+        instrumentation.register(self)
+
+    def start_request(self, headers, name):
+        """
+        Start the root span of a request and make it current
+
+        :param headers: Request headers. A valid "traceparent" continues that trace; an "X-Request-ID" is kept as the request_id tag
+        :param str name: Span name. Ex: "POST /api/ping"
+
+        :returns Span: The root span. Pass it to end_span() when the request is done
+        """
+        trace_id, parent_id = None, None
+        match = TRACEPARENT_RE.match(headers.get("traceparent", "").strip().lower())
+        if match is not None and match.group(1) != "0" * 32:
+            trace_id, parent_id = match.group(1), match.group(2)
+        if trace_id is None:
+            trace_id = os.urandom(16).hex()
+        span = Span(trace_id, parent_id, name, kind="SERVER")
+        request_id = headers.get("X-Request-ID")
+        if request_id is not None:
+            span.tags["request_id"] = request_id[:128]
+        span._token = _CURRENT_SPAN.set(span)
+        return span
+
+    def start_span(self, name, kind=None, tags=None):
+        """
+        Start a child span of the current span and make it current
+
+        :returns Span: The span, or None if there is no current span (ex: outside a request)
+        """
+        parent = _CURRENT_SPAN.get()
+        if parent is None:
+            return None
+        span = Span(parent.trace_id, parent.span_id, name, kind=kind, tags=tags)
+        span._token = _CURRENT_SPAN.set(span)
+        return span
+
+    def end_span(self, span, error=None):
+        """
+        Finish a span, make its parent current again and queue the span for export
+
+        :param Span span: Span from start_request() or start_span()
+        :param error: Exception the span's operation raised, if any
+        """
+        span.duration_us = max(1, int((time.perf_counter() - span._start) * 1000000))
+        if error is not None:
+            span.tags["error"] = type(error).__name__
+        if span._token is not None:
+            try:
+                _CURRENT_SPAN.reset(span._token)
+            except ValueError:
+                # Ended from a different context than it started in
+                _CURRENT_SPAN.set(None)
+            span._token = None
+        try:
+            self.__queue.put_nowait(span)
+        except queue.Full:
+            self.__dropped += 1
+
+
+    def call_started(self, call):
+        """
+        :param instrumentation.InstrumentedCall call: The method being called
+
+        :returns Span: The call's span, named "<component>.<method>", or None if there is no current span
+        """
+        return self.start_span(call.name, kind=call.kind)
+
+    def call_finished(self, call, token, error):
+        """
+        :param instrumentation.InstrumentedCall call: The method that was called
+        :param Span token: call_started()'s return value
+        :param error: Exception the call raised, or None
+        """
+        if token is not None:
+            self.end_span(token, error=error)
+    def flush(self):
+        """
+        Wait until every queued span is written
+        """
+        if self.__writer is not None and self.__writer.is_alive():
+            self.__queue.join()
+
+    def __start_writer(self):
+        self.__writer = threading.Thread(target=self.__write_spans, name="TraceExporter", daemon=True)
+        self.__writer.start()
+
+    def __after_fork(self):
+        # The writer thread doesn't survive a fork. Spans the parent had queued are left for the parent to write
+        self.__queue = queue.Queue(maxsize=max(1, self.__conf.tracing_queue_size))
+        self.__dropped = 0
+        self.__start_writer()
+
+    def __write_spans(self):
+        """
+        Exporter thread. Appends queued spans to tracing_file, writing whatever has piled up in one go
+        """
+        while True:
+            spans = [self.__queue.get()]
+            while len(spans) < 1000:
+                try:
+                    spans.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.__conf.tracing_file, "a") as f:
+                    for span in spans:
+                        f.write(json.dumps(span.to_zipkin(self.__service_name)) + "\n")
+                if self.__dropped > 0:
+                    dropped, self.__dropped = self.__dropped, 0
+                    logging.warning(f"Tracer: __write_spans: Trace queue was full, {dropped} spans dropped")
+            except Exception as e:
+                logging.error(f"Tracer: __write_spans: Unable to write {len(spans)} spans to {self.__conf.tracing_file}")
+                logging.error(e)
+            finally:
+                for span in spans:
+                    self.__queue.task_done()
+
+def current_span():
+    """
+    :returns Span: The current span, or None
+    """
+    return _CURRENT_SPAN.get()
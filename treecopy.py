@@ -0,0 +1,381 @@
+import json, logging, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from storage import split_document_path, is_valid_collection_path
+
+class TreeCopier:
+
+    def __init__(self, db=None, max_in_flight=8, batch_size=300, checkpoint_file=None, progress_callback=None, progress_interval=5.0, max_list_in_flight=32):
+        """
+        Copies a document or collection and everything below it. Each collection's document paths are paged through as a stream
+        and copied in batches (one get_all and one WriteBatch per batch) by a pool of threads, with at most max_in_flight batches
+        in flight. Each batch lists its documents' subcollections concurrently on a separate pool of max_list_in_flight threads, and
+        the subcollections found are queued and copied the same way. Documents that only hold subcollections are walked but not
+        created at the destination.
+
+        With a checkpoint_file the copy can be resumed: it records the collections still to copy and the documents already copied
+        in each, and running the same copy again picks up from there. The file is a journal of JSON lines and each save only appends
+        what changed since the last one. It is compacted when a copy resumes and removed once a copy finishes without failures.
+
+        Functions:\n
+        -- -- -- -- -- --
+        copy(): Copy a document or collection subtree
+
+        :param db: FirestoreIO, or any backend with read_docs(), write_docs(), list_doc_paths() and list_subcollections(). Defaults to a new FirestoreIO
+        :param int max_in_flight: Maximum number of batches being copied at once
+        :param int batch_size: Documents per batch. Capped at db.MAX_BATCH_SIZE
+        :param str checkpoint_file: Where to save progress for resuming. None disables checkpoints
+        :param progress_callback: Called with a copy of the stats dict every progress_interval seconds and when the copy ends
+        :param float progress_interval: Seconds between progress reports and checkpoint saves
+        :param int max_list_in_flight: Maximum number of subcollection listings running at once, across all batches
+        """
+        if db is None:
+            from fsio import FirestoreIO
+            db = FirestoreIO()
+        self.__db = db
+        self.__max_in_flight = max(1, max_in_flight)
+        self.__batch_size = max(1, min(batch_size, getattr(db, "MAX_BATCH_SIZE", 500)))
+        self.__checkpoint_file = checkpoint_file
+        self.__progress_callback = progress_callback
+        self.__progress_interval = progress_interval
+        self.__max_list_in_flight = max(1, max_list_in_flight)
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__save_lock = threading.Lock()
+
+    def copy(self, from_path, to_path):
+        """
+        Copy a subtree. Documents are merged into any existing documents at the destination, like copy_doc()
+
+        :param str from_path: Document or collection path to copy
+        :param str to_path: Destination path. Must be the same kind of path as from_path
+
+        :returns dict: Stats: "copied", "missing" (docs that only hold subcollections), "failed", "collections_done", "collections_pending",
+                       "elapsed_s" and "docs_per_s". The copy is complete when "failed" is 0. None if the paths are invalid
+        """
+        is_doc = split_document_path(from_path) is not None and split_document_path(to_path) is not None
+        is_coll = is_valid_collection_path(from_path) and is_valid_collection_path(to_path)
+        if not is_doc and not is_coll:
+            logging.error(f"TreeCopier: copy: from_path and to_path must both be document paths or both be collection paths. Got {from_path} and {to_path}")
+            return None
+        self.__from_path = from_path
+        self.__to_path = to_path
+        self.__start_time = time.monotonic()
+        self.__last_report = self.__start_time
+        self.__in_flight = 0
+        self.__slots = threading.BoundedSemaphore(self.__max_in_flight)
+        self.__stats = {
+            "copied": 0,
+            "missing": 0,
+            "failed": 0,
+            "collections_done": 0,
+            "collections_pending": 0,
+            "elapsed_s": 0.0,
+            "docs_per_s": 0.0
+        }
+        self.__collections = {}
+        self.__root_done = False
+        self.__journal = []
+        checkpoint = self.__load_checkpoint()
+        if checkpoint is not None:
+            logging.info(f"TreeCopier: copy: Resuming copy of {from_path} to {to_path} with {len(checkpoint['collections'])} collections left")
+            for src, entry in checkpoint["collections"].items():
+                self.__add_collection(src, entry["dst"], entry["done"])
+            root_done = checkpoint["root_done"]
+        else:
+            root_done = False
+        self.__root_done = root_done
+        self.__start_checkpoint()
+        if not root_done:
+            if is_doc:
+                if self.__copy_root_doc() is not True:
+                    self.__finish()
+                    return self.__stats
+            else:
+                self.__add_collection(from_path, to_path)
+        self.__set_root_done()
+        with ThreadPoolExecutor(max_workers=self.__max_in_flight, thread_name_prefix="TreeCopy") as executor, \
+             ThreadPoolExecutor(max_workers=self.__max_list_in_flight, thread_name_prefix="TreeCopyList") as self.__lister:
+            while True:
+                with self.__lock:
+                    src = next((s for s, c in self.__collections.items() if c["started"] is False), None)
+                    if src is None:
+                        if self.__in_flight == 0:
+                            break
+                        self.__changed.wait(self.__progress_interval)
+                        continue
+                    self.__collections[src]["started"] = True
+                self.__copy_collection(executor, src)
+                self.__maybe_report()
+        self.__finish()
+        return self.__stats
+
+    def __copy_root_doc(self):
+        """
+        Copy the document at from_path itself and queue its subcollections
+        """
+        doc = self.__db.read_docs([self.__from_path])[0]
+        if doc is None:
+            logging.error(f"TreeCopier: __copy_root_doc: Unable to read {self.__from_path}")
+            self.__stats["failed"] += 1
+            return False
+        if type(doc) is dict:
+            if self.__db.write_docs([(self.__to_path, doc)])[0] is not True:
+                logging.error(f"TreeCopier: __copy_root_doc: Unable to write {self.__to_path}")
+                self.__stats["failed"] += 1
+                return False
+            self.__stats["copied"] += 1
+        else:
+            self.__stats["missing"] += 1
+        subs = self.__db.list_subcollections(self.__from_path)
+        if subs is None:
+            self.__stats["failed"] += 1
+            return False
+        for sub in subs:
+            self.__add_collection(sub, self.__to_path + sub[len(self.__from_path):])
+        return True
+
+    def __set_root_done(self):
+        with self.__lock:
+            if self.__root_done is False:
+                self.__root_done = True
+                self.__journal.append({"root_done": True})
+
+    def __copy_collection(self, executor, src):
+        """
+        Page through a collection's document paths and hand them to the pool in batches, skipping docs copied before a resume
+        """
+        coll = self.__collections[src]
+        paths = self.__db.list_doc_paths(src, page_size=self.__batch_size)
+        batch = []
+        if paths is None:
+            paths = [None]
+        for path in paths:
+            if path is None:
+                logging.error(f"TreeCopier: __copy_collection: Listing {src} failed, it will be retried on resume")
+                with self.__lock:
+                    coll["failed"] = True
+                break
+            doc_id = path[len(src):]
+            if doc_id in coll["done"]:
+                continue
+            batch.append(doc_id)
+            if len(batch) >= self.__batch_size:
+                self.__submit(executor, src, batch)
+                batch = []
+        if len(batch) > 0:
+            self.__submit(executor, src, batch)
+        with self.__lock:
+            coll["listed"] = True
+            self.__check_complete(src)
+
+    def __submit(self, executor, src, doc_ids):
+        # Blocks while max_in_flight batches are running, so listing never runs far ahead of copying
+        self.__slots.acquire()
+        with self.__lock:
+            self.__collections[src]["outstanding"] += 1
+            self.__in_flight += 1
+        executor.submit(self.__copy_batch, src, doc_ids)
+
+    def __copy_batch(self, src, doc_ids):
+        """
+        Copy one batch of documents from a collection and queue their subcollections. Runs on the pool
+        """
+        coll = self.__collections[src]
+        dst = coll["dst"]
+        copied, missing, failed = 0, 0, 0
+        done = []
+        try:
+            docs = self.__db.read_docs([src + doc_id for doc_id in doc_ids])
+            items = [(dst + doc_id, doc) for doc_id, doc in zip(doc_ids, docs) if type(doc) is dict]
+            written = dict(zip([path for path, doc in items], self.__db.write_docs(items))) if len(items) > 0 else {}
+            listed = []
+            for doc_id, doc in zip(doc_ids, docs):
+                if doc is None or (type(doc) is dict and written.get(dst + doc_id) is not True):
+                    failed += 1
+                    continue
+                listed.append((doc_id, doc))
+            # One listing round trip per document, so run them side by side instead of one after another
+            all_subs = self.__lister.map(self.__db.list_subcollections, [src + doc_id for doc_id, doc in listed])
+            for (doc_id, doc), subs in zip(listed, all_subs):
+                if subs is None:
+                    failed += 1
+                    continue
+                for sub in subs:
+                    self.__add_collection(sub, dst + sub[len(src):])
+                if type(doc) is dict:
+                    copied += 1
+                else:
+                    missing += 1
+                done.append(doc_id)
+        except Exception as e:
+            logging.error(f"TreeCopier: __copy_batch: An unknown exception occured copying a batch of {len(doc_ids)} documents from {src}")
+            logging.error(e)
+            failed = len(doc_ids) - len(done)
+        finally:
+            with self.__lock:
+                coll["done"].update(done)
+                if len(done) > 0:
+                    self.__journal.append({"done": src, "ids": done})
+                self.__stats["copied"] += copied
+                self.__stats["missing"] += missing
+                self.__stats["failed"] += failed
+                if failed > 0:
+                    coll["failed"] = True
+                coll["outstanding"] -= 1
+                self.__in_flight -= 1
+                self.__check_complete(src)
+                self.__changed.notify_all()
+            self.__slots.release()
+            self.__maybe_report()
+
+    def __add_collection(self, src, dst, done=None):
+        with self.__lock:
+            if src not in self.__collections:
+                self.__collections[src] = {
+                    "dst": dst,
+                    "done": set(done or []),
+                    "started": False,
+                    "listed": False,
+                    "failed": False,
+                    "outstanding": 0
+                }
+                self.__journal.append({"add": src, "dst": dst})
+                self.__changed.notify_all()
+
+    def __check_complete(self, src):
+        # Caller holds self.__lock. A collection is forgotten once listed and every batch copied; failed ones stay in the checkpoint
+        coll = self.__collections[src]
+        if coll["listed"] and coll["outstanding"] == 0 and not coll["failed"]:
+            del self.__collections[src]
+            self.__journal.append({"complete": src})
+            self.__stats["collections_done"] += 1
+
+    def __maybe_report(self):
+        now = time.monotonic()
+        with self.__lock:
+            if now - self.__last_report < self.__progress_interval:
+                return
+            self.__last_report = now
+        self.__report()
+
+    def __report(self):
+        with self.__lock:
+            elapsed = time.monotonic() - self.__start_time
+            self.__stats["elapsed_s"] = round(elapsed, 3)
+            self.__stats["docs_per_s"] = round(self.__stats["copied"] / elapsed, 2) if elapsed > 0 else 0.0
+            self.__stats["collections_pending"] = len(self.__collections)
+            stats = dict(self.__stats)
+        logging.info(f"TreeCopier: Copying {self.__from_path} to {self.__to_path}: {stats}")
+        self.__save_checkpoint()
+        if self.__progress_callback is not None:
+            try:
+                self.__progress_callback(stats)
+            except Exception as e:
+                logging.error("TreeCopier: __report: progress_callback raised an exception")
+                logging.error(e)
+
+    def __finish(self):
+        self.__report()
+        if self.__checkpoint_file is not None and self.__stats["failed"] == 0 and len(self.__collections) == 0:
+            try:
+                os.remove(self.__checkpoint_file)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.error(f"TreeCopier: __finish: Unable to remove checkpoint file {self.__checkpoint_file}")
+                logging.error(e)
+
+    def __load_checkpoint(self):
+        """
+        Replay the checkpoint journal: a header line, then one line per collection added, batch of documents copied, collection
+        completed and root copied. A torn last line (ex: the process died mid-save) is ignored
+
+        :returns dict: Checkpoint for this from_path and to_path ({"root_done": bool, "collections": {src: {"dst": str, "done": list}}}), or None if there is none
+        """
+        if self.__checkpoint_file is None or not os.path.exists(self.__checkpoint_file):
+            return None
+        try:
+            with open(self.__checkpoint_file) as f:
+                lines = f.read().splitlines()
+            header = json.loads(lines[0])
+        except Exception as e:
+            logging.error(f"TreeCopier: __load_checkpoint: Unable to read checkpoint file {self.__checkpoint_file}. Starting over")
+            logging.error(e)
+            return None
+        if header.get("from") != self.__from_path or header.get("to") != self.__to_path:
+            logging.warning(f"TreeCopier: __load_checkpoint: Checkpoint file {self.__checkpoint_file} is for a different copy. Starting over")
+            return None
+        checkpoint = {"root_done": False, "collections": {}}
+        collections = checkpoint["collections"]
+        for n, line in enumerate(lines[1:], start=2):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                if n == len(lines):
+                    break
+                logging.error(f"TreeCopier: __load_checkpoint: Line {n} of checkpoint file {self.__checkpoint_file} is corrupt. Starting over")
+                return None
+            if "add" in event:
+                collections.setdefault(event["add"], {"dst": event["dst"], "done": set()})
+            elif "done" in event and event["done"] in collections:
+                collections[event["done"]]["done"].update(event["ids"])
+            elif "complete" in event:
+                collections.pop(event["complete"], None)
+            elif "root_done" in event:
+                checkpoint["root_done"] = True
+        return checkpoint
+
+    def __start_checkpoint(self):
+        """
+        Write a fresh journal holding only the current state, replacing any old one. Later saves append to it
+        """
+        if self.__checkpoint_file is None:
+            return
+        with self.__lock:
+            lines = [{"from": self.__from_path, "to": self.__to_path}]
+            for src, c in self.__collections.items():
+                lines.append({"add": src, "dst": c["dst"]})
+                if len(c["done"]) > 0:
+                    lines.append({"done": src, "ids": sorted(c["done"])})
+            if self.__root_done:
+                lines.append({"root_done": True})
+            self.__journal = []
+        with self.__save_lock:
+            tmp = self.__checkpoint_file + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    f.write("".join(json.dumps(line) + "\n" for line in lines))
+                os.replace(tmp, self.__checkpoint_file)
+            except Exception as e:
+                logging.error(f"TreeCopier: __start_checkpoint: Unable to write checkpoint file {self.__checkpoint_file}")
+                logging.error(e)
+
+    def __save_checkpoint(self):
+        """
+        Append what changed since the last save to the journal
+        """
+        if self.__checkpoint_file is None:
+            return
+        with self.__save_lock:
+            with self.__lock:
+                events, self.__journal = self.__journal, []
+            if len(events) == 0:
+                return
+            try:
+                with open(self.__checkpoint_file, "a") as f:
+                    f.write("".join(json.dumps(event) + "\n" for event in events))
+            except Exception as e:
+                logging.error(f"TreeCopier: __save_checkpoint: Unable to write checkpoint file {self.__checkpoint_file}")
+                logging.error(e)
+                with self.__lock:
+                    self.__journal = events + self.__journal
+
+if __name__ == "__main__":
+    # Usage: python treecopy.py <from_path> <to_path> [checkpoint_file]
+    # Copies a Firestore document or collection subtree. Run it again with the same checkpoint file to resume a failed copy
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) not in [3, 4]:
+        print("Usage: python treecopy.py <from_path> <to_path> [checkpoint_file]")
+        sys.exit(2)
+    stats = TreeCopier(checkpoint_file=sys.argv[3] if len(sys.argv) == 4 else None).copy(sys.argv[1], sys.argv[2])
+    sys.exit(0 if stats is not None and stats["failed"] == 0 else 1)
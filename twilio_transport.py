@@ -0,0 +1,158 @@
+import logging, random, time
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout
+from twilio.http.http_client import TwilioHttpClient
+from utils import ConfigProvider
+
+class RetryPolicy():
+
+    # Methods that are safe to repeat after the server may have acted on them
+    IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "DELETE"]
+
+    def __init__(self, max_retries, backoff_base, backoff_max, retry_statuses):
+        """
+        When and how long to wait before retrying a Twilio API request. Shared by the sync and async transports.
+
+        A request that never reached Twilio (the connection couldn't be made) is always retried. Other failures are only retried
+        for IDEMPOTENT_METHODS, except for statuses that say the request wasn't processed: 429, and 503 with a Retry-After header.
+        A POST that creates a message is never resent after a 5xx, since Twilio may already have accepted it.
+
+        :param int max_retries: Retries after the first attempt. 0 disables retrying
+        :param float backoff_base: Upper bound in seconds of the first retry's delay. Doubles every retry
+        :param float backoff_max: Upper bound in seconds of any retry delay, including Retry-After
+        :param list retry_statuses: HTTP status codes that may be retried
+        """
+        self.max_retries = max(0, max_retries)
+        self.__backoff_base = max(0.0, backoff_base)
+        self.__backoff_max = max(0.0, backoff_max)
+        self.__retry_statuses = [int(status) for status in retry_statuses]
+
+    def delay(self, method, attempt, response=None, never_sent=False):
+        """
+        :param str method: HTTP method of the request
+        :param int attempt: Retries made so far
+        :param response: Response of the failed attempt, or None if it raised a connection error
+        :param bool never_sent: The connection error happened before the request was sent (ex: connect timeout)
+
+        :returns float: Seconds to wait before retrying, or None if the request must not be retried
+        """
+        if attempt >= self.max_retries:
+            return None
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        if response is None:
+            if never_sent or idempotent:
+                return backoff_delay(attempt, self.__backoff_base, self.__backoff_max)
+            return None
+        if response.status_code not in self.__retry_statuses:
+            return None
+        retry_after = retry_after_delay(response, self.__backoff_max)
+        if not idempotent and response.status_code != 429 and not (response.status_code == 503 and retry_after is not None):
+            return None
+        if retry_after is not None:
+            return retry_after
+        return backoff_delay(attempt, self.__backoff_base, self.__backoff_max)
+
+class PooledTwilioHttpClient(TwilioHttpClient):
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, max_retries, backoff_base, backoff_max, retry_statuses, base_url=""):
+        """
+        Twilio HTTP client with one shared keep-alive connection pool, explicit connect/read timeouts and jittered exponential
+        backoff for retryable responses (see RetryPolicy). Reusing pooled connections means a send only pays for a TLS handshake
+        when the pool has to open a new connection.
+
+        :param int pool_size: Maximum number of kept-alive connections. Size this to the number of threads that send SMS
+        :param float connect_timeout: Seconds to wait for a connection
+        :param float read_timeout: Seconds to wait for a response once connected
+        :param int max_retries: See RetryPolicy
+        :param float backoff_base: See RetryPolicy
+        :param float backoff_max: See RetryPolicy
+        :param list retry_statuses: See RetryPolicy
+        :param str base_url: If not empty, every Twilio API URL is sent here instead (ex: "http://127.0.0.1:8099" for a local stand-in)
+        """
+        super().__init__(pool_connections=True)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Set after the parent constructor, which only accepts a single number
+        self.timeout = (connect_timeout, read_timeout)
+        self.__retry = RetryPolicy(max_retries, backoff_base, backoff_max, retry_statuses)
+        self.__base_url = urlsplit(base_url) if base_url else None
+
+    def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+        """
+        Make an HTTP request, retrying failures that RetryPolicy allows. See TwilioHttpClient.request() for the parameters.
+
+        :returns: twilio.http.response.Response of the last attempt
+        """
+        url = self.__rewrite_url(url)
+        attempt = 0
+        while True:
+            try:
+                response = super().request(method, url, params=params, data=data, headers=headers, auth=auth, timeout=timeout, allow_redirects=allow_redirects)
+            except ConnectionError as e:
+                delay = self.__retry.delay(method, attempt, never_sent=isinstance(e, ConnectTimeout))
+                if delay is None:
+                    raise
+                logging.warning(f"PooledTwilioHttpClient: request: {method} {url} failed to connect ({e}). Retry {attempt + 1}/{self.__retry.max_retries} in {delay:.2f}s")
+            else:
+                delay = self.__retry.delay(method, attempt, response=response)
+                if delay is None:
+                    return response
+                logging.warning(f"PooledTwilioHttpClient: request: {method} {url} returned {response.status_code}. Retry {attempt + 1}/{self.__retry.max_retries} in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def __rewrite_url(self, url):
+        return rewrite_base_url(url, self.__base_url)
+
+def backoff_delay(attempt, backoff_base, backoff_max):
+    """
+    Full jitter backoff: a random delay between 0 and min(backoff_max, backoff_base * 2^attempt)
+    """
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+def retry_after_delay(response, backoff_max):
+    """
+    :returns float: The response's Retry-After delay in seconds, capped at backoff_max, or None if it has none
+    """
+    try:
+        value = response.headers.get("Retry-After") if response.headers is not None else None
+        if value is None:
+            return None
+        return min(backoff_max, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return None
+
+def rewrite_base_url(url, base_url):
+    """
+    :param str url: Twilio API URL
+    :param base_url: urlsplit() result of twilio_api_base_url, or None to keep url as is
+
+    :returns str: url sent to base_url instead of api.twilio.com
+    """
+    if base_url is None:
+        return url
+    parts = urlsplit(url)
+    return urlunsplit((base_url.scheme, base_url.netloc, base_url.path.rstrip("/") + parts.path, parts.query, parts.fragment))
+
+def make_twilio_http_client():
+    """
+    Build the Twilio HTTP client selected by twilio_transport in the config
+
+    :returns: PooledTwilioHttpClient if twilio_transport is "pooled", otherwise None so twilio uses its default client
+    """
+    conf = ConfigProvider()
+    if conf.twilio_transport != "pooled":
+        return None
+    pool_size = conf.twilio_pool_size if conf.twilio_pool_size > 0 else conf.sms_worker_count + conf.sms_broadcast_workers
+    return PooledTwilioHttpClient(
+        pool_size=pool_size,
+        connect_timeout=conf.twilio_connect_timeout,
+        read_timeout=conf.twilio_read_timeout,
+        max_retries=conf.twilio_max_retries,
+        backoff_base=conf.twilio_backoff_base,
+        backoff_max=conf.twilio_backoff_max,
+        retry_statuses=conf.twilio_retry_statuses,
+        base_url=conf.twilio_api_base_url
+    )
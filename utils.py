@@ -1,19 +1,34 @@
-import json, yaml, os, platform, subprocess
-import flask
-from threading import Timer
+import json, yaml, os, platform, subprocess, time
+from threading import Timer, Lock, RLock
 from datetime import datetime
 import logging
 
 class Singleton(type):
     _instances = {}
-    
+    # Reentrant, since a singleton's __init__ often creates other singletons (ex: ConfigProvider)
+    _lock = RLock()
+
     def __call__(cls, *args, **kwargs):
         """
         Make me your metaclass to be a singleton! It's *magic*
+
+        Thread-safe: two threads asking for an instance that doesn't exist yet get the same one. Once it exists no lock is taken
         """
-        if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
+        instance = cls._instances.get(cls)
+        if instance is None:
+            with Singleton._lock:
+                instance = cls._instances.get(cls)
+                if instance is None:
+                    instance = super(Singleton, cls).__call__(*args, **kwargs)
+                    cls._instances[cls] = instance
+        return instance
+
+def _reset_singleton_lock():
+    # A thread of the parent may have held the lock when it forked, and would never release it in the child
+    Singleton._lock = RLock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_singleton_lock)
 
 class SimpleJsonYmlReader:
 
@@ -106,6 +121,106 @@ class ConfigProvider(metaclass=Singleton):
             self.logfile_name = str(self.__config_dict["logfile_name"])
         except Exception as e:
             logging.error(f"ConfigProvider: An unknown error occured or a value was missing from your config.yml. Check your config.yml.TEMPLATE file for a correct example\n", e)
+        # Optional settings. These fall back to their defaults so that older config.yml files keep working
+        self.storage_backend_modules = self.__get_optional("storage_backend_modules", [], list)
+        self.log_queue_enabled = self.__get_optional("log_queue_enabled", False, bool)
+        self.log_queue_size = self.__get_optional("log_queue_size", 10000, int)
+        self.log_queue_overflow = self.__get_optional("log_queue_overflow", "block", str)
+        self.log_queue_sample_rate = self.__get_optional("log_queue_sample_rate", 10, int)
+        self.logfile_per_process = self.__get_optional("logfile_per_process", False, bool)
+        self.log_format = self.__get_optional("log_format", "text", str)
+        self.log_sample_rates = self.__get_optional("log_sample_rates", {}, dict)
+        self.log_request_events = self.__get_optional("log_request_events", False, bool)
+        self.metrics_enabled = self.__get_optional("metrics_enabled", False, bool)
+        self.metrics_dir = self.__get_optional("metrics_dir", "", str)
+        self.metrics_flush_interval = self.__get_optional("metrics_flush_interval", 5.0, float)
+        self.profiling_enabled = self.__get_optional("profiling_enabled", False, bool)
+        self.profiling_sample_rate = self.__get_optional("profiling_sample_rate", 0.0, float)
+        self.profiling_latency_threshold_ms = self.__get_optional("profiling_latency_threshold_ms", 0.0, float)
+        self.profiling_sample_interval_ms = self.__get_optional("profiling_sample_interval_ms", 10.0, float)
+        self.profiling_header_token = self.__get_optional("profiling_header_token", "", str)
+        self.profiling_dir = self.__get_optional("profiling_dir", "profiles", str)
+        self.profiling_max_files = self.__get_optional("profiling_max_files", 200, int)
+        self.tracing_enabled = self.__get_optional("tracing_enabled", False, bool)
+        self.tracing_file = self.__get_optional("tracing_file", "traces.jsonl", str)
+        self.tracing_queue_size = self.__get_optional("tracing_queue_size", 10000, int)
+        self.tracing_service_name = self.__get_optional("tracing_service_name", "portfolio-app-server", str)
+        self.firestore_cache_enabled = self.__get_optional("firestore_cache_enabled", False, bool)
+        self.firestore_cache_max_entries = self.__get_optional("firestore_cache_max_entries", 1024, int)
+        self.firestore_cache_ttl = self.__get_optional("firestore_cache_ttl", 30.0, float)
+        self.firestore_ref_cache_size = self.__get_optional("firestore_ref_cache_size", 4096, int)
+        self.firestore_purge_rate = self.__get_optional("firestore_purge_rate", 500.0, float)
+        self.firestore_purge_workers = self.__get_optional("firestore_purge_workers", 4, int)
+        self.write_behind_enabled = self.__get_optional("write_behind_enabled", False, bool)
+        self.write_behind_max_buffer = self.__get_optional("write_behind_max_buffer", 5000, int)
+        self.write_behind_flush_size = self.__get_optional("write_behind_flush_size", 200, int)
+        self.write_behind_flush_interval = self.__get_optional("write_behind_flush_interval", 1.0, float)
+        self.write_behind_put_timeout = self.__get_optional("write_behind_put_timeout", 0.5, float)
+        self.write_behind_max_retries = self.__get_optional("write_behind_max_retries", 3, int)
+        self.ping_coalesce_enabled = self.__get_optional("ping_coalesce_enabled", False, bool)
+        self.ping_coalesce_window = self.__get_optional("ping_coalesce_window", 5.0, float)
+        self.ping_coalesce_max_clients = self.__get_optional("ping_coalesce_max_clients", 10000, int)
+        self.log_shard_mode = self.__get_optional("log_shard_mode", "monolithic", str)
+        self.log_shard_count = self.__get_optional("log_shard_count", 16, int)
+        self.log_retention_enabled = self.__get_optional("log_retention_enabled", False, bool)
+        self.log_retention_interval = self.__get_optional("log_retention_interval", 3600.0, float)
+        self.sms_log_max_age_days = self.__get_optional("sms_log_max_age_days", 90.0, float)
+        self.sms_log_max_entries_per_client = self.__get_optional("sms_log_max_entries_per_client", 1000, int)
+        self.ping_log_max_age_days = self.__get_optional("ping_log_max_age_days", 0.0, float)
+        self.log_retention_archive = self.__get_optional("log_retention_archive", True, bool)
+        self.log_retention_batch_size = self.__get_optional("log_retention_batch_size", 100, int)
+        self.log_retention_rate = self.__get_optional("log_retention_rate", 50.0, float)
+        self.sms_dispatch_mode = self.__get_optional("sms_dispatch_mode", "sync", str)
+        self.sms_worker_count = self.__get_optional("sms_worker_count", 4, int)
+        self.sms_queue_depth = self.__get_optional("sms_queue_depth", 1000, int)
+        self.sms_status_retention = self.__get_optional("sms_status_retention", 10000, int)
+        self.sms_broadcast_workers = self.__get_optional("sms_broadcast_workers", 8, int)
+        self.sms_broadcast_rate = self.__get_optional("sms_broadcast_rate", 1.0, float)
+        self.sms_broadcast_max_recipients = self.__get_optional("sms_broadcast_max_recipients", 500, int)
+        self.sms_broadcast_max_wait = self.__get_optional("sms_broadcast_max_wait", 20.0, float)
+        self.twilio_transport = self.__get_optional("twilio_transport", "pooled", str)
+        self.twilio_pool_size = self.__get_optional("twilio_pool_size", 0, int)
+        self.twilio_connect_timeout = self.__get_optional("twilio_connect_timeout", 3.05, float)
+        self.twilio_read_timeout = self.__get_optional("twilio_read_timeout", 10.0, float)
+        self.twilio_max_retries = self.__get_optional("twilio_max_retries", 3, int)
+        self.twilio_backoff_base = self.__get_optional("twilio_backoff_base", 0.25, float)
+        self.twilio_backoff_max = self.__get_optional("twilio_backoff_max", 8.0, float)
+        self.twilio_retry_statuses = self.__get_optional("twilio_retry_statuses", [429, 500, 502, 503, 504], list)
+        self.twilio_api_base_url = self.__get_optional("twilio_api_base_url", "", str)
+        self.admission_enabled = self.__get_optional("admission_enabled", False, bool)
+        self.admission_client_limits = self.__get_optional("admission_client_limits", {}, dict)
+        self.admission_ip_limits = self.__get_optional("admission_ip_limits", {}, dict)
+        self.admission_max_concurrency = self.__get_optional("admission_max_concurrency", {}, dict)
+        self.admission_concurrency_retry_after = self.__get_optional("admission_concurrency_retry_after", 1.0, float)
+        self.admission_max_tracked_keys = self.__get_optional("admission_max_tracked_keys", 100000, int)
+        self.admission_shared_path = self.__get_optional("admission_shared_path", "", str)
+        self.async_storage_threads = self.__get_optional("async_storage_threads", 32, int)
+        self.async_sms_max_in_flight = self.__get_optional("async_sms_max_in_flight", 200, int)
+        self.sqlite_pool_size = self.__get_optional("sqlite_pool_size", 8, int)
+        self.sqlite_pool_timeout = self.__get_optional("sqlite_pool_timeout", 5.0, float)
+        self.sqlite_busy_timeout_ms = self.__get_optional("sqlite_busy_timeout_ms", 5000, int)
+        self.sqlite_cache_size_kib = self.__get_optional("sqlite_cache_size_kib", 16384, int)
+        self.sqlite_mmap_size = self.__get_optional("sqlite_mmap_size", 268435456, int)
+        self.sqlite_synchronous = self.__get_optional("sqlite_synchronous", "NORMAL", str)
+
+    def __get_optional(self, key, default, cast):
+        """
+        Read an optional config value
+
+        :param str key: Config key
+        :param default: Value to use if the key is missing or invalid
+        :param cast: Type to cast the value to (ex: int)
+
+        :returns: The cast config value, or default
+        """
+        if type(self.__config_dict) is not dict or self.__config_dict.get(key) is None:
+            return default
+        try:
+            return cast(self.__config_dict[key])
+        except Exception as e:
+            logging.error(f"ConfigProvider: Invalid value '{self.__config_dict[key]}' for {key}. Using default of '{default}'")
+            logging.error(e)
+            return default
 
 class InfoProivder(metaclass=Singleton):
 
@@ -145,6 +260,8 @@ class RepeatedTimer(object):
     def start(self):
         if not self.is_running:
             self._timer = Timer(self.interval, self._run)
+            # Daemon so that a running timer never holds the interpreter open on shutdown
+            self._timer.daemon = True
             self._timer.start()
             self.is_running = True
 
@@ -152,6 +269,82 @@ class RepeatedTimer(object):
         self._timer.cancel()
         self.is_running = False
 
+class RateLimiter():
+
+    def __init__(self, rate, burst=None):
+        """
+        Thread-safe token bucket. Refills at rate tokens per second and holds at most burst tokens.
+
+        :param float rate: Tokens added per second. 0 or less disables limiting
+        :param float burst: Bucket size. Defaults to rate (one second's worth), minimum 1
+        """
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst) if burst is not None else self.rate)
+        self.__tokens = self.burst
+        self.__last = time.monotonic()
+        self.__lock = Lock()
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if they are available
+
+        :param float tokens: Number of tokens to take
+
+        :returns float: 0.0 if the tokens were taken, otherwise the number of seconds until they will be available
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            if self.__tokens >= tokens:
+                self.__tokens -= tokens
+                return 0.0
+            return (tokens - self.__tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available, then take them
+
+        :param float tokens: Number of tokens to take
+        """
+        wait = self.try_acquire(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire(tokens)
+
+    def reserve(self, count, max_wait):
+        """
+        Take count tokens now, going into debt for the ones that aren't available yet, so each caller knows when its turn comes
+        without polling. Nothing is taken if the last token wouldn't be available within max_wait seconds.
+        try_acquire() and acquire() callers wait for the debt to be paid off.
+
+        :param int count: Number of tokens, one per paced action
+        :param float max_wait: Seconds the last token may be away
+
+        :returns list: Seconds from now until each token is available, or None if the last one is more than max_wait away
+        """
+        if self.rate <= 0:
+            return [0.0] * count
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            if (count - self.__tokens) / self.rate > max_wait:
+                return None
+            waits = [max(0.0, (n - self.__tokens) / self.rate) for n in range(1, count + 1)]
+            self.__tokens -= count
+            return waits
+
+    def capacity(self, seconds):
+        """
+        :returns float: Most tokens an idle limiter hands out within seconds. Infinite if limiting is disabled
+        """
+        if self.rate <= 0:
+            return float("inf")
+        return self.burst + self.rate * seconds
+
 # Utility methods not contained within classes below
 
 def get_timestamp():
@@ -201,6 +394,17 @@ class RequestUtils():
             "Status": "Success"
         }
 
+    def queued_template(self, message_id):
+        """
+        Get a dict for a request that was accepted and queued for later processing
+
+        :param str message_id: ID the client can use to look up the result
+        """
+        return {
+            "Status": "Queued",
+            "Message ID": message_id
+        }
+
     def failure_template_missing_keys(self, keys):
         """
         Generate a request response based on required keys which are missing from the request body (raw json body)
@@ -0,0 +1,222 @@
+import logging, os, threading, time, atexit, copy
+from collections import deque
+from utils import ConfigProvider, Singleton, RepeatedTimer
+from storage import get_backend
+
+class WriteBehindBuffer(metaclass=Singleton):
+
+    # Firestore's WriteBatch limit
+    MAX_FLUSH_SIZE = 500
+
+    def __init__(self):
+        """
+        Write-behind buffer for log documents. Request threads queue document merges here instead of waiting on a database round trip,
+        and a background flusher commits them with the storage backend's write_docs() (WriteBatch operations on Firestore) once
+        write_behind_flush_size writes are waiting, or every write_behind_flush_interval seconds, so no write waits much longer than that.
+
+        The buffer holds at most write_behind_max_buffer writes (pending + in flight). When it is full, put() waits up to
+        write_behind_put_timeout seconds for space and then writes synchronously instead (so does a put() after shutdown()).
+
+        Ordering: merges to the same document are applied in put() order. Queued merges commit in queue order, and a failed one
+        goes back to the front of the queue. A synchronous write first waits for the batch in flight, then takes that document's
+        pending merges out of the queue and writes them together with the new merge, so it can't be overtaken by an older one.
+        There is no ordering between different documents.
+        Everything still pending is flushed when the process exits. A forked child (ex: a gunicorn worker of a --preload master)
+        starts with an empty buffer and its own flush timer; writes the parent had pending are left for the parent to flush.
+
+        Functions:\n
+        -- -- -- -- -- --
+        put(): Queue a document merge
+        flush(): Commit everything currently pending
+        shutdown(): Stop the flusher and flush everything that is left
+        pending_count(): Number of writes waiting to be committed
+        """
+        self.__conf = ConfigProvider()
+        self.__max_buffer = max(1, self.__conf.write_behind_max_buffer)
+        self.__flush_size = min(max(1, self.__conf.write_behind_flush_size), self.MAX_FLUSH_SIZE)
+        self.__flush_interval = max(0.05, self.__conf.write_behind_flush_interval)
+        self.__put_timeout = max(0.0, self.__conf.write_behind_put_timeout)
+        self.__max_retries = max(0, self.__conf.write_behind_max_retries)
+        self.__db = get_backend(self.__conf.database_type)
+        self.__closed = False
+        self.__start()
+        atexit.register(self.shutdown)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.__start)
+
+    def __start(self):
+        """
+        Start with an empty buffer, fresh locks and a flush timer. Also run in a forked child, where the timer thread doesn't
+        exist and the locks may have been held by one of the parent's threads
+        """
+        self.__pending = deque()
+        self.__in_flight = 0
+        self.__size_flush_running = False
+        self.__lock = threading.Lock()
+        self.__space = threading.Condition(self.__lock)
+        self.__flush_lock = threading.Lock()
+        self.__timer = RepeatedTimer(self.__flush_interval, self.__on_timer)
+
+    def put(self, path, write_dict):
+        """
+        Queue a document merge to be committed in the background
+
+        :param str path: Document path. Same rules as StorageBackend.write_doc()
+        :param dict write_dict: Dict to merge into the document
+
+        :returns: True if queued. If the buffer stayed full for write_behind_put_timeout seconds or has been shut down, the result of a synchronous write (see __write_through())
+        """
+        deadline = time.monotonic() + self.__put_timeout
+        with self.__lock:
+            while not self.__closed and len(self.__pending) + self.__in_flight >= self.__max_buffer:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__space.wait(remaining)
+            queued = not self.__closed and len(self.__pending) + self.__in_flight < self.__max_buffer
+            if queued:
+                self.__pending.append([path, write_dict, 0])
+                start_size_flush = len(self.__pending) >= self.__flush_size and self.__size_flush_running is False
+                if start_size_flush:
+                    self.__size_flush_running = True
+        if not queued:
+            if not self.__closed:
+                logging.warning(f"WriteBehindBuffer: put: Buffer full ({self.__max_buffer} writes). Falling back to a synchronous write for {path}")
+            return self.__write_through(path, write_dict)
+        if start_size_flush:
+            threading.Thread(target=self.__size_flush, name="WriteBehindFlush", daemon=True).start()
+        return True
+
+    def flush(self):
+        """
+        Commit everything currently pending, in batches of at most write_behind_flush_size writes.
+        Stops early if a batch fails; its writes are retried on the next flush.
+
+        :returns int: Number of writes committed
+        """
+        committed = 0
+        with self.__flush_lock:
+            while True:
+                chunk = self.__take_chunk()
+                if len(chunk) == 0:
+                    return committed
+                c = self.__commit_chunk(chunk)
+                committed += c
+                if c < len(chunk) and not self.__closed:
+                    return committed
+
+    def shutdown(self):
+        """
+        Stop the background flusher and flush every pending write. Registered with atexit so worker exits don't lose buffered logs.
+        """
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__space.notify_all()
+        self.__timer.stop()
+        committed = self.flush()
+        logging.debug(f"WriteBehindBuffer: shutdown: Flushed {committed} pending writes")
+
+    def pending_count(self):
+        """
+        :returns int: Number of writes waiting to be committed, including ones currently in flight
+        """
+        with self.__lock:
+            return len(self.__pending) + self.__in_flight
+
+    def __write_through(self, path, write_dict):
+        """
+        Write a document merge synchronously without overtaking older merges to the same document. Holding the flush lock means
+        no batch is in flight, so every older merge for path is either committed, dropped or still pending. The pending ones are
+        taken out of the queue and merged (oldest first) under write_dict, and the result is written as one write_doc().
+        If that write fails and older merges were taken, the combined merge goes back in the queue in their place to be retried.
+
+        :param str path: Document path
+        :param dict write_dict: Dict to merge into the document
+
+        :returns: The result of the backend's write_doc()
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                older = [item for item in self.__pending if item[0] == path]
+                if len(older) > 0:
+                    self.__pending = deque(item for item in self.__pending if item[0] != path)
+                    self.__space.notify_all()
+            if len(older) == 0:
+                return self.__db.write_doc(path, write_dict)
+            merged = {}
+            for item in older:
+                self.__deep_merge(merged, item[1])
+            self.__deep_merge(merged, write_dict)
+            res = self.__db.write_doc(path, merged)
+            if res is False and not self.__closed:
+                with self.__lock:
+                    self.__pending.appendleft([path, merged, max(item[2] for item in older)])
+            return res
+
+    def __deep_merge(self, target, source):
+        """
+        Merge source into target the way the backends merge writes: nested dicts merge, everything else is replaced
+        """
+        for key, value in source.items():
+            if type(value) is dict and type(target.get(key)) is dict:
+                self.__deep_merge(target[key], value)
+            else:
+                target[key] = copy.deepcopy(value)
+
+    def __on_timer(self):
+        """
+        RepeatedTimer callback. Flushes anything that has been pending since the last tick
+        """
+        if self.pending_count() > 0:
+            self.flush()
+
+    def __size_flush(self):
+        """
+        Flush triggered by put() once write_behind_flush_size writes are pending
+        """
+        try:
+            self.flush()
+        finally:
+            with self.__lock:
+                self.__size_flush_running = False
+
+    def __take_chunk(self):
+        """
+        Move up to write_behind_flush_size pending writes to in flight
+
+        :returns list: The writes to commit
+        """
+        with self.__lock:
+            chunk = []
+            while len(self.__pending) > 0 and len(chunk) < self.__flush_size:
+                chunk.append(self.__pending.popleft())
+            self.__in_flight += len(chunk)
+            return chunk
+
+    def __commit_chunk(self, chunk):
+        """
+        Commit a chunk of writes as one batch. Failed writes are put back at the front of the buffer until write_behind_max_retries is reached.
+
+        :param list chunk: Writes from __take_chunk()
+
+        :returns int: Number of writes committed
+        """
+        results = self.__db.write_docs([(item[0], item[1]) for item in chunk])
+        retry = []
+        committed = 0
+        for item, res in zip(chunk, results):
+            if res is True:
+                committed += 1
+            elif res is False and item[2] < self.__max_retries:
+                item[2] += 1
+                retry.append(item)
+            else:
+                logging.error(f"WriteBehindBuffer: __commit_chunk: Dropping write to {item[0]} after {item[2] + 1} failed attempts")
+        with self.__lock:
+            self.__in_flight -= len(chunk)
+            for item in reversed(retry):
+                self.__pending.appendleft(item)
+            self.__space.notify_all()
+        return committed